@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Run many sets of OED inputs through the test tool on a pool of processes.
+Each case runs in its own scratch directory and its net losses are written
+to its own output directory, as by tests/gen_output.py. The results, timings
+and failures of all the cases are collected into one summary.
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+import traceback
+import pandas as pd
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import common
+import reinsurance_tester
+
+# The result of running one case
+CaseResult = namedtuple(
+    "CaseResult",
+    "name oed_dir status exec_time layer_count loss_gul loss_net error")
+
+STATUS_SUCCESS = 'SUCCESS'
+STATUS_FAILED = 'FAILED'
+
+SUMMARY_FILE = "summary.csv"
+
+
+def get_oed_dirs(patterns):
+    """
+    Expand a list of directories, or glob patterns of directories, to the
+    directories that hold an OED account file.
+    """
+    oed_dirs = []
+    for pattern in patterns:
+        for oed_dir in sorted(glob.glob(pattern)):
+            if os.path.exists(os.path.join(oed_dir, "account.csv")) and \
+                    oed_dir not in oed_dirs:
+                oed_dirs.append(oed_dir)
+    return oed_dirs
+
+
+def get_case_names(oed_dirs):
+    """
+    Name each case after its directory, adding a suffix to repeated names.
+    """
+    names = []
+    for oed_dir in oed_dirs:
+        name = os.path.basename(os.path.normpath(oed_dir))
+        if name in names:
+            name = "{}_{}".format(name, len(names))
+        names.append(name)
+    return names
+
+
+def run_case(name, oed_dir, output_dir, loss_factor, fm_engine, keep_scratch=False):
+    """
+    Run a single case and write its net losses to output_dir/name.
+    Failures are returned in the result rather than raised, so that one
+    case does not stop the batch.
+    """
+    t_start = time.time()
+    scratch_dir = tempfile.mkdtemp(prefix="batch_{}_".format(name))
+    layer_count = 0
+    loss_gul = None
+    loss_net = None
+    error = None
+    try:
+        (
+            account_df,
+            location_df,
+            ri_info_df,
+            ri_scope_df,
+            do_reinsurance
+        ) = reinsurance_tester.load_oed_dfs(oed_dir)
+        net_losses = reinsurance_tester.run_test(
+            "run",
+            account_df, location_df, ri_info_df, ri_scope_df,
+            loss_factor,
+            do_reinsurance,
+            fm_engine=fm_engine,
+            session=common.AnalysisSession(scratch_dir))
+
+        case_output_dir = os.path.join(output_dir, name)
+        if not os.path.exists(case_output_dir):
+            os.makedirs(case_output_dir)
+        for (description, net_loss) in net_losses.items():
+            net_loss.to_csv(
+                os.path.join(case_output_dir, "{}.csv".format(
+                    description.replace(' ', '_'))),
+                index=False)
+
+        layer_count = len(net_losses)
+        loss_gul = float(net_losses['Direct'].loss_gul.sum())
+        last_losses = list(net_losses.values())[-1]
+        loss_net = float(last_losses[
+            'loss_net' if 'loss_net' in last_losses.columns else 'loss_il'].sum())
+    except (Exception, SystemExit) as e:
+        # The test tool exits on invalid reinsurance structures
+        error = "{}: {}".format(type(e).__name__, " ".join(str(e).split()))
+        traceback.print_exc()
+    finally:
+        if not keep_scratch:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return CaseResult(
+        name=name,
+        oed_dir=oed_dir,
+        status=STATUS_SUCCESS if error is None else STATUS_FAILED,
+        exec_time=time.time() - t_start,
+        layer_count=layer_count,
+        loss_gul=loss_gul,
+        loss_net=loss_net,
+        error=error)
+
+
+def run_batch(
+        oed_dirs, output_dir,
+        loss_factor=1.0,
+        fm_engine=common.FM_ENGINE_KTOOLS,
+        processes=None,
+        keep_scratch=False):
+    """
+    Run each OED directory as a case on a pool of processes, and return a
+    summary DataFrame with one row per case, in the order of oed_dirs.
+    The summary is also written to output_dir.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    output_dir = os.path.abspath(output_dir)
+    oed_dirs = [os.path.abspath(oed_dir) for oed_dir in oed_dirs]
+    names = get_case_names(oed_dirs)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(
+                run_case, name, oed_dir, output_dir, loss_factor, fm_engine,
+                keep_scratch)
+            for (name, oed_dir) in zip(names, oed_dirs)]
+        results = [future.result() for future in futures]
+
+    summary_df = pd.DataFrame(results, columns=CaseResult._fields)
+    summary_df.to_csv(os.path.join(output_dir, SUMMARY_FILE), index=False)
+    return summary_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run many sets of OED inputs through the Oasis FM in parallel.')
+    parser.add_argument(
+        'oed_dirs', metavar='OED_DIR', type=str, nargs='+',
+        help='The directories containing the OED files, or glob patterns, '
+             'e.g. "examples/*".')
+    parser.add_argument(
+        '-o', '--output_dir', metavar='N', type=str, required=True,
+        help='The directory to write the net losses of each case, and the summary, to.')
+    parser.add_argument(
+        '-l', '--loss_factor', metavar='N', type=float, default=1.0,
+        help='The loss factor to apply to TIVs.')
+    parser.add_argument(
+        '-f', '--fm_engine', metavar='N', type=str,
+        default=common.FM_ENGINE_KTOOLS, choices=common.FM_ENGINES,
+        help='The financial module implementation, either ktools or numpy.')
+    parser.add_argument(
+        '-p', '--processes', metavar='N', type=int, default=None,
+        help='The number of processes, by default the number of CPUs.')
+    parser.add_argument(
+        '-k', '--keep_scratch', action='store_true',
+        help='Keep the scratch directory of each case.')
+
+    args = parser.parse_args()
+
+    summary_df = run_batch(
+        get_oed_dirs(args.oed_dirs),
+        args.output_dir,
+        loss_factor=args.loss_factor,
+        fm_engine=args.fm_engine,
+        processes=args.processes,
+        keep_scratch=args.keep_scratch)
+
+    print(summary_df.to_string(index=False))
+    failed_count = int((summary_df.status == STATUS_FAILED).sum())
+    print("{} cases, {} failed, {:.2f}s total run time".format(
+        len(summary_df.index), failed_count, summary_df.exec_time.sum()))
+    if failed_count > 0:
+        exit(1)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+Scaling benchmark of the test tool on synthetic portfolios. Each portfolio
+size is generated and run in a fresh process, so that its peak memory is
+its own, and the wall time of each stage of the run and the peak memory,
+optionally also of each stage, are written to a JSON file, to catch
+complexity and memory regressions and to size hardware.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import common
+import portfolio_generator
+import reinsurance_tester
+import run_profile
+from run_profile import get_peak_rss
+
+DEFAULT_LOCATION_COUNTS = [1000, 10000, 100000, 1000000]
+
+
+def run_size(
+        location_count,
+        locations_per_account=100,
+        policies_per_account=1,
+        tiv_distribution=portfolio_generator.TIV_DISTRIBUTION_CONSTANT,
+        treaties=portfolio_generator.DEFAULT_TREATIES,
+        event_count=1,
+        fm_engine=common.FM_ENGINE_KTOOLS,
+        partitions=1,
+        chained=False,
+        memory=False,
+        seed=0):
+    """
+    Generate a portfolio of location_count locations and run it through
+    the test tool, with event_count loss factor events.
+    Returns a dict of the sizes of the run, the wall time in seconds of
+    generating the portfolio and of each stage of the run, and the peak
+    memory in bytes. If memory is set, the memory use of each stage, as
+    recorded by run_profile, is also returned, though tracing it slows
+    the run.
+    """
+    t_start = time.time()
+    account_count = max(1, location_count // locations_per_account)
+    (account_df, location_df, ri_info_df, ri_scope_df) = \
+        portfolio_generator.generate_portfolio(
+            account_count,
+            locations_per_account,
+            policies_per_account=policies_per_account,
+            tiv_distribution=tiv_distribution,
+            treaties=treaties,
+            seed=seed)
+    generate_time = time.time() - t_start
+
+    loss_factors = None
+    if event_count > 1:
+        loss_factors = list(np.linspace(0.1, 1.0, event_count))
+
+    scratch_dir = tempfile.mkdtemp(prefix="benchmark_")
+    stage_times = {}
+    profile = run_profile.RunProfile(memory=memory)
+    try:
+        net_losses = reinsurance_tester.run_test(
+            "run",
+            account_df, location_df, ri_info_df, ri_scope_df,
+            1.0,
+            ri_info_df is not None,
+            loss_factors=loss_factors,
+            fm_engine=fm_engine,
+            session=common.AnalysisSession(scratch_dir, partitions=partitions),
+            chained=chained,
+            stage_times=stage_times,
+            profile=profile)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    result = {
+        'location_count': len(location_df.index),
+        'account_count': account_count,
+        'policy_count': len(account_df.index),
+        'contract_count': 0 if ri_info_df is None else len(ri_info_df.index),
+        'scope_count': 0 if ri_scope_df is None else len(ri_scope_df.index),
+        'event_count': event_count,
+        'item_count': len(net_losses['Direct'].index) // event_count,
+        'layer_count': len(net_losses),
+        'generate_time': generate_time,
+        'stage_times': stage_times,
+        'peak_rss': get_peak_rss(),
+        'children_peak_rss': get_peak_rss(resource.RUSAGE_CHILDREN),
+    }
+    if memory:
+        result['stage_memory'] = profile.get_memory()
+        result['net_losses_bytes'] = profile.counts['net_losses']['bytes']
+    return result
+
+
+def run_benchmark(location_counts, output_file, **kwargs):
+    """
+    Run each portfolio size in turn, each in a new process, and write the
+    results, with the environment they were run in, to output_file.
+    The keyword arguments are passed to run_size.
+    """
+    results = []
+    for location_count in location_counts:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results.append(executor.submit(
+                run_size, location_count, **kwargs).result())
+        print("{} locations: {:.2f}s, peak memory {:.1f}MB".format(
+            location_count, results[-1]['stage_times']['total'],
+            results[-1]['peak_rss'] / (1024 * 1024)))
+
+    parameters = dict(kwargs)
+    if 'treaties' in parameters:
+        parameters['treaties'] = [
+            treaty._asdict() for treaty in parameters['treaties']]
+    benchmark = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'environment': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'parameters': parameters,
+        'results': results,
+    }
+    with open(output_file, 'w') as f:
+        json.dump(benchmark, f, indent=4)
+    return benchmark
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Oasis FM with reinsurance on synthetic portfolios.')
+    parser.add_argument(
+        '-o', '--output_file', metavar='N', type=str, default="benchmark.json",
+        help='The JSON file to write the results to.')
+    parser.add_argument(
+        '-s', '--sizes', metavar='N', type=str,
+        default=",".join(str(size) for size in DEFAULT_LOCATION_COUNTS),
+        help='A comma separated list of the numbers of locations to run.')
+    parser.add_argument(
+        '-l', '--locations_per_account', metavar='N', type=int, default=100,
+        help='The number of locations in each account.')
+    parser.add_argument(
+        '-p', '--policies_per_account', metavar='N', type=int, default=1,
+        help='The number of policies in each account.')
+    parser.add_argument(
+        '-t', '--tiv_distribution', metavar='N', type=str,
+        default=portfolio_generator.TIV_DISTRIBUTION_CONSTANT,
+        choices=portfolio_generator.TIV_DISTRIBUTIONS,
+        help='The distribution of location TIVs.')
+    parser.add_argument(
+        '-e', '--events', metavar='N', type=int, default=1,
+        help='The number of events, as a sweep of loss factors.')
+    parser.add_argument(
+        '-f', '--fm_engine', metavar='N', type=str,
+        default=common.FM_ENGINE_KTOOLS, choices=common.FM_ENGINES,
+        help='The financial module implementation, either ktools or numpy.')
+    parser.add_argument(
+        '--partitions', metavar='N', type=int, default=1,
+        help='The number of partitions, by event, to split each fmcalc run into.')
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='Run the layers as one pipeline of fmcalc processes.')
+    parser.add_argument(
+        '--memory', action='store_true',
+        help='Record the memory use of each stage, which slows the runs.')
+    parser.add_argument(
+        '--seed', metavar='N', type=int, default=0,
+        help='The random seed of the portfolios.')
+
+    args = parser.parse_args()
+
+    run_benchmark(
+        [int(size) for size in args.sizes.split(",")],
+        args.output_file,
+        locations_per_account=args.locations_per_account,
+        policies_per_account=args.policies_per_account,
+        tiv_distribution=args.tiv_distribution,
+        event_count=args.events,
+        fm_engine=args.fm_engine,
+        partitions=args.partitions,
+        chained=args.pipeline,
+        memory=args.memory,
+        seed=args.seed)
@@ -1,6 +1,17 @@
+import numpy as np
 import pandas as pd
+import os
+import logging
+import mmap
+import shutil
+import signal
 import subprocess
-from collections import namedtuple
+import tempfile
+import threading
+import ktools_io
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 
 #
@@ -44,6 +55,11 @@ CALCRULE_ID_OCCURRENCE_LIMIT_AND_SHARE = 23
 CALCRULE_ID_OCCURRENCE_CATASTROPHE_EXCESS_OF_LOSS = 24
 CALCRULE_ID_FACULTATIVE_WITH_POLICY_SHARE = 25
 
+# Implementations of the financial module
+FM_ENGINE_KTOOLS = 'ktools'
+FM_ENGINE_NUMPY = 'numpy'
+FM_ENGINES = [FM_ENGINE_KTOOLS, FM_ENGINE_NUMPY]
+
 NO_ALLOCATION_ALLOC_ID = 0
 ALLOCATE_TO_ITEMS_BY_GUL_ALLOC_ID = 1
 ALLOCATE_TO_ITEMS_BY_PREVIOUS_LEVEL_ALLOC_ID = 2
@@ -58,6 +74,13 @@ COVERAGE_TYPES = [
     CONTENTS_COVERAGE_TYPE_ID,
     TIME_COVERAGE_TYPE_ID]
 
+# Location TIV field for each coverage type, in coverage type order
+COVERAGE_TYPE_TIV_FIELDS = OrderedDict([
+    (BUILDING_COVERAGE_TYPE_ID, 'BuildingTIV'),
+    (OTHER_BUILDING_COVERAGE_TYPE_ID, 'OtherTIV'),
+    (CONTENTS_COVERAGE_TYPE_ID, 'ContentsTIV'),
+    (TIME_COVERAGE_TYPE_ID, 'BITIV')])
+
 PERIL_WIND = 1
 PERILS = [PERIL_WIND]
 
@@ -76,19 +99,24 @@ IL_INPUTS_FILES = [
 OPTIONAL_INPUTS_FILES = [
     'events']
 
+KTOOLS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ktools')
+
 CONVERSION_TOOLS = {
-    'coverages': '../ktools/coveragetobin',
-    'events': '../ktools/evetobin',
-    'fm_policytc': '../ktools/fmpolicytctobin',
-    'fm_profile': '../ktools/fmprofiletobin',
-    'fm_programme': '../ktools/fmprogrammetobin',
-    'fm_xref': '../ktools/fmxreftobin',
-    'fmsummaryxref': '../ktools/fmsummaryxreftobin',
-    'gulsummaryxref': '../ktools/gulsummaryxreftobin',
-    'items': "../ktools/itemtobin"}
+    'coverages': 'coveragetobin',
+    'events': 'evetobin',
+    'fm_policytc': 'fmpolicytctobin',
+    'fm_profile': 'fmprofiletobin',
+    'fm_programme': 'fmprogrammetobin',
+    'fm_xref': 'fmxreftobin',
+    'fmsummaryxref': 'fmsummaryxreftobin',
+    'gulsummaryxref': 'gulsummaryxreftobin',
+    'items': "itemtobin"}
+
 
 
 
+# Losses are reported to the same precision as the ktools fmtocsv tool
+LOSS_DECIMALS = 2
 
 NOT_SET_ID = -1
 LARGE_VALUE = 9999999999999
@@ -243,6 +271,35 @@ def get_profile(
         share3=0        # Not used
         )
 
+def get_profiles(
+    profile_ids,
+    deductibles,
+    limits
+    ):
+    """
+    Column-wise version of get_profile, returning an fm_profile DataFrame
+    with one row per element of the profile_ids, deductibles and limits arrays.
+    """
+
+    profile_ids = np.asarray(profile_ids)
+    limits = np.asarray(limits)
+    limits = np.where(limits == 0, LARGE_VALUE, limits)
+    not_used = np.zeros(len(profile_ids), dtype=np.int64)
+
+    return pd.DataFrame({
+        'profile_id': profile_ids,
+        'calcrule_id': np.full(
+            len(profile_ids), CALCRULE_ID_DEDUCTIBLE_ATTACHMENT_LIMIT_AND_SHARE),
+        'deductible1': deductibles,
+        'deductible2': not_used,
+        'deductible3': not_used,
+        'attachment': not_used,
+        'limit': limits,
+        'share1': np.ones(len(profile_ids)),
+        'share2': not_used,
+        'share3': not_used
+        }, columns=FmProfile._fields)
+
 def get_reinsurance_profile(
     profile_id,
     attachment=0,
@@ -291,37 +348,445 @@ def get_occlim_profile(
         share3=1.0        # Not used
         )
 
+class ProfileRegistry(object):
+    """
+    Interns fm profiles by their values, so that each distinct profile is
+    written to fm_profile once. add returns a reference to the profile,
+    which increases in the order that profiles are added, and the
+    references are mapped to the deduplicated profile IDs with
+    get_profile_ids.
+    """
+
+    def __init__(self):
+        self._profile_ids = dict()
+        self._reference_profile_ids = [0]
+        self._profiles = list()
+
+    def add(self, profile):
+        values = tuple(profile[1:])
+        profile_id = self._profile_ids.get(values)
+        if profile_id is None:
+            profile_id = len(self._profiles) + 1
+            self._profile_ids[values] = profile_id
+            self._profiles.append(FmProfile(profile_id, *values))
+        self._reference_profile_ids.append(profile_id)
+        return len(self._reference_profile_ids) - 1
+
+    def get_profile_ids(self, references):
+        return np.asarray(self._reference_profile_ids)[references]
+
+    def get_fm_profiles(self):
+        return pd.DataFrame(self._profiles, columns=FmProfile._fields)
+
+class AnalysisSession(object):
+    """
+    The context of an analysis: the workspace directory that its files are
+    read from and written to, the directory of the ktools binaries, and the
+    logger. Paths are resolved against the session rather than the process
+    working directory, so that several analyses can run at once in one
+    process. max_processes bounds the number of ktools processes that the
+    session runs at once, by default the number of CPUs. partitions is the
+    number of partitions, by event, that each fmcalc run is split into.
+    profile is the run_profile.RunProfile that spans and counts of the work
+    are recorded in, if any.
+    """
+
+    def __init__(
+            self, workspace, ktools_dir=KTOOLS_DIR, logger=None, max_processes=None,
+            partitions=1, profile=None):
+        self.workspace = os.path.abspath(workspace)
+        self.ktools_dir = os.path.abspath(ktools_dir)
+        self.logger = logger or logging.getLogger()
+        self.max_processes = max_processes or os.cpu_count() or 1
+        self.partitions = partitions
+        self.profile = profile
+
+    def get_path(self, *names):
+        """
+        Return the path of a file or directory in the workspace.
+        """
+        return os.path.join(self.workspace, *names)
+
+    def get_ktools_path(self, tool):
+        return os.path.join(self.ktools_dir, tool)
+
+    def get_subsession(self, name):
+        """
+        Return a session for the directory name in this session's workspace,
+        with the same ktools, logger and profile.
+        """
+        return AnalysisSession(
+            self.get_path(name), self.ktools_dir, self.logger, self.max_processes,
+            self.partitions, self.profile)
+
+    def span(self, name, **attributes):
+        """
+        Return a context manager that times its body as a span of the
+        session's profile, or does nothing if the session has no profile.
+        """
+        if self.profile is None:
+            return _no_span()
+        return self.profile.span(name, **attributes)
+
+    def count(self, scope, **counts):
+        if self.profile is not None:
+            self.profile.count(scope, **counts)
+
+
+@contextmanager
+def _no_span():
+    # contextlib.nullcontext needs Python 3.7
+    yield
+
+def get_session(session=None):
+    """
+    Return session or, by default, a session for the working directory.
+    """
+    if session is None:
+        return AnalysisSession(os.getcwd())
+    return session
+
+def _run_conversion_tool(conversion_tool, input_file_path, output_file_path):
+    """
+    Run a conversion tool and return None, or the reason it failed.
+    """
+    try:
+        with open(input_file_path, 'rb') as input_file, \
+                open(output_file_path, 'wb') as output_file:
+            proc = subprocess.run(
+                [conversion_tool], stdin=input_file, stdout=output_file,
+                stderr=subprocess.PIPE)
+    except OSError as e:
+        return str(e)
+    if proc.returncode != 0:
+        return "{} exited with {}: {}".format(
+            os.path.basename(conversion_tool), proc.returncode,
+            proc.stderr.decode(errors='replace').strip())
+    return None
+
+def run_conversion_tools(input_files, csv_directory, bin_directory, session=None):
+    """
+    Convert Oasis structure CSV files to ktools binaries using the ktools
+    conversion tools. Files that are not present are skipped.
+    The files are converted concurrently, by up to the session's
+    max_processes tools at a time. If any conversion fails, the others
+    are still completed and the failures are raised together.
+    """
+    session = get_session(session)
+    conversions = []
+    for input_file in input_files:
+        input_file_path = session.get_path(csv_directory, input_file + ".csv")
+        if not os.path.exists(input_file_path):
+            continue
+        conversions.append((
+            session.get_ktools_path(CONVERSION_TOOLS[input_file]),
+            input_file_path,
+            session.get_path(bin_directory, input_file + ".bin")))
+
+    def _run_conversion(conversion):
+        with session.span(
+                "conversion_tool",
+                tool=os.path.basename(conversion[0]), file=conversion[1]):
+            return _run_conversion_tool(*conversion)
+
+    with ThreadPoolExecutor(max_workers=session.max_processes) as executor:
+        errors = list(executor.map(_run_conversion, conversions))
+
+    failures = [
+        "{}: {}".format(input_file_path, error)
+        for ((_, input_file_path, _), error) in zip(conversions, errors)
+        if error is not None]
+    if failures:
+        raise Exception("Failed to convert:\n" + "\n".join(failures))
+
+def run_fmcalc(
+        fm_input_dir,
+        input_file=None,
+        write_input=None,
+        output_file=None,
+        net=False,
+        allocation=ALLOCATE_TO_ITEMS_BY_PREVIOUS_LEVEL_ALLOC_ID,
+        sidx=1,
+        session=None):
+    """
+    Run fmcalc on the structures in fm_input_dir, a directory in the
+    session's workspace, and return the decoded losses.
+    The input stream is either read from input_file, or written to fmcalc's
+    stdin by calling write_input(stdin) on a separate thread, so that the
+    output is consumed while the input is being written. The raw output
+    stream is copied to output_file if set.
+    """
+    return run_fmcalc_chain(
+        [fm_input_dir],
+        input_file=input_file,
+        write_input=write_input,
+        output_file=output_file,
+        nets=[net],
+        allocation=allocation,
+        sidx=sidx,
+        session=session)[-1]
+
+def _tap_loss_stream(input_stream, output_stream, sidx, results, index, errors):
+    """
+    Decode a loss stream into results[index] while copying it on to the
+    next process in a pipeline.
+    """
+    try:
+        results[index] = ktools_io.read_loss_stream(
+            input_stream, sidx=sidx, tee=output_stream, decimals=LOSS_DECIMALS)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        # Closing both ends lets the processes either side see the pipe close
+        input_stream.close()
+        try:
+            output_stream.close()
+        except BrokenPipeError:
+            # The next process has already stopped, and reports its error
+            pass
+
+def run_fmcalc_chain(
+        fm_input_dirs,
+        input_file=None,
+        write_input=None,
+        output_file=None,
+        nets=None,
+        allocation=ALLOCATE_TO_ITEMS_BY_PREVIOUS_LEVEL_ALLOC_ID,
+        sidx=1,
+        taps=(),
+        session=None):
+    """
+    Run a pipeline of fmcalc processes, one for the structures in each of
+    fm_input_dirs, each reading the output stream of the one before. The
+    input of the first process is given as for run_fmcalc, and the net flag
+    of each process is given by nets, by default False.
+    The losses of the last process are always decoded, and the losses of
+    the earlier processes only if their index is in taps. The streams of
+    untapped processes go straight from one process to the next, so
+    nothing is written to disk and all the processes run at once.
+    Returns a list with the losses of each process, or None if untapped.
+    """
+    session = get_session(session)
+    with session.span("fmcalc", layers=list(fm_input_dirs)):
+        return _run_fmcalc_chain(
+            fm_input_dirs, input_file, write_input, output_file, nets,
+            allocation, sidx, taps, session)
+
+def _run_fmcalc_chain(
+        fm_input_dirs, input_file, write_input, output_file, nets,
+        allocation, sidx, taps, session):
+    if nets is None:
+        nets = [False] * len(fm_input_dirs)
+    last = len(fm_input_dirs) - 1
+
+    procs = []
+    tapped_procs = []
+    threads = []
+    writer = None
+    errors = []
+    results = [None] * len(fm_input_dirs)
+    try:
+        for (index, (fm_input_dir, net)) in enumerate(zip(fm_input_dirs, nets)):
+            command = [
+                session.get_ktools_path("fmcalc"), "-p", session.get_path(fm_input_dir),
+                "-a", str(allocation)]
+            if net:
+                command.append("-n")
+            stdin = subprocess.PIPE
+            if index == 0 and input_file is not None:
+                stdin = input_file
+            elif index > 0 and index - 1 not in taps:
+                stdin = procs[-1].stdout
+            proc = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE)
+            if index > 0 and index - 1 in taps:
+                threads.append(threading.Thread(
+                    target=_tap_loss_stream,
+                    args=(procs[-1].stdout, proc.stdin, sidx, results, index - 1, errors)))
+                threads[-1].start()
+                tapped_procs.append(procs[-1])
+            elif index > 0:
+                # The process now holds the only copy of the pipe
+                procs[-1].stdout.close()
+            procs.append(proc)
+
+        if write_input is not None:
+            def _write_input():
+                try:
+                    write_input(procs[0].stdin)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    procs[0].stdin.close()
+            writer = threading.Thread(target=_write_input)
+            writer.start()
+            threads.append(writer)
+
+        try:
+            results[last] = ktools_io.read_loss_stream(
+                procs[-1].stdout, sidx=sidx, tee=output_file, decimals=LOSS_DECIMALS)
+        except Exception as e:
+            # A failed process truncates the stream, so its return code is
+            # checked before the decode error is raised
+            errors.append(e)
+    finally:
+        # On failure, closing the pipes held here makes every process and
+        # thread in the pipeline see its input or output close, and stop
+        if writer is None and procs and procs[0].stdin is not None:
+            procs[0].stdin.close()
+        for proc in procs:
+            if proc not in tapped_procs:
+                proc.stdout.close()
+        for thread in threads:
+            thread.join()
+        for proc in procs:
+            proc.wait()
+    # Processes stopped by closing their output on an error here were
+    # killed by SIGPIPE, and the first other failure in the pipeline is
+    # the one that caused the rest
+    failures = [
+        (fm_input_dir, proc.returncode)
+        for (fm_input_dir, proc) in zip(fm_input_dirs, procs)
+        if proc.returncode != 0 and proc.returncode != -signal.SIGPIPE]
+    if failures:
+        raise Exception(
+            "Failed to run fm: fmcalc on {} exited with return code {}".format(
+                *failures[0]))
+    if errors:
+        raise errors[0]
+    if any(proc.returncode != 0 for proc in procs):
+        raise Exception("Failed to run fm")
+    return results
+
+def run_fmcalc_partitions(
+        fm_input_dirs,
+        write_inputs,
+        output_file=None,
+        nets=None,
+        allocation=ALLOCATE_TO_ITEMS_BY_PREVIOUS_LEVEL_ALLOC_ID,
+        sidx=1,
+        taps=(),
+        session=None):
+    """
+    Run a separate fmcalc pipeline, as run_fmcalc_chain, for each partition
+    of the events. The input stream of each partition is written by the
+    matching function in write_inputs, and holds a contiguous range of the
+    events. The partitions are run at once, each pipeline counting as one
+    process per layer towards the session's max_processes, though one
+    pipeline always runs. The output streams of the partitions are written
+    to temporary files in the session's workspace, and their losses and
+    output streams are joined in partition order, so they are the same as
+    those of a single pipeline on all the events.
+    """
+    session = get_session(session)
+    if len(write_inputs) == 1:
+        return run_fmcalc_chain(
+            fm_input_dirs, write_input=write_inputs[0], output_file=output_file,
+            nets=nets, allocation=allocation, sidx=sidx, taps=taps,
+            session=session)
+
+    output_streams = [None] * len(write_inputs)
+    try:
+        if output_file is not None:
+            output_streams = [
+                tempfile.TemporaryFile(dir=session.workspace) for _ in write_inputs]
+        with ThreadPoolExecutor(max_workers=max(1, min(
+                len(write_inputs),
+                session.max_processes // len(fm_input_dirs)))) as executor:
+            partition_losses = list(executor.map(
+                lambda partition: run_fmcalc_chain(
+                    fm_input_dirs, write_input=partition[0], output_file=partition[1],
+                    nets=nets, allocation=allocation, sidx=sidx, taps=taps,
+                    session=session),
+                zip(write_inputs, output_streams)))
+
+        if output_file is not None:
+            header_size = ktools_io.LOSS_STREAM_HEADER_DTYPE.itemsize
+            output_streams[0].seek(0)
+            output_file.write(output_streams[0].read(header_size))
+            for output_stream in output_streams:
+                output_stream.seek(header_size)
+                shutil.copyfileobj(output_stream, output_file)
+    finally:
+        for output_stream in output_streams:
+            if output_stream is not None:
+                output_stream.close()
+
+    return [
+        None if layer_losses[0] is None
+        else pd.concat(layer_losses, ignore_index=True)
+        for layer_losses in zip(*partition_losses)]
+
 def run_fm(
     input_name,
     output_name,
     xref_descriptions,
-    allocation=ALLOCATE_TO_ITEMS_BY_PREVIOUS_LEVEL_ALLOC_ID):
-    command = \
-        "../ktools/fmcalc -p {0} -n -a {2} < {1}.bin | tee {0}.bin | ../ktools/fmtocsv > {0}.csv".format(
-            output_name, input_name, allocation)
-    proc = subprocess.Popen(command, shell=True)
-    #print(command)
-    proc.wait()
-    if proc.returncode != 0:
-        raise Exception("Failed to run fm")
-    losses_df = pd.read_csv("{}.csv".format(output_name))
-    inputs_df = pd.read_csv("{}.csv".format(input_name))
-
-    losses_df.drop(losses_df[losses_df.sidx != 1].index, inplace=True)
-    inputs_df.drop(inputs_df[inputs_df.sidx != 1].index, inplace=True)
-    losses_df = pd.merge(
-        inputs_df,
-        losses_df, left_on='output_id', right_on='output_id',
-        suffixes=('_pre', '_net'))
+    allocation=ALLOCATE_TO_ITEMS_BY_PREVIOUS_LEVEL_ALLOC_ID,
+    sample_size=None,
+    session=None):
+    """
+    Run the losses of the previous layer, input_name, through the structures
+    in output_name. By default only the first sample of the single event is
+    used. If sample_size is set, samples 1 to sample_size of every event are
+    used and the losses are returned with their event_id and sidx.
+    If the session has more than one partition, the events of the input
+    losses are split between that many fmcalc processes. The input is
+    memory mapped rather than read, and each partition's part of it is
+    streamed to its process.
+    """
+    session = get_session(session)
+    sidx = 1
+    if sample_size is not None:
+        sidx = list(range(1, sample_size + 1))
+    input_path = session.get_path("{}.bin".format(input_name))
+    with open(input_path, "rb") as input_file, \
+            open(session.get_path("{}.bin".format(output_name)), "wb") as output_file:
+        if session.partitions > 1:
+            with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as input_data:
+                losses_df = run_fmcalc_partitions(
+                    [output_name],
+                    [lambda stream, bounds=bounds: ktools_io.write_loss_stream_partition(
+                        stream, input_data, *bounds)
+                     for bounds in ktools_io.get_loss_stream_partitions(
+                         input_data, session.partitions)],
+                    output_file=output_file, nets=[True], allocation=allocation,
+                    sidx=sidx, session=session)[-1]
+        else:
+            losses_df = run_fmcalc(
+                output_name, input_file=input_file, output_file=output_file,
+                net=True, allocation=allocation, sidx=sidx, session=session)
+    with session.span("merge", layer=output_name):
+        inputs_df = ktools_io.read_loss_file(
+            input_path, sidx=sidx, decimals=LOSS_DECIMALS)
+        return merge_net_losses(inputs_df, losses_df, xref_descriptions, sample_size)
+
+def merge_net_losses(inputs_df, losses_df, xref_descriptions, sample_size=None):
+    """
+    Join the input and net losses of a reinsurance layer, as decoded from
+    the loss streams, to the descriptions of their items.
+    """
+    if sample_size is None:
+        losses_df = pd.merge(
+            inputs_df,
+            losses_df, on=['event_id', 'output_id', 'sidx'],
+            suffixes=('_pre', '_net'))
+    else:
+        # fmcalc does not output zero losses
+        losses_df = pd.merge(
+            inputs_df,
+            losses_df, how='left', on=['event_id', 'output_id', 'sidx'],
+            suffixes=('_pre', '_net'))
+        losses_df['loss_net'] = losses_df['loss_net'].fillna(0.0)
 
     losses_df = pd.merge(
         xref_descriptions,
         losses_df, left_on='xref_id', right_on='output_id')
 
-    del losses_df['event_id_pre']
-    del losses_df['sidx_pre']
-    del losses_df['event_id_net']
-    del losses_df['sidx_net']
+    if sample_size is None:
+        del losses_df['event_id']
+        del losses_df['sidx']
+    else:
+        losses_df.sort_values(by='event_id', kind='mergesort', inplace=True)
+        losses_df.reset_index(drop=True, inplace=True)
     del losses_df['output_id']
     del losses_df['xref_id']
     return losses_df
@@ -1,8 +1,11 @@
+import numpy as np
 import pandas as pd
 import os
-import subprocess
 import shutil
 import common
+import ktools_io
+import numpy_fm
+from collections import OrderedDict
 
 
 class DirectLayer(object):
@@ -27,208 +30,480 @@ class DirectLayer(object):
         self.fm_xrefs = pd.DataFrame()
         self.xref_descriptions = pd.DataFrame()
 
-        self.item_id_dict = dict()
+    def generate_oasis_structures(self):
+        """
+        Create the Oasis structures for the direct policies.
 
-    def _get_location_tiv(self, location, coverage_type_id):
-        switcher = {
-            common.BUILDING_COVERAGE_TYPE_ID: location.BuildingTIV,
-            common.OTHER_BUILDING_COVERAGE_TYPE_ID: location.OtherTIV,
-            common.CONTENTS_COVERAGE_TYPE_ID: location.ContentsTIV,
-            common.TIME_COVERAGE_TYPE_ID: location.BITIV
-        }
-        return switcher.get(coverage_type_id, 0)
+        Each account row is a policy that covers every location with the same
+        AccountNumber. The structures are built column-wise: policies are joined
+        to locations to give one site per (policy, location) pair, the TIV columns
+        are melted into coverages (keeping TIV > 0), and IDs are assigned by
+        position. The numbering is the same as looping over policies, then
+        their locations, then coverage types and perils.
+        """
 
-    def generate_oasis_structures(self):
+        accounts = self.accounts.reset_index(drop=True)
+        policy_agg_ids = np.arange(1, len(accounts.index) + 1)
+        sites = self._get_sites()
+        site_agg_ids = np.arange(1, len(sites.index) + 1)
+        site_policy_agg_ids = sites.policy_agg_id.values
+
+        # Each policy profile is followed by the profiles of its sites
+        sites_per_policy = np.bincount(
+            site_policy_agg_ids, minlength=len(policy_agg_ids) + 1)[1:]
+        policy_profile_ids = \
+            policy_agg_ids + np.cumsum(sites_per_policy) - sites_per_policy
+        site_profile_ids = site_policy_agg_ids + site_agg_ids
+
+        # One coverage per site and coverage type with a positive TIV
+        site_tivs = sites[list(common.COVERAGE_TYPE_TIV_FIELDS.values())].values
+        (coverage_site_indexes, coverage_type_indexes) = np.nonzero(site_tivs > 0)
+        coverage_tivs = site_tivs[coverage_site_indexes, coverage_type_indexes]
+        coverage_type_ids = np.array(
+            list(common.COVERAGE_TYPE_TIV_FIELDS.keys()))[coverage_type_indexes]
+        coverage_ids = np.arange(1, len(coverage_tivs) + 1)
+
+        # One item per coverage and peril
+        item_coverage_indexes = np.repeat(
+            np.arange(len(coverage_ids)), len(common.PERILS))
+        item_ids = np.arange(1, len(item_coverage_indexes) + 1)
+        item_site_indexes = coverage_site_indexes[item_coverage_indexes]
+        item_tivs = coverage_tivs[item_coverage_indexes]
+
+        # fm_programme lists each site followed by its items
+        items_per_site = np.bincount(
+            item_site_indexes, minlength=len(site_agg_ids))
+        site_programme_rows = \
+            np.arange(len(site_agg_ids)) + np.cumsum(items_per_site) - items_per_site
+        item_programme_rows = item_site_indexes + item_ids
+        programme_size = len(site_agg_ids) + len(item_ids)
+        from_agg_ids = np.empty(programme_size, dtype=np.int64)
+        level_ids = np.empty(programme_size, dtype=np.int64)
+        to_agg_ids = np.empty(programme_size, dtype=np.int64)
+        from_agg_ids[site_programme_rows] = site_agg_ids
+        level_ids[site_programme_rows] = 2
+        to_agg_ids[site_programme_rows] = site_policy_agg_ids
+        from_agg_ids[item_programme_rows] = item_ids
+        level_ids[item_programme_rows] = 1
+        to_agg_ids[item_programme_rows] = site_agg_ids[item_site_indexes]
+
+        self.item_ids = item_ids
+        self.item_tivs = item_tivs
+        self.coverages = pd.DataFrame({
+            'coverage_id': coverage_ids,
+            'tiv': coverage_tivs
+        }, columns=common.Coverage._fields)
+        self.items = pd.DataFrame({
+            'item_id': item_ids,
+            'coverage_id': coverage_ids[item_coverage_indexes],
+            'areaperil_id': -1,
+            'vulnerability_id': -1,
+            'group_id': site_agg_ids[item_site_indexes]
+        }, columns=common.Item._fields)
+        self.fmprogrammes = pd.DataFrame({
+            'from_agg_id': from_agg_ids,
+            'level_id': level_ids,
+            'to_agg_id': to_agg_ids
+        }, columns=common.FmProgramme._fields)
+        self.fmprofiles = pd.concat([
+            common.get_profiles(
+                policy_profile_ids, accounts.Ded6.values, accounts.Limit6.values),
+            common.get_profiles(
+                site_profile_ids, sites.Ded6.values, sites.Limit6.values)
+        ]).sort_values(by='profile_id', kind='mergesort').reset_index(drop=True)
+        self.fm_policytcs = pd.DataFrame({
+            'layer_id': 1,
+            'level_id': np.concatenate([
+                np.full(len(policy_agg_ids), 2), np.full(len(site_agg_ids), 1)]),
+            'agg_id': np.concatenate([policy_agg_ids, site_agg_ids]),
+            'profile_id': np.concatenate([policy_profile_ids, site_profile_ids])
+        }, columns=common.FmPolicyTc._fields
+        ).sort_values(by='profile_id', kind='mergesort').reset_index(drop=True)
+        self.fm_xrefs = pd.DataFrame({
+            'output_id': item_ids,
+            'agg_id': item_ids,
+            'layer_id': 1
+        }, columns=common.FmXref._fields)
+        self.xref_descriptions = pd.DataFrame({
+            'xref_id': item_ids,
+            'policy_number': sites.policy_number.values[item_site_indexes],
+            'account_number': sites.AccountNumber.values[item_site_indexes],
+            'location_number': sites.LocationNumber.values[item_site_indexes],
+            'coverage_type_id': coverage_type_ids[item_coverage_indexes],
+            'peril_id': np.tile(common.PERILS, len(coverage_ids)),
+            'tiv': item_tivs
+        }, columns=common.XrefDescription._fields)
+
+    def _get_sites(self):
+        """
+        Return the sites, one per (policy, location) pair, in policy then
+        location order, with the policy_agg_id and policy_number of each.
+        There is one policy per account row.
+        """
+        accounts = self.accounts.reset_index(drop=True)
+        locations = self.locations.reset_index(drop=True)
+        sites = pd.merge(
+            pd.DataFrame({
+                'policy_agg_id': np.arange(1, len(accounts.index) + 1),
+                'AccountNumber': accounts.AccountNumber.values,
+                'policy_number': accounts.PolicyNumber.values}),
+            locations.assign(location_index=np.arange(len(locations.index))),
+            on='AccountNumber')
+        sites.sort_values(
+            by=['policy_agg_id', 'location_index'], kind='mergesort', inplace=True)
+        sites.reset_index(drop=True, inplace=True)
+        return sites
+
+    def get_structure_counts(self):
+        """
+        Count the rows of the structures that generate_oasis_structures
+        creates, without creating them, as they follow from the sites and
+        their coverages. Returns an OrderedDict of the counts, and a
+        DataFrame of the account, policy and location numbers and the item
+        count of each site with items, from which the structures of the
+        reinsurance layers are counted.
+        """
+        sites = self._get_sites()
+        coverages_per_site = (
+            sites[list(common.COVERAGE_TYPE_TIV_FIELDS.values())].values > 0).sum(axis=1)
+        items_per_site = coverages_per_site * len(common.PERILS)
+        policy_count = len(self.accounts.index)
+        site_count = len(sites.index)
+        item_count = int(items_per_site.sum())
+
+        counts = OrderedDict([
+            ('items', item_count),
+            ('coverages', int(coverages_per_site.sum())),
+            ('nodes', policy_count + site_count + item_count),
+            ('programmes', site_count + item_count),
+            ('profiles', policy_count + site_count),
+            ('policytcs', policy_count + site_count),
+            ('layers', 1)])
+        has_items = items_per_site > 0
+        site_items = pd.DataFrame({
+            'account_number': sites.AccountNumber.values[has_items],
+            'policy_number': sites.policy_number.values[has_items],
+            'location_number': sites.LocationNumber.values[has_items],
+            'item_count': items_per_site[has_items]})
+        return (counts, site_items)
 
-        coverage_id = 0
-        item_id = 0
-        group_id = 0
-        policy_agg_id = 0
-        profile_id = 0
-
-        coverages_list = list()
-        items_list = list()
-        fmprogrammes_list = list()
-        fmprofiles_list = list()
-        fm_policytcs_list = list()
-        fm_xrefs_list = list()
-        xref_descriptions_list = list()
-
-        site_agg_id = 0
-        for policy_index, policy in self.accounts.iterrows():
-            policy_agg_id = policy_agg_id + 1
-            profile_id = profile_id + 1
-            fmprofiles_list.append(
-                common.get_profile(
-                    profile_id,
-                    deductible=policy.Ded6,
-                    limit=policy.Limit6))
-            fm_policytcs_list.append(common.FmPolicyTc(
-                layer_id=1,
-                level_id=2,
-                agg_id=policy_agg_id,
-                profile_id=profile_id
-            ))
-            for location_index, location in self.locations.loc[self.locations["AccountNumber"] == policy.AccountNumber].iterrows():
-                group_id = group_id + 1
-                site_agg_id = site_agg_id + 1
-                profile_id = profile_id + 1
-
-                fmprofiles_list.append(
-                    common.get_profile(
-                        profile_id=profile_id,
-                        deductible=location.Ded6,
-                        limit=location.Limit6))
-                fm_policytcs_list.append(common.FmPolicyTc(
-                    layer_id=1,
-                    level_id=1,
-                    agg_id=site_agg_id,
-                    profile_id=profile_id
-                ))
-                fmprogrammes_list.append(
-                    common.FmProgramme(
-                        from_agg_id=site_agg_id,
-                        level_id=2,
-                        to_agg_id=policy_agg_id
-                    )
-                )
-
-                for coverage_type_id in common.COVERAGE_TYPES:
-                    tiv = self._get_location_tiv(location, coverage_type_id)
-                    if tiv > 0:
-                        coverage_id = coverage_id + 1
-                        self.item_id_dict[coverage_id] = location
-
-                        coverages_list.append(
-                            common.Coverage(
-                                coverage_id=coverage_id,
-                                tiv=tiv,
-                            ))
-                        for peril in common.PERILS:
-                            item_id = item_id + 1
-                            self.item_ids.append(item_id)
-                            self.item_tivs.append(tiv)
-                            items_list.append(
-                                common.Item(
-                                    item_id=item_id,
-                                    coverage_id=coverage_id,
-                                    areaperil_id=-1,
-                                    vulnerability_id=-1,
-                                    group_id=group_id
-                                ))
-                            fmprogrammes_list.append(
-                                common.FmProgramme(
-                                    from_agg_id=item_id,
-                                    level_id=1,
-                                    to_agg_id=site_agg_id
-                                )
-                            )
-                            fm_xrefs_list.append(
-                                common.FmXref(
-                                    output_id=item_id,
-                                    agg_id=item_id,
-                                    layer_id=1
-                                ))
-                            xref_descriptions_list.append(
-                                common.XrefDescription(
-                                    xref_id=item_id,
-                                    account_number=location.AccountNumber,
-                                    location_number=location.LocationNumber,
-                                    coverage_type_id=coverage_type_id,
-                                    peril_id=peril,
-                                    policy_number=policy.PolicyNumber,
-                                    tiv=tiv
-                                )
-                            )
-
-        self.coverages = pd.DataFrame(coverages_list)
-        self.items = pd.DataFrame(items_list)
-        self.fmprogrammes = pd.DataFrame(fmprogrammes_list)
-        self.fmprofiles = pd.DataFrame(fmprofiles_list)
-        self.fm_policytcs = pd.DataFrame(fm_policytcs_list)
-        self.fm_xrefs = pd.DataFrame(fm_xrefs_list)
-        self.xref_descriptions = pd.DataFrame(xref_descriptions_list)
-
-    def write_oasis_files(self):
-
-        self.coverages.to_csv("coverages.csv", index=False)
-        self.items.to_csv("items.csv", index=False)
-        self.fmprogrammes.to_csv("fm_programme.csv", index=False)
-        self.fmprofiles.to_csv("fm_profile.csv", index=False)
-        self.fm_policytcs.to_csv("fm_policytc.csv", index=False)
-        self.fm_xrefs.to_csv("fm_xref.csv", index=False)
-
-        directory = "direct"
+    def set_xref_descriptions(self, xref_descriptions):
+        """
+        Set the items from the xref descriptions of a previous run, for when
+        the ktools binaries are taken from a structure cache rather than
+        generated. Only the losses can then be calculated, using fmcalc.
+        """
+        self.xref_descriptions = xref_descriptions
+        self.item_ids = xref_descriptions.xref_id.values
+        self.item_tivs = xref_descriptions.tiv.values
+
+    def write_oasis_files(self, debug=False, use_conversion_tools=False, session=None):
+        """
+        Write out the Oasis structures as ktools binaries in the "direct"
+        directory of the session's workspace.
+        CSV copies are only written when debugging, or when the binaries are
+        created using the ktools conversion tools rather than the native writer.
+        """
+        session = common.get_session(session)
+
+        input_dfs = OrderedDict([
+            ('coverages', self.coverages),
+            ('items', self.items),
+            ('fm_programme', self.fmprogrammes),
+            ('fm_profile', self.fmprofiles),
+            ('fm_policytc', self.fm_policytcs),
+            ('fm_xref', self.fm_xrefs)])
+
+        directory = session.get_path("direct")
         if os.path.exists(directory):
             shutil.rmtree(directory)
         os.mkdir(directory)
-        input_files = common.GUL_INPUTS_FILES + common.IL_INPUTS_FILES
-
-        for input_file in input_files:
-            conversion_tool = common.CONVERSION_TOOLS[input_file]
-            input_file_path = input_file + ".csv"
-            if not os.path.exists(input_file_path):
-                continue
 
-            output_file_path = os.path.join(directory, input_file + ".bin")
-            command = "{} < {} > {}".format(
-                conversion_tool, input_file_path, output_file_path)
-            proc = subprocess.Popen(command, shell=True)
-            proc.wait()
-            if proc.returncode != 0:
-                raise Exception(
-                    "Failed to convert {}: {}".format(input_file_path, command))
+        if debug or use_conversion_tools:
+            with session.span("write_csv", layer="direct"):
+                for (input_file, df) in input_dfs.items():
+                    df.to_csv(session.get_path(input_file + ".csv"), index=False)
 
+        if use_conversion_tools:
+            common.run_conversion_tools(
+                input_dfs.keys(), ".", directory, session=session)
+        else:
+            with session.span("write_bin", layer="direct"):
+                ktools_io.write_input_files(directory, input_dfs)
 
     def report_item_ids(self):
         """
         return a dataframe showing the relationship between item_id's and Locations
         """
-        locations_list  = [self.item_id_dict[ID].LocationNumber for ID in self.item_ids] 
         from_agg_ids = self.fmprogrammes[self.fmprogrammes['level_id'] == 1].from_agg_id.tolist()
         item_map_df = pd.concat([
             self.items[['item_id','coverage_id']],
             self.coverages['tiv'],
-            pd.DataFrame({'LocationNumber': locations_list})
+            self.xref_descriptions['location_number'].rename('LocationNumber')
         ],axis=1)  
         # filter 'item_id' that exisit in 'from_agg_id'
         return item_map_df[item_map_df['item_id'].isin(from_agg_ids)]
 
-    def apply_fm(self, loss_percentage_of_tiv=1.0, net=False):
-        guls_list = list()
-        for item_id, tiv in zip(self.item_ids, self.item_tivs):
-            event_loss = loss_percentage_of_tiv * tiv
-            guls_list.append(
-                common.GulRecord(event_id=1, item_id=item_id, sidx=-1, loss=event_loss))
-            guls_list.append(
-                common.GulRecord(event_id=1, item_id=item_id, sidx=-2, loss=0))
-            guls_list.append(
-                common.GulRecord(event_id=1, item_id=item_id, sidx=1, loss=event_loss))
-        guls_df = pd.DataFrame(guls_list)
-        guls_df.to_csv("guls.csv", index=False)
-        net_flag = ""
-        if net:
-            net_flag = "-n"
-        command = "../ktools/gultobin -S 1 < guls.csv | ../ktools/fmcalc -p direct {} -a {} | tee ils.bin | ../ktools/fmtocsv > ils.csv".format(
-            net_flag, common.ALLOCATE_TO_ITEMS_BY_PREVIOUS_LEVEL_ALLOC_ID)
-        proc = subprocess.Popen(command, shell=True)
-        proc.wait()
-        if proc.returncode != 0:
-            raise Exception("Failed to run fm")
-        losses_df = pd.read_csv("ils.csv")
-        losses_df.drop(losses_df[losses_df.sidx != 1].index, inplace=True)
-        del losses_df['sidx']
-        guls_df.drop(guls_df[guls_df.sidx != 1].index, inplace=True)
-        del guls_df['event_id']
-        del guls_df['sidx']
+    def get_event_loss_set(self, loss_percentage_of_tiv=1.0):
+        """
+        Return an event loss set with one sample of loss_percentage_of_tiv
+        of the TIV on every item. If loss_percentage_of_tiv is a list, there
+        is an event for each value, with event_id 1 for the first value,
+        event_id 2 for the second and so on.
+        """
+        loss_percentages_of_tiv = np.atleast_1d(loss_percentage_of_tiv)
+        item_ids = np.asarray(self.item_ids)
+        return pd.DataFrame({
+            'event_id': np.repeat(
+                np.arange(1, len(loss_percentages_of_tiv) + 1), len(item_ids)),
+            'item_id': np.tile(item_ids, len(loss_percentages_of_tiv)),
+            'sidx': 1,
+            'damage_ratio': np.repeat(loss_percentages_of_tiv, len(item_ids))
+        }, columns=['event_id', 'item_id', 'sidx', 'damage_ratio'])
+
+    def _write_event_losses(self, stream, event_loss_set, sample_size):
+        """
+        Write the ground up loss stream for an event loss set.
+        fmcalc expects every item in each event, so items and samples that
+        are not in the event loss set are given a zero loss.
+        """
+        item_ids = np.asarray(self.item_ids)
+        item_tivs = np.asarray(self.item_tivs)
+        ktools_io.write_loss_stream_header(
+            stream, ktools_io.GUL_ITEM_STREAM_TYPE, sample_size)
+
+        event_ids = event_loss_set.event_id.values
+        (unique_event_ids, event_starts) = np.unique(event_ids, return_index=True)
+        event_ends = np.append(event_starts[1:], len(event_ids))
+        for (event_id, start, end) in zip(unique_event_ids, event_starts, event_ends):
+            event_item_indexes = event_loss_set.item_id.values[start:end] - 1
+            samples = np.zeros((len(item_ids), sample_size))
+            samples[event_item_indexes, event_loss_set.sidx.values[start:end] - 1] = \
+                event_loss_set.damage_ratio.values[start:end] * item_tivs[event_item_indexes]
+            ktools_io.write_gul_records(
+                stream, np.full(len(item_ids), event_id), item_ids, samples)
+
+    def get_event_loss_matrix(self, event_loss_set, sample_size):
+        """
+        Return the ground up losses of an event loss set as a LossMatrix, with
+        a row for every item and a column for every event and sample. Items
+        and samples that are not in the event loss set have a zero loss.
+        """
+        item_ids = np.asarray(self.item_ids)
+        item_tivs = np.asarray(self.item_tivs)
+        (event_ids, event_indexes) = np.unique(
+            event_loss_set.event_id.values, return_inverse=True)
+        item_indexes = event_loss_set.item_id.values - 1
+        losses = np.zeros((len(item_ids), len(event_ids) * sample_size))
+        losses[item_indexes, event_indexes * sample_size + event_loss_set.sidx.values - 1] = \
+            event_loss_set.damage_ratio.values * item_tivs[item_indexes]
+        return numpy_fm.LossMatrix(
+            output_ids=item_ids,
+            event_ids=np.repeat(event_ids, sample_size),
+            sidxs=np.tile(np.arange(1, sample_size + 1), len(event_ids)),
+            losses=losses.astype(np.float32))
+
+    def apply_fm(
+            self, loss_percentage_of_tiv=1.0, net=False, event_loss_set=None,
+            fm_engine=common.FM_ENGINE_KTOOLS, loss_matrices=None, session=None):
+        """
+        Run ground up losses through the direct layer. The losses are
+        streamed straight into fmcalc.
+
+        By default a single event is run, with a loss of loss_percentage_of_tiv
+        of the TIV on every item, and the losses are returned by item.
+
+        Alternatively, event_loss_set gives the damage ratios, as a proportion
+        of TIV, of many events and samples, with columns event_id, item_id,
+        sidx and damage_ratio, where sidx runs from 1 to the number of samples.
+        All events are run through a single fmcalc invocation, or one per
+        partition of the events if the session has more than one partition,
+        and the losses are returned by event_id, item and sidx.
+
+        If fm_engine is common.FM_ENGINE_NUMPY, the losses are calculated in
+        memory by numpy_fm instead, and added to loss_matrices as 'ils'.
+        Otherwise the structures are read from, and the losses written to,
+        the session's workspace.
+        """
+        session = common.get_session(session)
+        keep_event_ids = event_loss_set is not None
+        (event_loss_set, sample_size) = self._get_sorted_event_loss_set(
+            loss_percentage_of_tiv, event_loss_set)
+
+        if fm_engine == common.FM_ENGINE_NUMPY:
+            with session.span("numpy_fm", layer="direct"):
+                output_losses = numpy_fm.calculate(
+                    self, self.get_event_loss_matrix(event_loss_set, sample_size),
+                    net=net)
+            if loss_matrices is not None:
+                loss_matrices['ils'] = output_losses
+            losses_df = numpy_fm.to_loss_df(output_losses)
+        else:
+            with open(session.get_path("ils.bin"), "wb") as output_file:
+                losses_df = common.run_fmcalc_partitions(
+                    ["direct"],
+                    self._get_partition_writers(
+                        event_loss_set, sample_size, session.partitions),
+                    output_file=output_file,
+                    nets=[net],
+                    sidx=list(range(1, sample_size + 1)),
+                    session=session)[-1]
+
+        with session.span("merge", layer="direct"):
+            return self._merge_gul_losses(event_loss_set, losses_df, keep_event_ids)
+
+    def apply_fm_chain(
+            self, layer_names, loss_percentage_of_tiv=1.0, net=False,
+            event_loss_set=None, taps=None, session=None):
+        """
+        Run ground up losses through the direct layer and then through the
+        net of each reinsurance layer in layer_names, as one pipeline of
+        fmcalc processes. No loss streams are written to the workspace.
+
+        The event losses are as for apply_fm. taps is the names of the
+        layers, including 'direct', whose losses are returned, by default
+        all of them. The losses of the last layer are always returned.
+        Returns an OrderedDict of losses by layer name, as returned by
+        apply_fm for the direct layer and by common.run_fm for the others.
+        """
+        keep_event_ids = event_loss_set is not None
+        (event_loss_set, sample_size) = self._get_sorted_event_loss_set(
+            loss_percentage_of_tiv, event_loss_set)
+
+        names = ["direct"] + list(layer_names)
+        if taps is None:
+            taps = names
+        taps = set(taps) | {names[-1]}
+        # The input losses of a layer are needed to return its net losses
+        tap_indexes = set()
+        for (index, name) in enumerate(names):
+            if name in taps:
+                tap_indexes.add(index)
+                if index > 0:
+                    tap_indexes.add(index - 1)
+
+        session = common.get_session(session)
+        layer_losses = common.run_fmcalc_partitions(
+            names,
+            self._get_partition_writers(
+                event_loss_set, sample_size, session.partitions),
+            nets=[net] + [True] * len(layer_names),
+            sidx=list(range(1, sample_size + 1)),
+            taps=tap_indexes,
+            session=session)
+
+        losses = OrderedDict()
+        for (index, name) in enumerate(names):
+            if name not in taps:
+                continue
+            with session.span("merge", layer=name):
+                if index == 0:
+                    losses[name] = self._merge_gul_losses(
+                        event_loss_set, layer_losses[0], keep_event_ids)
+                else:
+                    losses[name] = common.merge_net_losses(
+                        layer_losses[index - 1], layer_losses[index],
+                        self.xref_descriptions,
+                        sample_size if keep_event_ids else None)
+        return losses
+
+    def _get_sorted_event_loss_set(self, loss_percentage_of_tiv, event_loss_set):
+        """
+        Return the event loss set, by default a single event with a loss of
+        loss_percentage_of_tiv on every item, sorted as fmcalc expects,
+        and its sample size.
+        """
+        if event_loss_set is None:
+            event_loss_set = self.get_event_loss_set(loss_percentage_of_tiv)
+        self._validate_event_loss_set(event_loss_set)
+        event_loss_set = event_loss_set.sort_values(
+            by=['event_id', 'item_id', 'sidx'], kind='mergesort')
+        return (event_loss_set, int(event_loss_set.sidx.max()))
+
+    def _validate_event_loss_set(self, event_loss_set):
+        """
+        Check that the rows of an event loss set can be placed in the loss
+        stream: item IDs of the direct layer, event IDs and sample indexes
+        from 1, finite damage ratios of at least 0, and at most one row per
+        event, item and sample.
+        """
+        if len(event_loss_set.index) == 0:
+            raise Exception("Invalid event loss set, empty event loss set")
+        item_count = len(self.item_ids)
+        damage_ratios = pd.to_numeric(
+            event_loss_set.damage_ratio, errors='coerce').values.astype(np.float64)
+        checks = [
+            ('event_id', event_loss_set.event_id.values < 1, "event_id below 1"),
+            ('item_id',
+             (event_loss_set.item_id.values < 1) |
+             (event_loss_set.item_id.values > item_count),
+             "item_id outside 1 to {}".format(item_count)),
+            ('sidx', event_loss_set.sidx.values < 1, "sidx below 1"),
+            ('damage_ratio',
+             ~(np.isfinite(damage_ratios) & (damage_ratios >= 0)),
+             "damage_ratio not a finite number of at least 0"),
+            ('sidx',
+             event_loss_set.duplicated(subset=['event_id', 'item_id', 'sidx']).values,
+             "duplicate event_id, item_id and sidx")]
+        for (column, is_invalid, description) in checks:
+            if is_invalid.any():
+                raise Exception("Invalid event loss set, {} in {} rows, e.g. {}".format(
+                    description, int(is_invalid.sum()),
+                    event_loss_set[is_invalid].iloc[0][
+                        ['event_id', 'item_id', 'sidx', 'damage_ratio']].to_dict()))
+
+    def _get_partition_writers(self, event_loss_set, sample_size, partition_count):
+        """
+        Split a sorted event loss set into at most partition_count contiguous
+        ranges of events, and return a function to write the ground up loss
+        stream of each range.
+        """
+        (event_ids, event_starts) = np.unique(
+            event_loss_set.event_id.values, return_index=True)
+        groups = np.array_split(
+            np.arange(len(event_ids)), max(1, min(partition_count, len(event_ids))))
+        bounds = [event_starts[group[0]] for group in groups] + [len(event_loss_set.index)]
+        return [
+            lambda stream, start=start, end=end: self._write_event_losses(
+                stream, event_loss_set.iloc[start:end], sample_size)
+            for (start, end) in zip(bounds[:-1], bounds[1:])]
+
+    def _merge_gul_losses(self, event_loss_set, losses_df, keep_event_ids):
+        """
+        Join the insured losses of the direct layer to the ground up losses
+        and descriptions of their items.
+        """
+        item_tivs = np.asarray(self.item_tivs)
+        guls_df = pd.DataFrame({
+            'event_id': event_loss_set.event_id.values,
+            'item_id': event_loss_set.item_id.values,
+            'sidx': event_loss_set.sidx.values,
+            'loss': event_loss_set.damage_ratio.values *
+                    item_tivs[event_loss_set.item_id.values - 1]})
         guls_df = pd.merge(
             self.xref_descriptions,
             guls_df, left_on=['xref_id'], right_on=['item_id'])
-        losses_df = pd.merge(
-            guls_df,
-            losses_df, left_on='xref_id', right_on='output_id',
-            suffixes=["_gul", "_il"])
-        del losses_df['event_id']
+
+        if keep_event_ids:
+            # fmcalc does not output zero losses
+            losses_df = pd.merge(
+                guls_df[guls_df.loss > 0],
+                losses_df, how='left',
+                left_on=['event_id', 'xref_id', 'sidx'],
+                right_on=['event_id', 'output_id', 'sidx'],
+                suffixes=["_gul", "_il"])
+            losses_df['loss_il'] = losses_df['loss_il'].fillna(0.0)
+            losses_df.sort_values(by='event_id', kind='mergesort', inplace=True)
+            losses_df.reset_index(drop=True, inplace=True)
+        else:
+            losses_df = pd.merge(
+                guls_df,
+                losses_df,
+                left_on=['event_id', 'xref_id', 'sidx'],
+                right_on=['event_id', 'output_id', 'sidx'],
+                suffixes=["_gul", "_il"])
+            del losses_df['event_id']
+            del losses_df['sidx']
         del losses_df['output_id']
         del losses_df['xref_id']
         del losses_df['item_id']
@@ -0,0 +1,374 @@
+"""
+Native readers and writers for the ktools binary formats.
+Builds the binary layouts directly from the Oasis structure DataFrames,
+rather than writing CSV files and running the ktools conversion tools.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+#
+# Binary record layouts, as written by the ktools *tobin conversion tools.
+#
+COVERAGES_DTYPE = np.dtype([
+    ('tiv', '<f4')])
+ITEMS_DTYPE = np.dtype([
+    ('item_id', '<i4'),
+    ('coverage_id', '<i4'),
+    ('areaperil_id', '<i4'),
+    ('vulnerability_id', '<i4'),
+    ('group_id', '<i4')])
+FM_POLICYTC_DTYPE = np.dtype([
+    ('level_id', '<i4'),
+    ('agg_id', '<i4'),
+    ('layer_id', '<i4'),
+    ('profile_id', '<i4')])
+FM_PROFILE_DTYPE = np.dtype([
+    ('profile_id', '<i4'),
+    ('calcrule_id', '<i4'),
+    ('deductible1', '<f4'),
+    ('deductible2', '<f4'),
+    ('deductible3', '<f4'),
+    ('attachment', '<f4'),
+    ('limit', '<f4'),
+    ('share1', '<f4'),
+    ('share2', '<f4'),
+    ('share3', '<f4')])
+FM_PROGRAMME_DTYPE = np.dtype([
+    ('from_agg_id', '<i4'),
+    ('level_id', '<i4'),
+    ('to_agg_id', '<i4')])
+FM_XREF_DTYPE = np.dtype([
+    ('output_id', '<i4'),
+    ('agg_id', '<i4'),
+    ('layer_id', '<i4')])
+
+INPUT_FILE_DTYPES = {
+    'coverages': COVERAGES_DTYPE,
+    'items': ITEMS_DTYPE,
+    'fm_policytc': FM_POLICYTC_DTYPE,
+    'fm_profile': FM_PROFILE_DTYPE,
+    'fm_programme': FM_PROGRAMME_DTYPE,
+    'fm_xref': FM_XREF_DTYPE}
+
+
+def get_input_files_size(row_counts):
+    """
+    Return the total size in bytes of the ktools binary input files with
+    the given numbers of rows, keyed by input file name, e.g. 'fm_profile'.
+    """
+    return sum(
+        INPUT_FILE_DTYPES[input_file].itemsize * row_count
+        for (input_file, row_count) in row_counts.items())
+
+
+def to_records(df, dtype):
+    """
+    Pack the columns of a DataFrame into a structured array with the given layout.
+    """
+    records = np.empty(len(df.index), dtype=dtype)
+    for name in dtype.names:
+        records[name] = df[name].values
+    return records
+
+
+def write_input_files(directory, input_dfs):
+    """
+    Write a set of Oasis structures to ktools binary files.
+    input_dfs maps the input file name, e.g. 'fm_profile', to its DataFrame.
+    """
+    for (input_file, df) in input_dfs.items():
+        to_records(df, INPUT_FILE_DTYPES[input_file]).tofile(
+            os.path.join(directory, input_file + ".bin"))
+
+
+#
+# Loss streams, as produced by gulcalc and fmcalc.
+#
+# The stream starts with a header of the stream type and sample size. It is
+# followed by a record for each (event_id, output_id) pair, which is a header
+# of the two IDs then (sidx, loss) samples, terminated by a (0, 0.0) sample.
+# Every element is a pair of 4 byte values, so the stream can be decoded as
+# a 2 column array without parsing it record by record.
+#
+LOSS_STREAM_HEADER_DTYPE = np.dtype([
+    ('stream_type', '<i4'),
+    ('sample_size', '<i4')])
+LOSS_STREAM_PAIR_SIZE = 8
+
+GUL_ITEM_STREAM_TYPE = 0x01000001
+FM_STREAM_TYPE = 0x02000001
+
+# Special sample indexes
+TIV_SIDX = -3
+STD_DEV_SIDX = -2
+MEAN_SIDX = -1
+
+# The special samples that lead the samples of each record, as written by
+# write_gul_records and by fmcalc
+GUL_STREAM_SPECIAL_SIDXS = [MEAN_SIDX, STD_DEV_SIDX]
+FM_STREAM_SPECIAL_SIDXS = [TIV_SIDX, MEAN_SIDX]
+
+def get_loss_stream_size(record_count, sample_size):
+    """
+    Return the size in bytes of a loss stream of record_count (event_id,
+    output_id) records, each with sample_size samples, counting any
+    special samples.
+    """
+    return LOSS_STREAM_HEADER_DTYPE.itemsize + \
+        record_count * (sample_size + 2) * LOSS_STREAM_PAIR_SIZE
+
+
+def get_gul_stream_size(record_count, sample_size):
+    """
+    Return the size in bytes of a ground up loss stream, as written by
+    write_gul_stream, of record_count records of sample_size samples.
+    """
+    return get_loss_stream_size(
+        record_count, sample_size + len(GUL_STREAM_SPECIAL_SIDXS))
+
+
+def get_fm_stream_size(record_count, sample_size):
+    """
+    Return the size in bytes of an fmcalc output stream of up to
+    record_count records of sample_size samples. fmcalc leaves out records
+    with no loss, so this is the size when every record has a loss.
+    """
+    return get_loss_stream_size(
+        record_count, sample_size + len(FM_STREAM_SPECIAL_SIDXS))
+
+
+LOSS_STREAM_CHUNK_SIZE = 1 << 20
+LOSS_STREAM_CHUNK_RECORDS = 1 << 16
+
+
+def encode_loss_records(event_ids, output_ids, sidxs, losses):
+    """
+    Encode loss stream records, without the stream header.
+    Every record has the same sample indexes, sidxs, and losses has
+    one row per record and one column per sample index.
+    """
+    losses = np.ascontiguousarray(losses, dtype='<f4').reshape(
+        len(event_ids), len(sidxs))
+    pairs = np.zeros((len(event_ids), len(sidxs) + 2, 2), dtype='<i4')
+    pairs[:, 0, 0] = event_ids
+    pairs[:, 0, 1] = output_ids
+    pairs[:, 1:-1, 0] = sidxs
+    pairs[:, 1:-1, 1] = losses.view('<i4')
+    return pairs.tobytes()
+
+
+def write_loss_stream_header(stream, stream_type, sample_size):
+    """
+    Write the header of a loss stream.
+    """
+    stream.write(np.array(
+        [(stream_type, sample_size)], dtype=LOSS_STREAM_HEADER_DTYPE).tobytes())
+
+
+def write_loss_records(
+        stream, event_ids, output_ids, sidxs, losses,
+        chunk_records=LOSS_STREAM_CHUNK_RECORDS):
+    """
+    Write loss stream records to a binary file object, such as the stdin of
+    fmcalc. The records are encoded and written in chunks to bound memory use.
+    """
+    for start in range(0, len(event_ids), chunk_records):
+        end = start + chunk_records
+        stream.write(encode_loss_records(
+            event_ids[start:end], output_ids[start:end], sidxs, losses[start:end]))
+
+
+def write_gul_records(stream, event_ids, item_ids, samples):
+    """
+    Write ground up loss records, as produced by gultobin.
+    samples has one row per (event_id, item_id) record and one column per
+    sample. The mean and standard deviation of each record are taken from
+    its samples.
+    """
+    samples = np.asarray(samples, dtype=np.float64).reshape(len(event_ids), -1)
+    sidxs = np.concatenate([
+        GUL_STREAM_SPECIAL_SIDXS, np.arange(1, samples.shape[1] + 1)])
+    losses = np.column_stack([
+        samples.mean(axis=1), samples.std(axis=1), samples])
+    write_loss_records(stream, event_ids, item_ids, sidxs, losses)
+
+
+def write_gul_stream(stream, event_ids, item_ids, samples):
+    """
+    Write a ground up loss stream, the header followed by the records.
+    """
+    samples = np.asarray(samples, dtype=np.float64).reshape(len(event_ids), -1)
+    write_loss_stream_header(stream, GUL_ITEM_STREAM_TYPE, samples.shape[1])
+    write_gul_records(stream, event_ids, item_ids, samples)
+
+
+def decode_loss_pairs(buffer, sidx=None):
+    """
+    Decode a buffer of complete loss stream records, without the stream header.
+    Only samples with sample index in sidx are kept; sidx can be a single index,
+    a list of indexes or None for all samples.
+    Returns arrays of event_id, output_id, sidx and loss, one element per sample.
+    """
+    pairs = np.frombuffer(buffer, dtype='<i4').reshape(-1, 2)
+    losses = pairs[:, 1].view('<f4')
+
+    # Record headers have event_id > 0, so any pair with a zero first value is
+    # a terminator. Each record header follows a terminator.
+    is_terminator = pairs[:, 0] == 0
+    is_header = np.empty(len(pairs), dtype=bool)
+    is_header[:1] = True
+    is_header[1:] = is_terminator[:-1]
+    record_indexes = np.cumsum(is_header) - 1
+
+    is_sample = ~(is_header | is_terminator)
+    if sidx is not None:
+        is_sample &= np.isin(pairs[:, 0], sidx)
+
+    header_pairs = pairs[is_header]
+    sample_record_indexes = record_indexes[is_sample]
+    return (
+        header_pairs[sample_record_indexes, 0],
+        header_pairs[sample_record_indexes, 1],
+        pairs[is_sample, 0],
+        losses[is_sample])
+
+
+def get_loss_stream_partitions(data, partition_count):
+    """
+    Split an encoded loss stream, the header followed by the records, by
+    event into at most partition_count parts, and return the (start, end)
+    byte offsets of the records of each part. As with eve, each part has a
+    contiguous range of the events, and the parts have near equal numbers
+    of events. data can be any buffer, such as a memory map of a file.
+    """
+    header_size = LOSS_STREAM_HEADER_DTYPE.itemsize
+    pairs = np.frombuffer(data, dtype='<i4', offset=header_size).reshape(-1, 2)
+    if len(pairs) == 0:
+        return [(header_size, header_size)]
+
+    # Each record starts after a terminator, and each event at the first
+    # record with its event_id
+    record_starts = np.concatenate([[0], np.flatnonzero(pairs[:, 0] == 0) + 1])
+    record_starts = record_starts[record_starts < len(pairs)]
+    record_event_ids = pairs[record_starts, 0]
+    event_starts = record_starts[np.concatenate([
+        [True], record_event_ids[1:] != record_event_ids[:-1]])]
+
+    groups = np.array_split(
+        np.arange(len(event_starts)), min(partition_count, len(event_starts)))
+    bounds = [event_starts[group[0]] for group in groups] + [len(pairs)]
+    return [
+        (header_size + int(start) * LOSS_STREAM_PAIR_SIZE,
+         header_size + int(end) * LOSS_STREAM_PAIR_SIZE)
+        for (start, end) in zip(bounds[:-1], bounds[1:])]
+
+
+def split_loss_stream(data, partition_count):
+    """
+    Split an encoded loss stream by event, as get_loss_stream_partitions,
+    into at most partition_count streams, each with the header.
+    """
+    header = data[:LOSS_STREAM_HEADER_DTYPE.itemsize]
+    return [
+        header + data[start:end]
+        for (start, end) in get_loss_stream_partitions(data, partition_count)]
+
+
+def write_loss_stream_partition(stream, data, start, end):
+    """
+    Write the header of an encoded loss stream, followed by its records from
+    byte start to end, a chunk at a time, so that data can be a memory map
+    of a file that is never read into memory at once.
+    """
+    stream.write(data[:LOSS_STREAM_HEADER_DTYPE.itemsize])
+    for chunk_start in range(start, end, LOSS_STREAM_CHUNK_SIZE):
+        stream.write(data[chunk_start:min(chunk_start + LOSS_STREAM_CHUNK_SIZE, end)])
+
+
+def read_loss_stream(
+        stream, sidx=None, tee=None, decimals=None,
+        chunk_size=LOSS_STREAM_CHUNK_SIZE):
+    """
+    Read a loss stream from a binary file object into a DataFrame with
+    columns event_id, output_id, sidx and loss, as produced by fmtocsv.
+    The stream is decoded chunk by chunk as it arrives, so it can be the
+    stdout of a running process. If tee is set, the raw stream is also
+    copied to that file object. If decimals is set, losses are rounded
+    to that many decimal places. Only a GUL item stream, as written by
+    gultobin, can end without terminating its last record; any other
+    stream that does has been cut short.
+    """
+    header = _read_exactly(stream, LOSS_STREAM_HEADER_DTYPE.itemsize)
+    stream_type = np.frombuffer(header, dtype=LOSS_STREAM_HEADER_DTYPE)['stream_type'][0]
+    if tee is not None:
+        tee.write(header)
+
+    decoded = []
+    remainder = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if tee is not None:
+            tee.write(chunk)
+        buffer = remainder + chunk
+
+        # Decode up to the end of the last complete record
+        pair_count = len(buffer) // LOSS_STREAM_PAIR_SIZE
+        first_values = np.frombuffer(
+            buffer, dtype='<i4', count=pair_count * 2)[::2]
+        terminators = np.flatnonzero(first_values == 0)
+        if len(terminators) == 0:
+            remainder = buffer
+            continue
+        end = (terminators[-1] + 1) * LOSS_STREAM_PAIR_SIZE
+        decoded.append(decode_loss_pairs(buffer[:end], sidx))
+        remainder = buffer[end:]
+
+    if len(remainder) % LOSS_STREAM_PAIR_SIZE != 0:
+        raise Exception("Truncated loss stream: {} bytes left over".format(
+            len(remainder)))
+    # gultobin does not terminate the last record
+    if len(remainder) > 0 and stream_type != GUL_ITEM_STREAM_TYPE:
+        raise Exception("Truncated loss stream: last record not terminated")
+    if len(remainder) > 0:
+        decoded.append(decode_loss_pairs(
+            remainder + bytes(LOSS_STREAM_PAIR_SIZE), sidx))
+
+    columns = ['event_id', 'output_id', 'sidx', 'loss']
+    if len(decoded) == 0:
+        losses_df = pd.DataFrame({
+            'event_id': np.array([], dtype=np.int64),
+            'output_id': np.array([], dtype=np.int64),
+            'sidx': np.array([], dtype=np.int64),
+            'loss': np.array([], dtype=np.float64)}, columns=columns)
+    else:
+        losses_df = pd.DataFrame({
+            'event_id': np.concatenate([d[0] for d in decoded]).astype(np.int64),
+            'output_id': np.concatenate([d[1] for d in decoded]).astype(np.int64),
+            'sidx': np.concatenate([d[2] for d in decoded]).astype(np.int64),
+            'loss': np.concatenate([d[3] for d in decoded]).astype(np.float64)
+        }, columns=columns)
+
+    if decimals is not None:
+        losses_df['loss'] = losses_df['loss'].round(decimals)
+    return losses_df
+
+
+def read_loss_file(file_path, sidx=None, decimals=None):
+    """
+    Read a loss stream that has been saved to file.
+    """
+    with open(file_path, 'rb') as f:
+        return read_loss_stream(f, sidx=sidx, decimals=decimals)
+
+
+def _read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise Exception("Loss stream ended before the stream header")
+        data = data + chunk
+    return data
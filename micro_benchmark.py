@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of the internals of reinsurance_layer.py: building the
+program hierarchy of each risk level, adding the profiles of each treaty
+type, combining the overlays into fm_policytcs, and validating the
+reinsurance structures. Each benchmark is timed at a range of portfolio
+sizes with fixed seeds, and the exponent of its growth with size is
+estimated, so that results can be compared with a stored baseline and a
+change from linear to quadratic is flagged.
+"""
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+import common
+import portfolio_generator
+from direct_layer import DirectLayer
+from reinsurance_layer import ReinsuranceLayer, get_program_hierarchy, \
+    validate_reinsurance_structures
+
+DEFAULT_SIZES = [1000, 4000, 16000]
+DEFAULT_REPEAT = 3
+LOCATIONS_PER_ACCOUNT = 10
+OVERLAY_COUNT = 8
+
+# A baseline time is exceeded if the new time is this many times greater,
+# and a baseline exponent if the new one is this much greater. Times below
+# MIN_TIME are too noisy to compare.
+TIME_TOLERANCE = 2.0
+EXPONENT_TOLERANCE = 0.5
+MIN_TIME = 0.001
+
+# The treaty of each _add_*_profiles benchmark. The risk treaties have a
+# specific scope row for every location, so that their scopes grow with the
+# size; CAT XL has one scope row for the portfolio.
+PROFILE_TREATIES = OrderedDict([
+    ('fac', (common.REINS_TYPE_FAC, common.REINS_RISK_LEVEL_LOCATION)),
+    ('per_risk', (common.REINS_TYPE_PER_RISK, common.REINS_RISK_LEVEL_LOCATION)),
+    ('quota_share', (common.REINS_TYPE_QUOTA_SHARE, common.REINS_RISK_LEVEL_LOCATION)),
+    ('surplus_share', (common.REINS_TYPE_SURPLUS_SHARE, common.REINS_RISK_LEVEL_LOCATION)),
+    ('cat_xl', (common.REINS_TYPE_CAT_XL, common.REINS_RISK_LEVEL_PORTFOLIO)),
+])
+
+
+class Fixture(object):
+    """
+    A generated portfolio of size locations, its direct structures, and a
+    treaty of each type at its own inuring priority.
+    """
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        treaties = [
+            portfolio_generator.Treaty(inuring_priority, reins_type, risk_level, 1, 1.0)
+            for (inuring_priority, (reins_type, risk_level))
+            in enumerate(PROFILE_TREATIES.values(), 1)]
+        (self.account_df, self.location_df, self.ri_info_df, self.ri_scope_df) = \
+            portfolio_generator.generate_portfolio(
+                max(1, size // LOCATIONS_PER_ACCOUNT), LOCATIONS_PER_ACCOUNT,
+                treaties=treaties,
+                specific_scope_types=[
+                    reins_type for (reins_type, risk_level) in PROFILE_TREATIES.values()
+                    if risk_level != common.REINS_RISK_LEVEL_PORTFOLIO],
+                seed=seed)
+
+        self.direct_layer = DirectLayer(self.account_df, self.location_df)
+        self.direct_layer.generate_oasis_structures()
+
+    def get_layer(self, inuring_priority):
+        """
+        Return the ReinsuranceLayer of the treaty at an inuring priority,
+        and its ri_info row.
+        """
+        ri_info_df = self.ri_info_df[self.ri_info_df.InuringPriority == inuring_priority]
+        risk_level = self.ri_scope_df[
+            self.ri_scope_df.ReinsNumber == ri_info_df.ReinsNumber.iloc[0]].RiskLevel.iloc[0]
+        layer = ReinsuranceLayer(
+            name="ri_{}_{}".format(inuring_priority, risk_level),
+            ri_info=ri_info_df,
+            ri_scope=self.ri_scope_df,
+            accounts=self.account_df,
+            locations=self.location_df,
+            items=self.direct_layer.items,
+            coverages=self.direct_layer.coverages,
+            fm_xrefs=self.direct_layer.fm_xrefs,
+            xref_descriptions=self.direct_layer.xref_descriptions,
+            risk_level=risk_level)
+        return (layer, ri_info_df.iloc[0])
+
+
+def get_tree_benchmark(risk_level):
+    def benchmark(fixture):
+        return (
+            lambda: None,
+            lambda _: get_program_hierarchy(
+                fixture.direct_layer.xref_descriptions, risk_level))
+    return benchmark
+
+
+def get_profiles_benchmark(name):
+    """
+    Time the _add_*_profiles method of a treaty type on the overlay of
+    one contract, as step 2 of generate_oasis_structures does.
+    """
+    def benchmark(fixture):
+        (layer, ri_info_row) = fixture.get_layer(
+            list(PROFILE_TREATIES.keys()).index(name) + 1)
+        hierarchy = layer._get_tree()
+        scope_rows = layer.ri_scope[
+            (layer.ri_scope.ReinsNumber == ri_info_row.ReinsNumber) &
+            (layer.ri_scope.RiskLevel == layer.risk_level)]
+        add_profiles = getattr(layer, "_add_{}_profiles".format(name))
+
+        def setup():
+            profiles = common.ProfileRegistry()
+            nolossprofile_id = profiles.add(common.get_no_loss_profile(None))
+            passthroughprofile_id = profiles.add(common.get_pass_through_profile(None))
+            return layer.add_profiles_args(
+                hierarchy, ri_info_row, scope_rows, 1, 1,
+                np.full(len(hierarchy.profile_nodes), nolossprofile_id), profiles,
+                nolossprofile_id, passthroughprofile_id,
+                hierarchy.all_node_index, hierarchy.risk_node_index)
+        return (setup, add_profiles)
+    return benchmark
+
+
+def policytc_benchmark(fixture):
+    """
+    Time step 3 of generate_oasis_structures, combining the overlays of
+    OVERLAY_COUNT contracts in two layers at the location risk level.
+    """
+    (layer, _) = fixture.get_layer(1)
+    hierarchy = layer._get_tree()
+    profiles = common.ProfileRegistry()
+    nolossprofile_id = profiles.add(common.get_no_loss_profile(None))
+    references = [
+        profiles.add(common.get_reinsurance_profile(None, limit=float(limit)))
+        for limit in range(1, 101)]
+    random_state = np.random.RandomState(0)
+    overlay_profiles = random_state.choice(
+        [nolossprofile_id] + references, (OVERLAY_COUNT, len(hierarchy.profile_nodes)))
+    overlay_layer_ids = np.repeat([1, 2], OVERLAY_COUNT // 2)
+    return (
+        lambda: None,
+        lambda _: layer._get_fm_policytcs(
+            hierarchy, overlay_profiles, overlay_layer_ids, 2, profiles,
+            nolossprofile_id))
+
+
+def validate_benchmark(fixture):
+    return (
+        lambda: None,
+        lambda _: validate_reinsurance_structures(
+            fixture.account_df, fixture.location_df,
+            fixture.ri_info_df, fixture.ri_scope_df))
+
+
+BENCHMARKS = OrderedDict(
+    [("get_tree_{}".format(risk_level), get_tree_benchmark(risk_level))
+     for risk_level in common.REINS_RISK_LEVELS] +
+    [("add_{}_profiles".format(name), get_profiles_benchmark(name))
+     for name in PROFILE_TREATIES.keys()] +
+    [("fm_policytcs", policytc_benchmark),
+     ("validate_reinsurance_structures", validate_benchmark)])
+
+
+def time_benchmark(setup, run, repeat):
+    """
+    Return the best time in seconds of repeat runs, each on a fresh setup.
+    """
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        t_start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - t_start)
+    return min(times)
+
+
+def get_exponent(sizes, times):
+    """
+    Estimate k for time growing as size ** k, from a least squares fit of
+    log time to log size.
+    """
+    if len(sizes) < 2:
+        return None
+    return float(np.polyfit(np.log(sizes), np.log(np.maximum(times, 1e-9)), 1)[0])
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, names=None, repeat=DEFAULT_REPEAT, seed=0):
+    """
+    Run the named benchmarks, by default all of them, at each size, the
+    number of locations. Returns a dict with the sizes and, for each
+    benchmark, its time in seconds at each size and its exponent.
+    """
+    names = list(BENCHMARKS.keys()) if names is None else names
+    times = OrderedDict((name, []) for name in names)
+    for size in sizes:
+        fixture = Fixture(size, seed)
+        for name in names:
+            times[name].append(time_benchmark(
+                *BENCHMARKS[name](fixture), repeat=repeat))
+
+    return {
+        'sizes': list(sizes),
+        'seed': seed,
+        'benchmarks': OrderedDict(
+            (name, {'times': name_times, 'exponent': get_exponent(sizes, name_times)})
+            for (name, name_times) in times.items()),
+    }
+
+
+def compare(results, baseline,
+            time_tolerance=TIME_TOLERANCE, exponent_tolerance=EXPONENT_TOLERANCE):
+    """
+    Compare benchmark results with a baseline from the same sizes, and
+    return a message for each time or exponent that has regressed.
+    Benchmarks that take less than MIN_TIME are not compared.
+    """
+    regressions = []
+    for (name, result) in results['benchmarks'].items():
+        baseline_result = baseline['benchmarks'].get(name)
+        if baseline_result is None:
+            continue
+        for (size, new_time, baseline_time) in zip(
+                results['sizes'], result['times'], baseline_result['times']):
+            if new_time > max(baseline_time * time_tolerance, MIN_TIME):
+                regressions.append("{} at {}: {:.6f}s, baseline {:.6f}s".format(
+                    name, size, new_time, baseline_time))
+        if result['exponent'] is not None and baseline_result['exponent'] is not None and \
+                max(result['times']) >= MIN_TIME and \
+                result['exponent'] > baseline_result['exponent'] + exponent_tolerance:
+            regressions.append("{} grows as size ** {:.2f}, baseline size ** {:.2f}".format(
+                name, result['exponent'], baseline_result['exponent']))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark the internals of the reinsurance layer.')
+    parser.add_argument(
+        '-s', '--sizes', metavar='N', type=str,
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help='A comma separated list of the numbers of locations to run.')
+    parser.add_argument(
+        '-b', '--benchmarks', metavar='N', type=str, default=None,
+        help='A comma separated list of the benchmarks to run, by default all of: ' +
+             ", ".join(BENCHMARKS.keys()))
+    parser.add_argument(
+        '-r', '--repeat', metavar='N', type=int, default=DEFAULT_REPEAT,
+        help='The number of times to run each benchmark, taking the best time.')
+    parser.add_argument(
+        '-o', '--output_file', metavar='N', type=str, default=None,
+        help='A JSON file to write the results to, e.g. to use as a baseline.')
+    parser.add_argument(
+        '--baseline', metavar='N', type=str, default=None,
+        help='A JSON file of earlier results to compare with.')
+
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # Times are only comparable at the same sizes
+        sizes = baseline['sizes']
+    results = run_benchmarks(
+        sizes,
+        names=None if args.benchmarks is None else args.benchmarks.split(","),
+        repeat=args.repeat)
+
+    print(pd.DataFrame(
+        [result['times'] + [result['exponent']]
+         for result in results['benchmarks'].values()],
+        index=list(results['benchmarks'].keys()),
+        columns=[str(size) for size in results['sizes']] + ['exponent']).to_string())
+    if args.output_file is not None:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=4)
+    if baseline is not None:
+        regressions = compare(results, baseline)
+        for regression in regressions:
+            print("Regression: {}".format(regression))
+        if regressions:
+            exit(1)
@@ -0,0 +1,264 @@
+"""
+A pure NumPy implementation of the ktools financial module, as an alternative
+to running fmcalc. The losses of every event and sample are run through the
+Oasis structures together, as the columns of a single loss matrix, so each
+level of the programme is a segmented sum over its aggregations. Layers are
+chained in memory rather than through loss stream files.
+
+Only the calcrules and allocation rule that this tool generates are supported.
+The calcrules follow the bundled version of fmcalc.
+"""
+import numpy as np
+import pandas as pd
+import common
+import ktools_io
+from collections import namedtuple
+
+
+# The losses of a set of outputs, or items, with one row per output_id and
+# one column per (event_id, sidx) sample.
+LossMatrix = namedtuple("LossMatrix", "output_ids event_ids sidxs losses")
+
+
+def _deductible_attachment_limit_and_share(losses, profiles):
+    return np.clip(
+        losses - (profiles['deductible1'] + profiles['attachment']),
+        0, profiles['limit']) * profiles['share1']
+
+
+def _deductible_only(losses, profiles):
+    return np.maximum(losses - profiles['deductible1'], 0)
+
+
+def _limit_only(losses, profiles):
+    return np.minimum(losses, profiles['limit'])
+
+
+def _occurrence_limit_and_share(losses, profiles):
+    return np.minimum(losses, profiles['limit']) * \
+        profiles['share2'] * profiles['share3']
+
+
+def _occurrence_catastrophe_excess_of_loss(losses, profiles):
+    # The ceded share is applied before the attachment
+    return np.clip(
+        losses * profiles['share1'] - profiles['attachment'],
+        0, profiles['limit']) * profiles['share2'] * profiles['share3']
+
+
+def _facultative_with_policy_share(losses, profiles):
+    return losses * \
+        profiles['share1'] * profiles['share2'] * profiles['share3']
+
+
+CALCRULES = {
+    common.CALCRULE_ID_DEDUCTIBLE_ATTACHMENT_LIMIT_AND_SHARE:
+        _deductible_attachment_limit_and_share,
+    common.CALCRULE_ID_DEDUCTIBLE_ONLY: _deductible_only,
+    common.CALCRULE_ID_LIMIT_ONLY: _limit_only,
+    common.CALCRULE_ID_OCCURRENCE_LIMIT_AND_SHARE: _occurrence_limit_and_share,
+    common.CALCRULE_ID_OCCURRENCE_CATASTROPHE_EXCESS_OF_LOSS:
+        _occurrence_catastrophe_excess_of_loss,
+    common.CALCRULE_ID_FACULTATIVE_WITH_POLICY_SHARE:
+        _facultative_with_policy_share}
+
+
+def apply_profiles(losses, profiles):
+    """
+    Apply a profile to each row of losses. profiles is a structured array of
+    fm_profile records, one per row.
+    """
+    results = np.empty_like(losses)
+    for calcrule_id in np.unique(profiles['calcrule_id']):
+        if calcrule_id not in CALCRULES:
+            raise Exception("Calcrule not supported: {}".format(calcrule_id))
+        rows = profiles['calcrule_id'] == calcrule_id
+        row_profiles = {
+            field: profiles[field][rows, np.newaxis].astype(np.float64)
+            for field in ktools_io.FM_PROFILE_DTYPE.names[2:]}
+        results[rows] = CALCRULES[calcrule_id](losses[rows], row_profiles)
+    return results
+
+
+def _get_indexes(ids, values):
+    """
+    Return the index in the sorted array ids of each of values.
+    """
+    indexes = np.minimum(np.searchsorted(ids, values), len(ids) - 1)
+    if np.any(ids[indexes] != values):
+        raise Exception("Aggregation IDs missing from the previous level")
+    return indexes
+
+
+def calculate(
+        layer,
+        input_losses,
+        net=False,
+        allocation=common.ALLOCATE_TO_ITEMS_BY_PREVIOUS_LEVEL_ALLOC_ID):
+    """
+    Run the input losses, a LossMatrix by item_id, through the Oasis
+    structures of a direct or reinsurance layer, as fmcalc would.
+    Returns a LossMatrix by output_id. If net is set, the losses are net of
+    all the layers and only the outputs of the last layer are returned.
+    """
+    if allocation != common.ALLOCATE_TO_ITEMS_BY_PREVIOUS_LEVEL_ALLOC_ID:
+        raise Exception("Allocation rule not supported: {}".format(allocation))
+
+    profiles = ktools_io.to_records(layer.fmprofiles, ktools_io.FM_PROFILE_DTYPE)
+    profile_indexes = np.zeros(profiles['profile_id'].max() + 1, dtype=np.int64)
+    profile_indexes[profiles['profile_id']] = np.arange(len(profiles))
+    layer_ids = np.unique(layer.fm_policytcs.layer_id.values)
+
+    order = np.argsort(input_losses.output_ids, kind='mergesort')
+    item_ids = np.asarray(input_losses.output_ids)[order]
+    item_losses = np.asarray(input_losses.losses, dtype=np.float64)[order]
+
+    #
+    # Bottom up, sum the losses out of each level into the aggregations of
+    # the next level, per layer, and apply their profiles.
+    #
+    agg_ids = item_ids
+    layer_losses = [item_losses] * len(layer_ids)
+    levels = []
+    for level_id in np.unique(layer.fmprogrammes.level_id.values):
+        programme = layer.fmprogrammes[layer.fmprogrammes.level_id == level_id]
+        child_indexes = _get_indexes(agg_ids, programme.from_agg_id.values)
+        (parent_agg_ids, parent_indexes) = np.unique(
+            programme.to_agg_id.values, return_inverse=True)
+        child_order = np.argsort(parent_indexes, kind='mergesort')
+        children = child_indexes[child_order]
+        starts = np.searchsorted(
+            parent_indexes[child_order], np.arange(len(parent_agg_ids)))
+
+        # Profile of each (layer, aggregation), or -1 if there is none
+        policytcs = layer.fm_policytcs[layer.fm_policytcs.level_id == level_id]
+        profile_rows = np.full((len(layer_ids), len(parent_agg_ids)), -1)
+        profile_rows[
+            np.searchsorted(layer_ids, policytcs.layer_id.values),
+            _get_indexes(parent_agg_ids, policytcs.agg_id.values)] = \
+            profile_indexes[policytcs.profile_id.values]
+
+        losses_in = []
+        losses_out = []
+        for layer_index in range(len(layer_ids)):
+            loss_in = np.add.reduceat(
+                layer_losses[layer_index][children], starts, axis=0)
+            loss_out = loss_in.copy()
+            rows = profile_rows[layer_index] >= 0
+            loss_out[rows] = apply_profiles(
+                loss_in[rows], profiles[profile_rows[layer_index][rows]])
+            if layer_index > 0:
+                # Aggregations with only a first layer profile feed the
+                # same losses into every layer
+                rows = ~rows & (profile_rows[0] >= 0)
+                loss_in[rows] = losses_in[0][rows]
+                loss_out[rows] = losses_out[0][rows]
+            losses_in.append(loss_in)
+            losses_out.append(loss_out)
+
+        parents = np.full(len(agg_ids), -1)
+        parents[child_indexes] = parent_indexes
+        levels.append((parents, losses_in, losses_out))
+        agg_ids = parent_agg_ids
+        layer_losses = losses_out
+
+    #
+    # Top down, back allocate the losses pro rata to the losses of the
+    # previous level. The share of each item is the product of the ratios
+    # of loss out to loss in of the aggregations above it.
+    #
+    layer_allocations = []
+    for layer_index in range(len(layer_ids)):
+        ratios = np.ones((1, item_losses.shape[1]))
+        parents = np.zeros(len(agg_ids), dtype=np.int64)
+        for (level_parents, losses_in, losses_out) in reversed(levels):
+            loss_in = losses_in[layer_index]
+            level_ratios = np.divide(
+                losses_out[layer_index], loss_in,
+                out=np.zeros_like(loss_in), where=loss_in != 0)
+            ratios = level_ratios * ratios[parents]
+            # Aggregations that are not in the next level are lost
+            ratios = np.vstack([ratios, np.zeros((1, ratios.shape[1]))])
+            parents = level_parents
+        layer_allocations.append(item_losses * ratios[parents])
+
+    #
+    # Outputs by fm_xref
+    #
+    fm_xrefs = layer.fm_xrefs
+    if net:
+        net_losses = item_losses
+        for allocation_losses in layer_allocations:
+            net_losses = np.maximum(net_losses - allocation_losses, 0)
+        fm_xrefs = fm_xrefs[fm_xrefs.layer_id == layer_ids[-1]]
+        output_losses = net_losses[_get_indexes(item_ids, fm_xrefs.agg_id.values)]
+    else:
+        output_losses = np.empty((len(fm_xrefs.index), item_losses.shape[1]))
+        item_indexes = _get_indexes(item_ids, fm_xrefs.agg_id.values)
+        layer_indexes = np.searchsorted(layer_ids, fm_xrefs.layer_id.values)
+        for layer_index in range(len(layer_ids)):
+            rows = layer_indexes == layer_index
+            output_losses[rows] = layer_allocations[layer_index][item_indexes[rows]]
+
+    return LossMatrix(
+        output_ids=fm_xrefs.output_id.values,
+        event_ids=input_losses.event_ids,
+        sidxs=input_losses.sidxs,
+        losses=output_losses)
+
+
+def to_loss_df(loss_matrix, sidx=None, decimals=common.LOSS_DECIMALS):
+    """
+    Return the losses in a DataFrame with columns event_id, output_id, sidx
+    and loss, as decoded from an fmcalc loss stream. The losses are held to
+    the same precision as the loss stream and, like fmcalc, zero losses are
+    not included. Only samples with sample index in sidx are kept.
+    """
+    event_ids = np.asarray(loss_matrix.event_ids)
+    sidxs = np.asarray(loss_matrix.sidxs)
+    output_ids = np.asarray(loss_matrix.output_ids)
+    losses = np.asarray(loss_matrix.losses).astype(np.float32)
+
+    is_loss = losses != 0
+    if sidx is not None:
+        is_loss &= np.isin(sidxs, sidx)[np.newaxis, :]
+    (rows, columns) = np.nonzero(is_loss)
+    order = np.lexsort((sidxs[columns], output_ids[rows], event_ids[columns]))
+    (rows, columns) = (rows[order], columns[order])
+
+    losses_df = pd.DataFrame({
+        'event_id': event_ids[columns].astype(np.int64),
+        'output_id': output_ids[rows].astype(np.int64),
+        'sidx': sidxs[columns].astype(np.int64),
+        'loss': losses[rows, columns].astype(np.float64)
+    }, columns=['event_id', 'output_id', 'sidx', 'loss'])
+    if decimals is not None:
+        losses_df['loss'] = losses_df['loss'].round(decimals)
+    return losses_df
+
+
+def run_fm(
+        input_name,
+        output_name,
+        reinsurance_layer,
+        loss_matrices,
+        allocation=common.ALLOCATE_TO_ITEMS_BY_PREVIOUS_LEVEL_ALLOC_ID,
+        sample_size=None):
+    """
+    In memory version of common.run_fm. The losses of the previous layer,
+    input_name, are taken from loss_matrices, a dictionary of LossMatrix by
+    layer name, and the net losses are added to it as output_name.
+    """
+    sidx = 1
+    if sample_size is not None:
+        sidx = list(range(1, sample_size + 1))
+    input_losses = loss_matrices[input_name]
+    output_losses = calculate(
+        reinsurance_layer, input_losses, net=True, allocation=allocation)
+    loss_matrices[output_name] = output_losses
+
+    return common.merge_net_losses(
+        to_loss_df(input_losses, sidx=sidx),
+        to_loss_df(output_losses, sidx=sidx),
+        reinsurance_layer.xref_descriptions,
+        sample_size)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""
+Generate synthetic sets of OED inputs, with configurable numbers of
+accounts, policies and locations, distributions of TIV, and reinsurance
+treaties, for load testing. Only the OED fields that the test tool uses
+are generated. The same parameters and seed give the same inputs.
+"""
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+import common
+
+# A treaty at an inuring priority. layer_count contracts of reins_type are
+# written, with scopes at risk_level. Specific scopes, by default for FAC and
+# SS, cover scope_fraction of the risks at that level.
+Treaty = namedtuple(
+    "Treaty", "inuring_priority reins_type risk_level layer_count scope_fraction")
+
+TIV_DISTRIBUTION_CONSTANT = 'constant'
+TIV_DISTRIBUTION_UNIFORM = 'uniform'
+TIV_DISTRIBUTION_LOGNORMAL = 'lognormal'
+TIV_DISTRIBUTIONS = [
+    TIV_DISTRIBUTION_CONSTANT,
+    TIV_DISTRIBUTION_UNIFORM,
+    TIV_DISTRIBUTION_LOGNORMAL]
+
+# The treaty types that can be generated, and the risk levels each supports
+TREATY_RISK_LEVELS = {
+    common.REINS_TYPE_QUOTA_SHARE: [
+        common.REINS_RISK_LEVEL_ACCOUNT,
+        common.REINS_RISK_LEVEL_POLICY,
+        common.REINS_RISK_LEVEL_LOCATION],
+    common.REINS_TYPE_SURPLUS_SHARE: [common.REINS_RISK_LEVEL_LOCATION],
+    common.REINS_TYPE_PER_RISK: [
+        common.REINS_RISK_LEVEL_ACCOUNT,
+        common.REINS_RISK_LEVEL_POLICY,
+        common.REINS_RISK_LEVEL_LOCATION],
+    common.REINS_TYPE_FAC: [
+        common.REINS_RISK_LEVEL_ACCOUNT,
+        common.REINS_RISK_LEVEL_POLICY,
+        common.REINS_RISK_LEVEL_LOCATION],
+    common.REINS_TYPE_CAT_XL: [common.REINS_RISK_LEVEL_PORTFOLIO],
+}
+
+# The treaty types with a scope row for each chosen risk, rather than one
+# scope row for all the risks at the level
+SPECIFIC_SCOPE_TYPES = [common.REINS_TYPE_FAC, common.REINS_TYPE_SURPLUS_SHARE]
+
+# Building, other building, contents and BI, as in utils/genloc.sh
+DEFAULT_COVERAGE_SHARES = (0.5, 0.0, 0.25, 0.25)
+
+DEFAULT_TREATIES = [
+    Treaty(1, common.REINS_TYPE_FAC, common.REINS_RISK_LEVEL_LOCATION, 1, 0.1),
+    Treaty(2, common.REINS_TYPE_SURPLUS_SHARE, common.REINS_RISK_LEVEL_LOCATION, 2, 0.2),
+    Treaty(3, common.REINS_TYPE_QUOTA_SHARE, common.REINS_RISK_LEVEL_ACCOUNT, 1, 1.0),
+    Treaty(4, common.REINS_TYPE_CAT_XL, common.REINS_RISK_LEVEL_PORTFOLIO, 2, 1.0),
+]
+
+
+def get_treaties(treaty_types, risk_levels, inuring_depth, layer_count=1, scope_fraction=0.1):
+    """
+    Return treaties at inuring priorities 1 to inuring_depth, cycling
+    through the treaty types and, for each, the given risk levels that
+    the type supports.
+    """
+    treaties = []
+    for inuring_priority in range(1, inuring_depth + 1):
+        reins_type = treaty_types[(inuring_priority - 1) % len(treaty_types)]
+        type_risk_levels = [
+            risk_level for risk_level in risk_levels
+            if risk_level in TREATY_RISK_LEVELS[reins_type]]
+        if not type_risk_levels:
+            raise Exception("No risk level for {} in {}".format(
+                reins_type, ", ".join(risk_levels)))
+        treaties.append(Treaty(
+            inuring_priority=inuring_priority,
+            reins_type=reins_type,
+            risk_level=type_risk_levels[
+                (inuring_priority - 1) // len(treaty_types) % len(type_risk_levels)],
+            layer_count=layer_count,
+            scope_fraction=scope_fraction))
+    return treaties
+
+
+def get_tivs(random_state, count, distribution, mean):
+    """
+    Draw count location TIVs with the given distribution and mean.
+    """
+    if distribution == TIV_DISTRIBUTION_CONSTANT:
+        return np.full(count, float(mean))
+    if distribution == TIV_DISTRIBUTION_UNIFORM:
+        return random_state.uniform(0.0, 2.0 * mean, count).round(0)
+    if distribution == TIV_DISTRIBUTION_LOGNORMAL:
+        sigma = 1.0
+        return random_state.lognormal(
+            np.log(mean) - sigma * sigma / 2, sigma, count).round(0)
+    raise Exception("Unknown TIV distribution: {}".format(distribution))
+
+
+def generate_portfolio(
+        account_count,
+        locations_per_account,
+        policies_per_account=1,
+        tiv_distribution=TIV_DISTRIBUTION_CONSTANT,
+        tiv_mean=2000.0,
+        coverage_shares=DEFAULT_COVERAGE_SHARES,
+        location_deductible=0.0,
+        location_limit=0.0,
+        treaties=DEFAULT_TREATIES,
+        specific_scope_types=SPECIFIC_SCOPE_TYPES,
+        seed=0):
+    """
+    Generate a portfolio of account_count accounts, each with
+    locations_per_account locations and policies_per_account policies that
+    each cover all the account's locations.
+    The location deductibles and limits are fractions of the location TIV,
+    with zero for none. The treaty limits are set from tiv_mean, and the
+    treaties of specific_scope_types have specific scopes.
+    Returns (account_df, location_df, ri_info_df, ri_scope_df), as returned
+    by reinsurance_tester.load_oed_dfs, with None for no treaties.
+    """
+    random_state = np.random.RandomState(seed)
+    location_count = account_count * locations_per_account
+    policy_count = account_count * policies_per_account
+
+    account_df = pd.DataFrame({
+        'PortfolioNumber': 1,
+        'AccountNumber': np.repeat(
+            np.arange(1, account_count + 1), policies_per_account),
+        'PolicyNumber': np.arange(1, policy_count + 1),
+        'PerilCode': 'WW1',
+        'Ded6': 0.0,
+        'Limit6': 0.0}, columns=common.OED_ACCOUNT_FIELDS)
+
+    tivs = get_tivs(random_state, location_count, tiv_distribution, tiv_mean)
+    location_df = pd.DataFrame({
+        'AccountNumber': np.repeat(
+            np.arange(1, account_count + 1), locations_per_account),
+        'LocationNumber': np.arange(1, location_count + 1),
+        'Ded6': (tivs * location_deductible).round(0),
+        'Limit6': (tivs * location_limit).round(0)},
+        columns=common.OED_LOCATION_FIELDS[:4])
+    for (field, share) in zip(common.COVERAGE_TYPE_TIV_FIELDS.values(), coverage_shares):
+        location_df[field] = (tivs * share).round(0)
+
+    if not treaties:
+        return (account_df, location_df, None, None)
+    (ri_info_df, ri_scope_df) = generate_treaties(
+        random_state, account_df, location_df, treaties, tiv_mean,
+        specific_scope_types)
+    return (account_df, location_df, ri_info_df, ri_scope_df)
+
+
+def generate_treaties(
+        random_state, account_df, location_df, treaties, tiv_mean,
+        specific_scope_types=SPECIFIC_SCOPE_TYPES):
+    """
+    Generate the ri_info and ri_scope rows of each treaty, with the limits
+    of risk treaties set from the mean location TIV and those of CAT XL
+    treaties from the total TIV.
+    """
+    total_tiv = location_df[list(common.COVERAGE_TYPE_TIV_FIELDS.values())].values.sum()
+    ri_info = []
+    ri_scope = []
+    for treaty in treaties:
+        if treaty.risk_level not in TREATY_RISK_LEVELS.get(treaty.reins_type, []):
+            raise Exception("Cannot generate {} at risk level {}".format(
+                treaty.reins_type, treaty.risk_level))
+
+        # The specific scopes are shared by the layers of the treaty
+        risks = None
+        if treaty.reins_type in specific_scope_types:
+            risks = get_scope_risks(
+                random_state, account_df, location_df, treaty.risk_level,
+                treaty.scope_fraction)
+
+        for layer_number in range(1, treaty.layer_count + 1):
+            reins_number = len(ri_info) + 1
+            ceded_percent = 1.0
+            risk_limit = 0.0
+            risk_attachment = 0.0
+            occ_limit = 0.0
+            occ_attachment = 0.0
+            placement_percent = 1.0
+            if treaty.reins_type == common.REINS_TYPE_QUOTA_SHARE:
+                ceded_percent = 0.5 / treaty.layer_count
+                risk_limit = tiv_mean * 0.5
+            elif treaty.reins_type == common.REINS_TYPE_FAC:
+                risk_limit = tiv_mean * 0.25 * layer_number
+            elif treaty.reins_type == common.REINS_TYPE_PER_RISK:
+                risk_limit = tiv_mean * 0.25
+                risk_attachment = tiv_mean * 0.25 * (layer_number - 1)
+            elif treaty.reins_type == common.REINS_TYPE_CAT_XL:
+                occ_limit = total_tiv * 0.1
+                occ_attachment = total_tiv * 0.1 * layer_number
+                placement_percent = 0.5
+            ri_info.append((
+                reins_number, layer_number, ceded_percent, risk_limit, risk_attachment,
+                occ_limit, occ_attachment, treaty.inuring_priority,
+                treaty.reins_type, placement_percent, 1.0))
+
+            if risks is None:
+                ri_scope.append((
+                    reins_number, 1, np.nan, np.nan, np.nan, treaty.risk_level, 1.0))
+                continue
+            # The surplus share of each risk
+            scope_ceded_percent = 1.0
+            if treaty.reins_type == common.REINS_TYPE_SURPLUS_SHARE:
+                scope_ceded_percent = round(0.1 * layer_number, 2)
+            for (account_number, policy_number, location_number) in risks:
+                ri_scope.append((
+                    reins_number, 1, account_number, policy_number, location_number,
+                    treaty.risk_level, scope_ceded_percent))
+
+    ri_info_df = pd.DataFrame(ri_info, columns=common.OED_REINS_INFO_FIELDS)
+    ri_scope_df = pd.DataFrame(ri_scope, columns=common.OED_REINS_SCOPE_FIELDS)
+    return (ri_info_df, ri_scope_df)
+
+
+def get_scope_risks(random_state, account_df, location_df, risk_level, scope_fraction):
+    """
+    Choose scope_fraction of the accounts, policies or locations for
+    specific scopes at risk_level, as (account, policy, location) numbers,
+    with NaN for the levels below the risk level.
+    """
+    if risk_level == common.REINS_RISK_LEVEL_ACCOUNT:
+        risks = account_df.drop_duplicates('AccountNumber')[['AccountNumber']]
+        risks = risks.assign(PolicyNumber=np.nan, LocationNumber=np.nan)
+    elif risk_level == common.REINS_RISK_LEVEL_POLICY:
+        risks = account_df[['AccountNumber', 'PolicyNumber']].assign(
+            LocationNumber=np.nan)
+    else:
+        # A location is covered by each policy of its account
+        risks = pd.merge(
+            account_df[['AccountNumber', 'PolicyNumber']],
+            location_df[['AccountNumber', 'LocationNumber']],
+            on='AccountNumber')
+    count = max(1, int(round(len(risks.index) * scope_fraction)))
+    chosen = np.sort(random_state.choice(len(risks.index), count, replace=False))
+    return [
+        tuple(risk) for risk in
+        risks[['AccountNumber', 'PolicyNumber', 'LocationNumber']].values[chosen]]
+
+
+def write_portfolio(oed_dir, account_df, location_df, ri_info_df, ri_scope_df):
+    """
+    Write a portfolio to oed_dir as OED files, to be read by load_oed_dfs.
+    """
+    if not os.path.exists(oed_dir):
+        os.makedirs(oed_dir)
+    account_df.to_csv(os.path.join(oed_dir, "account.csv"), index=False)
+    location_df.to_csv(os.path.join(oed_dir, "location.csv"), index=False)
+    if ri_info_df is not None:
+        ri_info_df.to_csv(os.path.join(oed_dir, "ri_info.csv"), index=False)
+        ri_scope_df.to_csv(os.path.join(oed_dir, "ri_scope.csv"), index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic portfolio of OED inputs.')
+    parser.add_argument(
+        '-o', '--oed_dir', metavar='N', type=str, required=True,
+        help='The directory to write the OED files to.')
+    parser.add_argument(
+        '-a', '--accounts', metavar='N', type=int, default=10,
+        help='The number of accounts.')
+    parser.add_argument(
+        '-l', '--locations_per_account', metavar='N', type=int, default=100,
+        help='The number of locations in each account.')
+    parser.add_argument(
+        '-p', '--policies_per_account', metavar='N', type=int, default=1,
+        help='The number of policies in each account.')
+    parser.add_argument(
+        '-t', '--tiv_distribution', metavar='N', type=str,
+        default=TIV_DISTRIBUTION_CONSTANT, choices=TIV_DISTRIBUTIONS,
+        help='The distribution of location TIVs.')
+    parser.add_argument(
+        '--tiv_mean', metavar='N', type=float, default=2000.0,
+        help='The mean location TIV.')
+    parser.add_argument(
+        '--treaty_types', metavar='N', type=str, default=None,
+        help='A comma separated list of treaty types, e.g. "FAC,SS,PR,QS,CAT XL", '
+             'to cycle through the inuring priorities. By default a FAC, SS, '
+             'QS and CAT XL treaty are generated.')
+    parser.add_argument(
+        '--risk_levels', metavar='N', type=str,
+        default=",".join(common.REINS_RISK_LEVELS),
+        help='A comma separated list of the risk levels of the treaty types.')
+    parser.add_argument(
+        '--inuring_depth', metavar='N', type=int, default=4,
+        help='The number of inuring priorities of the treaty types.')
+    parser.add_argument(
+        '--layers', metavar='N', type=int, default=1,
+        help='The number of contracts in each inuring priority of the treaty types.')
+    parser.add_argument(
+        '-s', '--seed', metavar='N', type=int, default=0,
+        help='The random seed.')
+
+    args = parser.parse_args()
+
+    treaties = DEFAULT_TREATIES
+    if args.treaty_types is not None:
+        treaties = get_treaties(
+            args.treaty_types.split(","), args.risk_levels.split(","),
+            args.inuring_depth, layer_count=args.layers)
+
+    write_portfolio(args.oed_dir, *generate_portfolio(
+        args.accounts,
+        args.locations_per_account,
+        policies_per_account=args.policies_per_account,
+        tiv_distribution=args.tiv_distribution,
+        tiv_mean=args.tiv_mean,
+        treaties=treaties,
+        seed=args.seed))
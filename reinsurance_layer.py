@@ -1,12 +1,12 @@
 import pandas as pd
 import os
 import logging
-import subprocess
-import anytree
+import numpy as np
 import shutil
 import common
+import ktools_io
 import json
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 
 # Meta-data about an inuring layer
@@ -173,22 +173,303 @@ def validate_reinsurance_structures(account_df, location_df, ri_info_df, ri_scop
     return (main_is_valid, inuring_layers)
 
 
+class ProgramHierarchy(object):
+    """
+    The program tree of a reinsurance layer, held as arrays with one element
+    per node. The nodes are in level order: the program node, then the risk
+    level nodes, then the items. Each node has a level_id, an agg_id and the
+    index of its parent node. The account, policy and location numbers of
+    the nodes are integer coded, with -1 where they are not set.
+    """
+
+    PROGRAM_NODE = 0
+    NUMBER_FIELDS = ['account_number', 'policy_number', 'location_number']
+
+    def __init__(self, risk_level, level_ids, agg_ids, parents, risk_numbers):
+        """
+        risk_numbers maps each number field to its values for the risk level
+        nodes, or None if it is not set on them.
+        """
+        self.risk_level = risk_level
+        self.level_ids = level_ids
+        self.agg_ids = agg_ids
+        self.parents = parents
+        self.risk_nodes = np.flatnonzero(level_ids == 2)
+        # The nodes that have profiles, the program node and any risk level
+        # nodes, come first in level order
+        self.profile_nodes = np.flatnonzero(level_ids > 1)
+        self._fm_programmes = None
+        self.codes = {}
+        self.code_values = {}
+        self._value_codes = {}
+        for field in self.NUMBER_FIELDS:
+            codes = np.full(len(level_ids), -1)
+            values = np.array([])
+            if risk_numbers[field] is not None:
+                (codes[self.risk_nodes], values) = pd.factorize(risk_numbers[field])
+            self.codes[field] = codes
+            self.code_values[field] = values
+            self._value_codes[field] = {
+                value: code for (code, value) in enumerate(values.tolist())}
+        self.all_node_index = NodeIndex(self, self.profile_nodes)
+        self.risk_node_index = NodeIndex(self, self.risk_nodes)
+
+    def __len__(self):
+        return len(self.level_ids)
+
+    def get_code(self, field, value):
+        """
+        Return the code of a number, or None if no node has that number.
+        """
+        return self._value_codes[field].get(value)
+
+    def get_number(self, field, node):
+        code = self.codes[field][node]
+        if code < 0:
+            return common.NOT_SET_ID
+        return self.code_values[field][code]
+
+    def get_name(self, node):
+        if node == self.PROGRAM_NODE:
+            return "Treaty"
+        if self.level_ids[node] == 1:
+            return "Item_id:{}".format(self.agg_ids[node])
+        if self.risk_level == common.REINS_RISK_LEVEL_ACCOUNT:
+            return "Account_number:{}".format(
+                self.get_number('account_number', node))
+        return "Account_number:{} Policy_number:{} Location_number:{}".format(
+            *[self.get_number(field, node) for field in self.NUMBER_FIELDS])
+
+    def get_fm_programmes(self):
+        """
+        Return the fm_programme rows, one per node below the program node.
+        """
+        if self._fm_programmes is None:
+            nodes = np.flatnonzero(self.parents >= 0)
+            self._fm_programmes = pd.DataFrame({
+                'from_agg_id': self.agg_ids[nodes],
+                'level_id': self.level_ids[nodes],
+                'to_agg_id': self.agg_ids[self.parents[nodes]]
+            }, columns=common.FmProgramme._fields)
+        return self._fm_programmes
+
+    def render(self):
+        """
+        Render the tree as text, for debugging.
+        """
+        children = [[] for _ in range(len(self))]
+        for (node, parent) in enumerate(self.parents.tolist()):
+            if parent >= 0:
+                children[parent].append(node)
+        lines = []
+        stack = [(self.PROGRAM_NODE, 0)]
+        while stack:
+            (node, depth) = stack.pop()
+            lines.append("{}{} (level_id={}, agg_id={})".format(
+                "    " * depth, self.get_name(node),
+                self.level_ids[node], self.agg_ids[node]))
+            stack.extend((child, depth + 1) for child in reversed(children[node]))
+        return "\n".join(lines)
+
+
+class NodeIndex(object):
+    """
+    Hash indexes of program hierarchy nodes by their account, policy and
+    location numbers, so that the nodes matching a scope row are found by
+    dictionary lookup rather than by searching the tree. An index is built
+    the first time a combination of fields is looked up.
+    """
+
+    def __init__(self, hierarchy, nodes):
+        self.hierarchy = hierarchy
+        self.nodes = np.asarray(nodes)
+        self._indexes = {}
+
+    def find(self, **field_values):
+        """
+        Return the nodes whose fields equal the given values, e.g.
+        find(account_number=1, policy_number=2).
+        """
+        fields = tuple(sorted(field_values.keys()))
+        key = tuple(
+            self.hierarchy.get_code(field, field_values[field])
+            for field in fields)
+        if None in key:
+            return []
+        if fields not in self._indexes:
+            index = {}
+            columns = [self.hierarchy.codes[field][self.nodes].tolist() for field in fields]
+            for (node, node_key) in zip(self.nodes.tolist(), zip(*columns)):
+                index.setdefault(node_key, []).append(node)
+            self._indexes[fields] = index
+        return self._indexes[fields].get(key, [])
+
+
+# The number field that starts a new risk level node when it changes
+RISK_LEVEL_FIELDS = {
+    common.REINS_RISK_LEVEL_ACCOUNT: 'account_number',
+    common.REINS_RISK_LEVEL_POLICY: 'policy_number',
+    common.REINS_RISK_LEVEL_LOCATION: 'location_number'
+}
+
+
+def sort_for_hierarchy(xref_descriptions):
+    """
+    Sort items by location, policy and account, the order of the items in
+    a program hierarchy.
+    """
+    return xref_descriptions.sort_values(
+        by=["location_number", "policy_number", "account_number"])
+
+
+def get_risk_starts(xref_descriptions, risk_level):
+    """
+    Return whether each of the items, sorted by sort_for_hierarchy, starts a
+    new risk level node. The items of a site all have the same numbers, so
+    the sites can be used in place of their items.
+    """
+    group_numbers = xref_descriptions[RISK_LEVEL_FIELDS[risk_level]].values
+    is_first = np.empty(len(group_numbers), dtype=bool)
+    is_first[:1] = group_numbers[:1] != 0
+    is_first[1:] = group_numbers[1:] != group_numbers[:-1]
+    return is_first
+
+
+def get_program_hierarchy(xref_descriptions, risk_level):
+    """
+    Build the program hierarchy for a risk level. The items are sorted
+    by location, policy and account, and a risk level node is started
+    whenever the account (ACC), policy (POL) or location (LOC) number
+    changes from the previous item. At portfolio level (SEL) the items
+    are directly under the program node.
+    """
+    program_node_level_id = 3
+    if risk_level == common.REINS_RISK_LEVEL_PORTFOLIO:
+        program_node_level_id = 2
+
+    xref_descriptions = sort_for_hierarchy(xref_descriptions)
+    item_count = len(xref_descriptions.index)
+    item_ids = xref_descriptions.xref_id.values
+    risk_numbers = dict.fromkeys(ProgramHierarchy.NUMBER_FIELDS)
+
+    if risk_level == common.REINS_RISK_LEVEL_PORTFOLIO:
+        risk_count = 0
+        item_parents = np.zeros(item_count, dtype=np.int64)
+    else:
+        is_first = get_risk_starts(xref_descriptions, risk_level)
+        risk_count = int(is_first.sum())
+        # Items before the first risk level node have no parent
+        item_parents = np.cumsum(is_first)
+        item_parents[item_parents == 0] = -1
+
+        fields = ProgramHierarchy.NUMBER_FIELDS
+        if risk_level == common.REINS_RISK_LEVEL_ACCOUNT:
+            fields = ['account_number']
+        for field in fields:
+            risk_numbers[field] = xref_descriptions[field].values[is_first]
+
+    parents = np.concatenate([
+        [-1],
+        np.zeros(risk_count, dtype=np.int64),
+        item_parents]).astype(np.int64)
+    return ProgramHierarchy(
+        risk_level=risk_level,
+        level_ids=np.concatenate([
+            [program_node_level_id],
+            np.full(risk_count, 2),
+            np.full(item_count, 1)]).astype(np.int64),
+        agg_ids=np.concatenate([
+            [1], np.arange(1, risk_count + 1), item_ids]).astype(np.int64),
+        parents=parents,
+        risk_numbers=risk_numbers)
+
+
+class HierarchyCache(object):
+    """
+    The program hierarchies of a run, built once per risk level and shared
+    by all the reinsurance layers at that risk level. The hierarchy only
+    depends on the items, so later inuring priorities reuse the sorted item
+    order, agg_ids, fm_programme and node indexes, and only compute their
+    profiles.
+    """
+
+    def __init__(self, xref_descriptions):
+        self.xref_descriptions = xref_descriptions
+        self._hierarchies = {}
+
+    def get(self, risk_level):
+        if risk_level not in self._hierarchies:
+            self._hierarchies[risk_level] = get_program_hierarchy(
+                self.xref_descriptions, risk_level)
+        return self._hierarchies[risk_level]
+
+
+def get_structure_counts(site_items, ri_info, ri_scope, risk_level):
+    """
+    Count the rows of the structures of a reinsurance layer without
+    creating them, from the numbers and item counts of the sites with
+    items, as returned by DirectLayer.get_structure_counts.
+    The risk level nodes are counted from the sites. The profiles and
+    layers are counted by running the overlays of generate_oasis_structures
+    on a hierarchy without items, with only the scope rows that give
+    distinct profiles, so the count does not grow with the portfolio.
+    """
+    site_items = sort_for_hierarchy(site_items)
+    item_counts = site_items.item_count.values
+    item_count = int(item_counts.sum())
+    if risk_level == common.REINS_RISK_LEVEL_PORTFOLIO:
+        risk_count = 0
+        parented_item_count = item_count
+    else:
+        is_first = get_risk_starts(site_items, risk_level)
+        risk_count = int(is_first.sum())
+        # Items before the first risk level node have no parent
+        parented_item_count = int(item_counts[np.cumsum(is_first) > 0].sum())
+
+    # The profiles of the scope rows of a contract only differ by CededPercent
+    layer = ReinsuranceLayer(
+        name="plan",
+        ri_info=ri_info,
+        ri_scope=ri_scope[ri_scope.RiskLevel == risk_level].drop_duplicates(
+            subset=['ReinsNumber', 'CededPercent']),
+        accounts=None,
+        locations=None,
+        items=pd.DataFrame(columns=common.Item._fields),
+        coverages=pd.DataFrame(columns=common.Coverage._fields),
+        fm_xrefs=pd.DataFrame(columns=common.FmXref._fields),
+        xref_descriptions=pd.DataFrame(columns=common.XrefDescription._fields),
+        risk_level=risk_level)
+    layer.generate_oasis_structures()
+    # Without items, the program node is the only profile node
+    layer_count = len(layer.fm_policytcs.index)
+
+    return OrderedDict([
+        ('items', item_count),
+        ('coverages', item_count // len(common.PERILS)),
+        ('nodes', 1 + risk_count + item_count),
+        ('programmes', risk_count + parented_item_count),
+        ('profiles', len(layer.fmprofiles.index)),
+        ('policytcs', layer_count * (1 + risk_count)),
+        ('layers', layer_count)])
+
+
 class ReinsuranceLayer(object):
     """
     Generates ktools inputs and runs financial module for a reinsurance structure.
     """
 
     def __init__(self, name, ri_info, ri_scope, accounts, locations,
-                 items, coverages, fm_xrefs, xref_descriptions, risk_level, logger=None):
+                 items, coverages, fm_xrefs, xref_descriptions, risk_level, logger=None,
+                 hierarchy_cache=None):
 
         self.logger = logger or logging.getLogger()
         self.name = name
         self.accounts = accounts
         self.locations = locations
 
-        self.coverages = items
-        self.items = coverages
-        self.fm_xrefs = fm_xrefs
+        self.coverages = coverages
+        self.items = items
+        self.fm_xrefs = fm_xrefs.copy()
         self.xref_descriptions = xref_descriptions
 
         self.item_ids = list()
@@ -198,121 +479,62 @@ class ReinsuranceLayer(object):
         self.fm_policytcs = pd.DataFrame()
 
         self.risk_level = risk_level
+        self.hierarchy_cache = hierarchy_cache
 
         self.ri_info = ri_info
         self.ri_scope = ri_scope
 
         self.add_profiles_args = namedtuple(
             "AddProfilesArgs",
-            "program_node, ri_info_row, scope_rows, overlay_loop, layer_id, "
-            "node_layer_profile_map, fmprofiles_list, nolossprofile_id, passthroughprofile_id")
-
-    def _add_program_node(self, level_id):
-        return anytree.Node(
-            "Treaty",
-            parent=None,
-            level_id=level_id,
-            agg_id=1,
-            account_number=common.NOT_SET_ID,
-            policy_number=common.NOT_SET_ID,
-            location_number=common.NOT_SET_ID)
-
-    def _add_item_node(self, xref_id, parent):
-        return anytree.Node(
-            "Item_id:{}".format(xref_id),
-            parent=parent,
-            level_id=1,
-            agg_id=xref_id,
-            account_number=common.NOT_SET_ID,
-            policy_number=common.NOT_SET_ID,
-            location_number=common.NOT_SET_ID)
-
-    def _add_location_node(
-            self, level_id, agg_id, xref_description, parent):
-        return anytree.Node(
-            "Account_number:{} Policy_number:{} Location_number:{}".format(
-                xref_description.account_number,
-                xref_description.policy_number,
-                xref_description.location_number),
-            parent=parent,
-            level_id=level_id,
-            agg_id=agg_id,
-            account_number=xref_description.account_number,
-            policy_number=xref_description.policy_number,
-            location_number=xref_description.location_number)
-
-    def _add_policy_node(
-            self, level_id, agg_id, xref_description, parent):
-        return anytree.Node(
-            "Account_number:{} Policy_number:{}".format(
-                xref_description.account_number, xref_description.policy_number),
-            parent=parent,
-            level_id=level_id,
-            agg_id=agg_id,
-            account_number=xref_description.account_number,
-            policy_number=xref_description.policy_number,
-            location_number=common.NOT_SET_ID)
-
-    def _add_account_node(
-            self, agg_id, level_id, xref_description, parent):
-        return anytree.Node(
-            "Account_number:{}".format(xref_description.account_number),
-            parent=parent,
-            level_id=level_id,
-            agg_id=agg_id,
-            account_number=xref_description.account_number,
-            policy_number=common.NOT_SET_ID,
-            location_number=common.NOT_SET_ID)
-
-
-
-    def _does_location_node_match_scope_row(self, node, ri_scope_row):
-        node_summary = (node.account_number,
-                        node.policy_number, node.location_number)
-        scope_row_summary = (ri_scope_row.AccountNumber,
-                             ri_scope_row.PolicyNumber, ri_scope_row.LocationNumber)
-        if (node_summary == scope_row_summary):
-            self.logger.debug('Matching node: location to scope\n node: {}, ri_scope: {}'.format(
-                str(node_summary),
-                str(scope_row_summary),
-            ))
-        return (node_summary == scope_row_summary)
-
-    def _does_policy_node_match_scope_row(self, node, ri_scope_row):
-        node_summary = (node.account_number,
-                        node.policy_number, common.NOT_SET_ID)
-        scope_row_summary = (ri_scope_row.AccountNumber, ri_scope_row.PolicyNumber, common.NOT_SET_ID)
-        if (node_summary == scope_row_summary):
-            self.logger.debug('Matching node: policy to scope\n node: {}, ri_scope: {}'.format(
-                str(node_summary),
-                str(scope_row_summary),
-            ))
-        return (node_summary == scope_row_summary)
-
-    def _does_account_node_match_scope_row(self, node, ri_scope_row):
-        node_summary = (node.account_number,
-                        common.NOT_SET_ID, common.NOT_SET_ID)
-        scope_row_summary = (ri_scope_row.AccountNumber,
-                             common.NOT_SET_ID, common.NOT_SET_ID)
-        if (node_summary == scope_row_summary):
-            self.logger.debug('Matching node: account to scope\n node: {}, ri_scope: {}'.format(
-                str(node_summary),
-                str(scope_row_summary),
-            ))
-        return (node_summary == scope_row_summary)
-
-    # More generic but slower (testing only)
-    def _match_node(self, node, search_dict):
-        node_dict = {
-            'AccountNumber':  node.account_number,
-            'PolicyNumber':   node.policy_number,
-            'LocationNumber': node.location_number,
-        }
-        self.logger.debug('Matching node: \n\t node: {}, \n\t search: {}'.format(
-            str(node_dict),
-            str(search_dict),
-        ))
-        return search_dict.items() <= node_dict.items()
+            "hierarchy, ri_info_row, scope_rows, overlay_loop, layer_id, "
+            "overlay_profiles, profiles, nolossprofile_id, passthroughprofile_id, "
+            "all_nodes, risk_nodes")
+
+    def _find_scope_nodes(self, node_index, ri_scope_row):
+        """
+        Find the nodes that match a scope row at the scope row's risk level.
+        Location scopes match on account, policy and location number, policy
+        scopes on account and policy number, and account scopes on account number.
+        """
+        if ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_LOCATION:
+            nodes = node_index.find(
+                account_number=ri_scope_row.AccountNumber,
+                policy_number=ri_scope_row.PolicyNumber,
+                location_number=ri_scope_row.LocationNumber)
+        elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_POLICY:
+            nodes = node_index.find(
+                account_number=ri_scope_row.AccountNumber,
+                policy_number=ri_scope_row.PolicyNumber)
+        elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_ACCOUNT:
+            nodes = node_index.find(
+                account_number=ri_scope_row.AccountNumber)
+        else:
+            raise Exception(
+                "Unsupported risk level: {}".format(ri_scope_row.RiskLevel))
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            for node in nodes:
+                self.logger.debug('Matching node: {} to scope\n node: {}, ri_scope: {}'.format(
+                    ri_scope_row.RiskLevel,
+                    str(tuple(
+                        node_index.hierarchy.get_number(field, node)
+                        for field in ProgramHierarchy.NUMBER_FIELDS)),
+                    str((ri_scope_row.AccountNumber, ri_scope_row.PolicyNumber, ri_scope_row.LocationNumber)),
+                ))
+        return nodes
+
+    def _filter_scope_nodes(self, node_index, ri_scope_row):
+        """
+        Find the nodes that match the number of a scope row at its risk level,
+        or all of the nodes if that number is not set.
+        """
+        if (ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_ACCOUNT) and self._is_defined(ri_scope_row.AccountNumber):
+            return node_index.find(account_number=ri_scope_row.AccountNumber)
+        elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_LOCATION and self._is_defined(ri_scope_row.LocationNumber):
+            return node_index.find(location_number=ri_scope_row.LocationNumber)
+        elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_POLICY and self._is_defined(ri_scope_row.PolicyNumber):
+            return node_index.find(policy_number=ri_scope_row.PolicyNumber)
+        return node_index.nodes.tolist()
 
     def _is_defined(self, num_to_check):
         # If the value = NaN it will return False
@@ -320,53 +542,13 @@ class ReinsuranceLayer(object):
 
 
     def _get_tree(self):
-        current_location_number = 0
-        current_policy_number = 0
-        current_account_number = 0
-        current_location_node = None
-        current_policy_node = None
-        current_account_node = None
-
-        program_node_level_id = 3
-        if self.risk_level == common.REINS_RISK_LEVEL_PORTFOLIO:
-            program_node_level_id = 2
-
-        program_node = self._add_program_node(program_node_level_id)
-
-        xref_descriptions = self.xref_descriptions.sort_values(
-            by=["location_number", "policy_number", "account_number"])
-        agg_id = 0
-        if self.risk_level == common.REINS_RISK_LEVEL_PORTFOLIO:
-            for _, row in xref_descriptions.iterrows():
-                self._add_item_node(row.xref_id, program_node)
-        elif self.risk_level == common.REINS_RISK_LEVEL_ACCOUNT:
-            for _, row in xref_descriptions.iterrows():
-                if current_account_number != row.account_number:
-                    agg_id = agg_id + 1
-                    level_id = 2
-                    current_account_number = row.account_number
-                    current_account_node = self._add_account_node(
-                        agg_id, level_id, row, program_node)
-                self._add_item_node(row.xref_id, current_account_node)
-        elif self.risk_level == common.REINS_RISK_LEVEL_POLICY:
-            for _, row in xref_descriptions.iterrows():
-                if current_policy_number != row.policy_number:
-                    agg_id = agg_id + 1
-                    level_id = 2
-                    current_policy_number = row.policy_number
-                    current_policy_node = self._add_location_node(
-                        level_id, agg_id, row, program_node)
-                self._add_item_node(row.xref_id, current_policy_node)
-        elif self.risk_level == common.REINS_RISK_LEVEL_LOCATION:
-            for _, row in xref_descriptions.iterrows():
-                if current_location_number != row.location_number:
-                    agg_id = agg_id + 1
-                    level_id = 2
-                    current_location_number = row.location_number
-                    current_location_node = self._add_location_node(
-                        level_id, agg_id, row, program_node)
-                self._add_item_node(row.xref_id, current_location_node)
-        return program_node
+        """
+        Return the program hierarchy for the risk level, from the hierarchy
+        cache if the layer has one.
+        """
+        if self.hierarchy_cache is not None:
+            return self.hierarchy_cache.get(self.risk_level)
+        return get_program_hierarchy(self.xref_descriptions, self.risk_level)
 
 #    def _add_occ_limit(self, add_profiles_args):
         
@@ -374,12 +556,8 @@ class ReinsuranceLayer(object):
 
     def _add_fac_profiles(self, add_profiles_args):
         self.logger.debug("Adding FAC profiles:")
-        profile_id = max(
-            x.profile_id for x in add_profiles_args.fmprofiles_list)
-
-        profile_id = profile_id + 1
-        add_profiles_args.fmprofiles_list.append(common.get_reinsurance_profile(
-            profile_id,
+        profile_id = add_profiles_args.profiles.add(common.get_reinsurance_profile(
+            None,
             attachment=add_profiles_args.ri_info_row.RiskAttachmentPoint,
             limit=add_profiles_args.ri_info_row.RiskLimit,
             ceded=add_profiles_args.ri_info_row.CededPercent,
@@ -387,109 +565,55 @@ class ReinsuranceLayer(object):
         ))
 
         for _, ri_scope_row in add_profiles_args.scope_rows.iterrows():
-            if ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_LOCATION:
-                nodes = anytree.search.findall(
-                    add_profiles_args.program_node,
-                    filter_=lambda node: self._does_location_node_match_scope_row(node, ri_scope_row))
-                for node in nodes:
-                    add_profiles_args.node_layer_profile_map[(
-                        node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
-            elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_POLICY:
-                nodes = anytree.search.findall(
-                    add_profiles_args.program_node,
-                    filter_=lambda node: self._does_policy_node_match_scope_row(node, ri_scope_row))
-                for node in nodes:
-                    add_profiles_args.node_layer_profile_map[(
-                        node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
-            elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_ACCOUNT:
-                nodes = anytree.search.findall(
-                    add_profiles_args.program_node,
-                    filter_=lambda node: self._does_account_node_match_scope_row(node, ri_scope_row))
-                for node in nodes:
-                    add_profiles_args.node_layer_profile_map[(
-                        node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
-            else:
-                raise Exception(
-                    "Unsupported risk level: {}".format(ri_scope_row.RiskLevel))
+            nodes = self._find_scope_nodes(add_profiles_args.all_nodes, ri_scope_row)
+            add_profiles_args.overlay_profiles[nodes] = profile_id
 
     # Need to check Matching rules for Per Risk with Joh
     def _add_per_risk_profiles(self, add_profiles_args):
         self.logger.debug("Adding PR profiles:")
-        profile_id = max(
-            x.profile_id for x in add_profiles_args.fmprofiles_list)
 
         for _, ri_scope_row in add_profiles_args.scope_rows.iterrows():
-            profile_id = profile_id + 1
-            add_profiles_args.fmprofiles_list.append(common.get_reinsurance_profile(
-                profile_id,
+            profile_id = add_profiles_args.profiles.add(common.get_reinsurance_profile(
+                None,
                 attachment=add_profiles_args.ri_info_row.RiskAttachmentPoint,
                 limit=add_profiles_args.ri_info_row.RiskLimit,
                 placement=add_profiles_args.ri_info_row.PlacementPercent
             ))
 
-            nodes = anytree.search.findall(
-                add_profiles_args.program_node, filter_=lambda node: node.level_id == 2)
-            for node in nodes:
-                add_profiles_args.node_layer_profile_map[(
-                    node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
+            add_profiles_args.overlay_profiles[add_profiles_args.risk_nodes.nodes] = profile_id
 
             # Check ri_info row for overall OccLimit
-            profile_id = profile_id + 1
-            add_profiles_args.fmprofiles_list.append(
+            profile_id = add_profiles_args.profiles.add(
                 common.get_occlim_profile(
-                    profile_id,
+                    None,
                     limit=add_profiles_args.ri_info_row.OccLimit,
             ))
-            add_profiles_args.node_layer_profile_map[
-                (add_profiles_args.program_node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
+            add_profiles_args.overlay_profiles[ProgramHierarchy.PROGRAM_NODE] = profile_id
 
 
     def _add_surplus_share_profiles(self, add_profiles_args):
         self.logger.debug("Adding SS profiles:")
 
-        profile_id = max( x.profile_id for x in add_profiles_args.fmprofiles_list)
-        nodes_all = anytree.search.findall(
-               add_profiles_args.program_node, filter_=lambda node: node.level_id == 2)
-
         for _, ri_scope_row in add_profiles_args.scope_rows.iterrows():
-            profile_id = profile_id + 1
-            add_profiles_args.fmprofiles_list.append(common.get_reinsurance_profile(
-                profile_id,
+            profile_id = add_profiles_args.profiles.add(common.get_reinsurance_profile(
+                None,
                 attachment=add_profiles_args.ri_info_row.RiskAttachmentPoint,
                 limit=add_profiles_args.ri_info_row.RiskLimit,
                 ceded=ri_scope_row.CededPercent,
             ))
-            
-            if ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_LOCATION:
-                selected_nodes = list(filter(lambda n: self._does_location_node_match_scope_row(n,ri_scope_row), nodes_all))
-                for node in selected_nodes:
-                    add_profiles_args.node_layer_profile_map[(
-                        node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
-            elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_POLICY:
-                selected_nodes = list(filter(lambda n: self._does_policy_node_match_scope_row(n,ri_scope_row), nodes_all))
-                for node in selected_nodes:
-                    add_profiles_args.node_layer_profile_map[(
-                        node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
-            elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_ACCOUNT:
-                selected_nodes = list(filter(lambda n: self._does_account_node_match_scope_row(n,ri_scope_row), nodes_all))
-                for node in selected_nodes:
-                    add_profiles_args.node_layer_profile_map[(
-                        node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
-            else:
-                raise Exception(
-                    "Unsupported risk level: {}".format(ri_scope_row.RiskLevel))
+
+            selected_nodes = self._find_scope_nodes(add_profiles_args.risk_nodes, ri_scope_row)
+            add_profiles_args.overlay_profiles[selected_nodes] = profile_id
 
 
         # add OccLimit / Placed Percent
-        profile_id = profile_id + 1
-        add_profiles_args.fmprofiles_list.append(
+        profile_id = add_profiles_args.profiles.add(
             common.get_occlim_profile(
-                profile_id,
+                None,
                 limit=add_profiles_args.ri_info_row.OccLimit,
                 placement=add_profiles_args.ri_info_row.PlacementPercent,
         ))
-        add_profiles_args.node_layer_profile_map[
-            (add_profiles_args.program_node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
+        add_profiles_args.overlay_profiles[ProgramHierarchy.PROGRAM_NODE] = profile_id
 
 
 
@@ -497,114 +621,97 @@ class ReinsuranceLayer(object):
     def _add_quota_share_profiles(self, add_profiles_args):
         self.logger.debug("Adding QS profiles:")
 
-        profile_id = max( x.profile_id for x in add_profiles_args.fmprofiles_list)
-        nodes_all = anytree.search.findall(
-               add_profiles_args.program_node, filter_=lambda node: node.level_id == 2)
-
         # Add any risk limits
         # RISK LEVEL SEL
         if self.risk_level == common.REINS_RISK_LEVEL_PORTFOLIO:
-            profile_id = profile_id + 1
-            add_profiles_args.fmprofiles_list.append(
+            add_profiles_args.profiles.add(
                 common.get_reinsurance_profile(
-                    profile_id,
+                    None,
                     limit=add_profiles_args.ri_info_row.OccLimit,
                     ceded=add_profiles_args.ri_info_row.CededPercent,
                     placement=add_profiles_args.ri_info_row.PlacementPercent
             ))
         else:
             for _, ri_scope_row in add_profiles_args.scope_rows.iterrows():
-                profile_id = profile_id + 1
-
-                add_profiles_args.fmprofiles_list.append(
+                profile_id = add_profiles_args.profiles.add(
                     common.get_reinsurance_profile(
-                        profile_id,
+                        None,
                         limit=add_profiles_args.ri_info_row.RiskLimit,
                         ceded=add_profiles_args.ri_info_row.CededPercent,
                     ))
 
                 # Filter 
-                if (ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_ACCOUNT) and self._is_defined(ri_scope_row.AccountNumber):
-                    selected_nodes = list(filter(lambda n: n.account_number == ri_scope_row.AccountNumber, nodes_all))
-                elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_LOCATION and  self._is_defined(ri_scope_row.LocationNumber):
-                    selected_nodes = list(filter(lambda n: n.location_number == ri_scope_row.LocationNumber, nodes_all))
-                elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_POLICY and self._is_defined(ri_scope_row.PolicyNumber):
-                    selected_nodes = list(filter(lambda n: n.policy_number == ri_scope_row.PolicyNumber, nodes_all))
-                else:
-                    selected_nodes = nodes_all
-                for node in selected_nodes:
-                    add_profiles_args.node_layer_profile_map[(
-                        node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
+                selected_nodes = self._filter_scope_nodes(add_profiles_args.risk_nodes, ri_scope_row)
+                add_profiles_args.overlay_profiles[selected_nodes] = profile_id
 
 
         # add OccLimit / Placed Percent
-        profile_id = profile_id + 1
-        add_profiles_args.fmprofiles_list.append(
+        profile_id = add_profiles_args.profiles.add(
             common.get_occlim_profile(
-                profile_id,
+                None,
                 limit=add_profiles_args.ri_info_row.OccLimit,
                 placement=add_profiles_args.ri_info_row.PlacementPercent,
         ))
-        add_profiles_args.node_layer_profile_map[
-            (add_profiles_args.program_node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
+        add_profiles_args.overlay_profiles[ProgramHierarchy.PROGRAM_NODE] = profile_id
 
     def _add_cat_xl_profiles(self, add_profiles_args):
         self.logger.debug("Adding CAT XL profiles:")
-        profile_id = max(
-            x.profile_id for x in add_profiles_args.fmprofiles_list)
 
         if self.risk_level == common.REINS_RISK_LEVEL_PORTFOLIO:
-            profile_id = profile_id + 1
-            add_profiles_args.fmprofiles_list.append(
+            profile_id = add_profiles_args.profiles.add(
                 common.get_reinsurance_profile(
-                    profile_id,
+                    None,
                     attachment=add_profiles_args.ri_info_row.OccurenceAttachmentPoint,
                     limit=add_profiles_args.ri_info_row.OccLimit,
                     placement=add_profiles_args.ri_info_row.PlacementPercent,
                     ceded=add_profiles_args.ri_info_row.CededPercent,
                 ))
-            add_profiles_args.node_layer_profile_map[
-                (add_profiles_args.program_node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
+            add_profiles_args.overlay_profiles[ProgramHierarchy.PROGRAM_NODE] = profile_id
 
         else:
-            nodes_all = anytree.search.findall(
-                   add_profiles_args.program_node, filter_=lambda node: node.level_id == 2)
-
             for _, ri_scope_row in add_profiles_args.scope_rows.iterrows():
-                profile_id = profile_id + 1
-
-                add_profiles_args.fmprofiles_list.append(
+                profile_id = add_profiles_args.profiles.add(
                     common.get_pass_through_profile(
-                        profile_id,
+                        None,
                     )
                 )
 
                 # Filter 
-                if (ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_ACCOUNT) and self._is_defined(ri_scope_row.AccountNumber):
-                    selected_nodes = list(filter(lambda n: n.account_number == ri_scope_row.AccountNumber, nodes_all))
-                elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_LOCATION and  self._is_defined(ri_scope_row.LocationNumber):
-                    selected_nodes = list(filter(lambda n: n.location_number == ri_scope_row.LocationNumber, nodes_all))
-                elif ri_scope_row.RiskLevel == common.REINS_RISK_LEVEL_POLICY and self._is_defined(ri_scope_row.PolicyNumber):
-                    selected_nodes = list(filter(lambda n: n.policy_number == ri_scope_row.PolicyNumber, nodes_all))
-                else:
-                    selected_nodes = nodes_all
-                for node in selected_nodes:
-                    add_profiles_args.node_layer_profile_map[(
-                        node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
+                selected_nodes = self._filter_scope_nodes(add_profiles_args.risk_nodes, ri_scope_row)
+                add_profiles_args.overlay_profiles[selected_nodes] = profile_id
 
 
             # add OccLimit / Placed Percent
-            profile_id = profile_id + 1
-            add_profiles_args.fmprofiles_list.append(
+            profile_id = add_profiles_args.profiles.add(
                 common.get_reinsurance_profile(
-                    profile_id,
+                    None,
                     attachment=add_profiles_args.ri_info_row.OccurenceAttachmentPoint,
                     ceded=add_profiles_args.ri_info_row.CededPercent,
                     limit=add_profiles_args.ri_info_row.OccLimit,
                     placement=add_profiles_args.ri_info_row.PlacementPercent,
             ))
-            add_profiles_args.node_layer_profile_map[
-                (add_profiles_args.program_node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = profile_id
+            add_profiles_args.overlay_profiles[ProgramHierarchy.PROGRAM_NODE] = profile_id
+
+    def _get_fm_policytcs(
+            self, hierarchy, overlay_profiles, overlay_layer_ids, layer_count,
+            profiles, nolossprofile_id):
+        """
+        Combine the overlays of each layer, taking the latest profile added
+        to each node, and return the fm_policytcs of the profile nodes in
+        each layer. Nodes without a profile in a layer have no loss.
+        """
+        profile_nodes = hierarchy.profile_nodes
+        layer_profiles = np.full((layer_count, len(profile_nodes)), nolossprofile_id)
+        for layer in range(1, layer_count + 1):
+            layer_overlays = overlay_layer_ids == layer
+            if layer_overlays.any():
+                layer_profiles[layer - 1] = overlay_profiles[layer_overlays].max(axis=0)
+        return pd.DataFrame({
+            'layer_id': np.repeat(np.arange(1, layer_count + 1), len(profile_nodes)),
+            'level_id': np.tile(hierarchy.level_ids[profile_nodes] - 1, layer_count),
+            'agg_id': np.tile(hierarchy.agg_ids[profile_nodes], layer_count),
+            'profile_id': profiles.get_profile_ids(layer_profiles.ravel())
+        }, columns=common.FmPolicyTc._fields)
 
     def generate_oasis_structures(self):
         '''
@@ -617,38 +724,30 @@ class ReinsuranceLayer(object):
         Step 3 - Iterate over the tree and write out the Oasis structure.
         '''
 
-        fmprogrammes_list = list()
-        fmprofiles_list = list()
-        fm_policytcs_list = list()
-
-        profile_id = 1
-        nolossprofile_id = profile_id
-        fmprofiles_list.append(
-            common.get_no_loss_profile(nolossprofile_id))
-        profile_id = profile_id + 1
-        passthroughprofile_id = profile_id
-        fmprofiles_list.append(
-            common.get_pass_through_profile(passthroughprofile_id))
-
-        node_layer_profile_map = {}
-
-        self.logger.debug(fmprofiles_list)
+        # The overlays hold profile references, which are mapped to the
+        # deduplicated fm_profile IDs once the layers are combined
+        profiles = common.ProfileRegistry()
+        nolossprofile_id = profiles.add(common.get_no_loss_profile(None))
+        passthroughprofile_id = profiles.add(common.get_pass_through_profile(None))
 
 
         #
         # Step 1 - Build a tree representation of the insurance program, depening on the reinsuarnce risk level.
         #
-        program_node = self._get_tree()
-
-
-
-        if self.logger:
+        hierarchy = self._get_tree()
+        profile_nodes = hierarchy.profile_nodes
+        all_nodes = hierarchy.all_node_index
+        risk_nodes = hierarchy.risk_node_index
+
+        # The profile of each profile node for each overlay, with the layer
+        # of each overlay. Nodes default to the no loss profile.
+        overlay_profiles = np.full(
+            (len(self.ri_info.index), len(profile_nodes)), nolossprofile_id)
+        overlay_layer_ids = np.zeros(len(self.ri_info.index), dtype=np.int64)
+
+        if self.logger.isEnabledFor(logging.DEBUG):
             self.logger.debug('program_node tree: "{}"'.format(self.name))
-            self.logger.debug(anytree.RenderTree(program_node))
-            #Plot tree to image (graphviz)
-            #from anytree.dotexport import RenderTreeGraph
-            #RenderTreeGraph(program_node).to_picture(
-            #    "Init_{}.png".format(self.name))
+            self.logger.debug(hierarchy.render())
 
 
         #
@@ -669,9 +768,10 @@ class ReinsuranceLayer(object):
                 prev_reins_number = ri_info_row.ReinsNumber
             if layer_id < ri_info_row.ReinsLayerNumber:
                 layer_id = ri_info_row.ReinsLayerNumber
+            overlay_layer_ids[overlay_loop - 1] = layer_id
 
 
-            if self.logger:
+            if self.logger.isEnabledFor(logging.DEBUG):
                 pd.set_option('display.width', 1000)
                 self.logger.debug('ri_scope: "{}"'.format(self.name))
                 self.logger.debug(scope_rows)
@@ -680,17 +780,15 @@ class ReinsuranceLayer(object):
                 continue
 
             add_profiles_args = self.add_profiles_args(
-                program_node, ri_info_row, scope_rows, overlay_loop, layer_id, 
-                node_layer_profile_map, fmprofiles_list, 
-                nolossprofile_id, passthroughprofile_id)
+                hierarchy, ri_info_row, scope_rows, overlay_loop, layer_id, 
+                overlay_profiles[overlay_loop - 1], profiles, 
+                nolossprofile_id, passthroughprofile_id,
+                all_nodes, risk_nodes)
 
             # Add pass through nodes at all levels so that the risks
             # not explicitly covered are unaffected
-            for node in anytree.iterators.LevelOrderIter(add_profiles_args.program_node):
-                add_profiles_args.node_layer_profile_map[(
-                    node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = add_profiles_args.nolossprofile_id
-            add_profiles_args.node_layer_profile_map[(
-                add_profiles_args.program_node.name, add_profiles_args.layer_id, add_profiles_args.overlay_loop)] = add_profiles_args.passthroughprofile_id
+            add_profiles_args.overlay_profiles[
+                ProgramHierarchy.PROGRAM_NODE] = add_profiles_args.passthroughprofile_id
 
             if ri_info_row.ReinsType == common.REINS_TYPE_FAC:
                 self._add_fac_profiles(add_profiles_args)
@@ -710,100 +808,70 @@ class ReinsuranceLayer(object):
         #
         # Step 3 - Iterate over the tree and write out the Oasis structure.
         #
-        for node in anytree.iterators.LevelOrderIter(program_node):
-            if node.parent is not None:
-                fmprogrammes_list.append(
-                    common.FmProgramme(
-                        from_agg_id=node.agg_id,
-                        level_id=node.level_id,
-                        to_agg_id=node.parent.agg_id
-                    )
-                )
-
         # Note: Pending confirmation from Joh that ReinsLayerNumber is being used correctly
-        for layer in range(1,layer_id+1):
-            for node in anytree.iterators.LevelOrderIter(program_node):
-                if node.level_id > 1:
-                    profiles_ids = []
-
-                    # The `overlay_rule` replaces using each resinsuarnce contact in a seperate layer
-                    # Collect overlaping unique combinations of (layer_id, level_id, agg_id) and combine into
-                    # a single layer
-                    #
-                    # TODO -> Detect profile rule clash and ++ layer_id
-                    for overlay_rule in range(1,overlay_loop+1):
-                        try:
-                            profiles_ids.append(
-                                node_layer_profile_map[(node.name, layer, overlay_rule)])
-                                
-                        except:
-                            profiles_ids.append(1)
-                            pass
-                    fm_policytcs_list.append(common.FmPolicyTc(
-                        layer_id=layer,
-                        level_id=node.level_id - 1,
-                        agg_id=node.agg_id,
-                        profile_id=max(profiles_ids)
-                    ))
-        self.fmprogrammes = pd.DataFrame(fmprogrammes_list)
-        self.fmprofiles = pd.DataFrame(fmprofiles_list)
-        self.fm_policytcs = pd.DataFrame(fm_policytcs_list)
+        #
+        # The `overlay_rule` replaces using each resinsuarnce contact in a seperate layer
+        # Collect overlaping unique combinations of (layer_id, level_id, agg_id) and combine into
+        # a single layer, taking the latest profile added by the overlays in the layer.
+        #
+        # TODO -> Detect profile rule clash and ++ layer_id
+        self.fmprogrammes = hierarchy.get_fm_programmes()
+        self.fmprofiles = profiles.get_fm_profiles()
+        self.fm_policytcs = self._get_fm_policytcs(
+            hierarchy, overlay_profiles, overlay_layer_ids, layer_id, profiles,
+            nolossprofile_id)
         self.fm_xrefs['layer_id'] = pd.Series(layer_id, range(len(self.fm_xrefs.index)))
 
         # Log Reinsurance structures
-        if self.logger:
+        if self.logger.isEnabledFor(logging.DEBUG):
             self.logger.debug('program_node tree: "{}"'.format(self.name))
-            self.logger.debug(anytree.RenderTree(add_profiles_args.program_node))
-            #Plot tree to image (graphviz)
-            #from anytree.dotexport import RenderTreeGraph
-            #RenderTreeGraph(program_node).to_picture(
-            #    "{}.png".format(self.name))
+            self.logger.debug(hierarchy.render())
 
 
             self.logger.debug('policytc_map: "{}"'.format(self.name))
             policytc_map = dict()
-            for k in add_profiles_args.node_layer_profile_map.keys():
-                profile_id = add_profiles_args.node_layer_profile_map[k]
-                policytc_map["(Name=%s, layer_id=%s, overlay_loop=%s)" % k] = profile_id
+            for (overlay_index, overlay_layer_id) in enumerate(overlay_layer_ids.tolist()):
+                for (node, profile_id) in zip(
+                        profile_nodes.tolist(), overlay_profiles[overlay_index].tolist()):
+                    policytc_map["(Name=%s, layer_id=%s, overlay_loop=%s)" % (
+                        hierarchy.get_name(node), overlay_layer_id, overlay_index + 1)] = \
+                        int(profiles.get_profile_ids(profile_id))
             self.logger.debug(json.dumps(policytc_map, indent=4))
             self.logger.debug('fm_policytcs: "{}"'.format(self.name))
             self.logger.debug(self.fm_policytcs)
             self.logger.debug('fm_profile: "{}"'.format(self.name))
             self.logger.debug(self.fmprofiles)
 
-    def write_oasis_files(self):
+    def write_oasis_files(self, debug=False, use_conversion_tools=False, session=None):
         """
-        Write out the Oasis structures to file.
+        Write out the Oasis structures as ktools binaries in the layer directory
+        of the session's workspace.
+        CSV copies are only written when debugging, or when the binaries are
+        created using the ktools conversion tools rather than the native writer.
         """
 
-        self.fmprogrammes.to_csv("fm_programme.csv", index=False)
-        self.fmprofiles.to_csv("fm_profile.csv", index=False)
-        self.fm_policytcs.to_csv("fm_policytc.csv", index=False)
-        self.fm_xrefs.to_csv("fm_xref.csv", index=False)
+        input_dfs = OrderedDict([
+            ('coverages', self.coverages),
+            ('items', self.items),
+            ('fm_programme', self.fmprogrammes),
+            ('fm_profile', self.fmprofiles),
+            ('fm_policytc', self.fm_policytcs),
+            ('fm_xref', self.fm_xrefs)])
 
-        directory = self.name
+        session = common.get_session(session)
+        directory = session.get_path(self.name)
         if os.path.exists(directory):
             shutil.rmtree(directory)
         os.mkdir(directory)
 
-        # place a copy in sub dir for reference
-        self.fmprogrammes.to_csv(os.path.join(directory,"fm_programme.csv"), index=False)
-        self.fmprofiles.to_csv(os.path.join(directory,"fm_profile.csv"), index=False)
-        self.fm_policytcs.to_csv(os.path.join(directory,"fm_policytc.csv"), index=False)
-        self.fm_xrefs.to_csv(os.path.join(directory,"fm_xref.csv"), index=False)
-        input_files = common.GUL_INPUTS_FILES + common.IL_INPUTS_FILES
-
-        for input_file in input_files:
-            conversion_tool = common.CONVERSION_TOOLS[input_file]
-            input_file_path = input_file + ".csv"
-            if not os.path.exists(input_file_path):
-                continue
+        if debug or use_conversion_tools:
+            with session.span("write_csv", layer=self.name):
+                for (input_file, df) in input_dfs.items():
+                    df.to_csv(os.path.join(directory, input_file + ".csv"), index=False)
 
-            output_file_path = os.path.join(directory, input_file + ".bin")
-            command = "{} < {} > {}".format(
-                conversion_tool, input_file_path, output_file_path)
-            proc = subprocess.Popen(command, shell=True)
-            proc.wait()
-            if proc.returncode != 0:
-                raise Exception(
-                    "Failed to convert {}: {}".format(input_file_path, command))
+        if use_conversion_tools:
+            common.run_conversion_tools(
+                input_dfs.keys(), directory, directory, session=session)
+        else:
+            with session.span("write_bin", layer=self.name):
+                ktools_io.write_input_files(directory, input_dfs)
@@ -4,16 +4,24 @@ Test tool for reinsurance functaionality and OED data input.
 Takes input data in OED format, and invokes the Oasis Platform financial module.
 """
 from tabulate import tabulate
+import numpy as np
 import pandas as pd
 import shutil
 import os
 import argparse
 import time
 import logging
-from reinsurance_layer import ReinsuranceLayer, validate_reinsurance_structures
+from reinsurance_layer import ReinsuranceLayer, HierarchyCache, validate_reinsurance_structures, \
+    get_structure_counts as get_reinsurance_structure_counts
 from direct_layer import DirectLayer
 import common
+import ktools_io
+import numpy_fm
+import run_profile
+from structure_cache import StructureCache
+from stage_manifest import StageManifest, get_fingerprint
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 def load_oed_dfs(oed_dir, show_all=False):
@@ -66,20 +74,30 @@ def load_oed_dfs(oed_dir, show_all=False):
     return (account_df, location_df, ri_info_df, ri_scope_df, do_reinsurance)
 
 
-def run_inuring_level_risk_level(
-        inuring_priority,
-        account_df,
-        location_df,
-        items,
-        coverages,
-        fm_xrefs,
-        xref_descriptions,
-        ri_info_df,
-        ri_scope_df,
-        previous_inuring_priority,
-        previous_risk_level,
-        risk_level):
+def get_reinsurance_layers(ri_info_df, ri_scope_df):
+    """
+    Return the (inuring priority, risk level, ReinsNumbers) of each
+    reinsurance layer, in the order they are run: by inuring priority,
+    then by risk level.
+    """
+    reinsurance_layers = []
+    for inuring_priority in range(1, ri_info_df['InuringPriority'].max() + 1):
+        # Filter the reinsNumbers by inuring_priority
+        reins_numbers = ri_info_df[ri_info_df['InuringPriority'] == inuring_priority].ReinsNumber.tolist()
+        risk_level_set = set(ri_scope_df[ri_scope_df['ReinsNumber'].isin(reins_numbers)].RiskLevel)
 
+        for risk_level in common.REINS_RISK_LEVELS:
+            if risk_level in risk_level_set:
+                reinsurance_layers.append((inuring_priority, risk_level, reins_numbers))
+    return reinsurance_layers
+
+
+def get_inuring_level_risk_level_ri_info(
+        inuring_priority, ri_info_df, ri_scope_df, risk_level):
+    """
+    Return the ri_info rows of the contracts in an inuring priority with
+    scopes at a risk level, or None if there are none.
+    """
     reins_numbers_1 = ri_info_df[
         ri_info_df['InuringPriority'] == inuring_priority].ReinsNumber
     if reins_numbers_1.empty:
@@ -90,11 +108,38 @@ def run_inuring_level_risk_level(
     if reins_numbers_2.empty:
         return None
 
-    ri_info_inuring_priority_df = ri_info_df[ri_info_df.isin(
+    return ri_info_df[ri_info_df.isin(
         {"ReinsNumber": reins_numbers_2.tolist()}).ReinsNumber]
-    output_name = "ri_{}_{}".format(inuring_priority, risk_level)
+
+
+def generate_inuring_level_risk_level(
+        inuring_priority,
+        account_df,
+        location_df,
+        items,
+        coverages,
+        fm_xrefs,
+        xref_descriptions,
+        ri_info_df,
+        ri_scope_df,
+        risk_level,
+        debug=False,
+        fm_engine=common.FM_ENGINE_KTOOLS,
+        hierarchy_cache=None,
+        session=None):
+    """
+    Generate the structures of an inuring priority and risk level, and
+    write them out if they are needed by fmcalc. The structures only depend
+    on the OED inputs, not on the losses of the previous layers.
+    Returns the ReinsuranceLayer, or None if there are no contracts.
+    """
+    ri_info_inuring_priority_df = get_inuring_level_risk_level_ri_info(
+        inuring_priority, ri_info_df, ri_scope_df, risk_level)
+    if ri_info_inuring_priority_df is None:
+        return None
+
     reinsurance_layer = ReinsuranceLayer(
-        name=output_name,
+        name="ri_{}_{}".format(inuring_priority, risk_level),
         ri_info=ri_info_inuring_priority_df,
         ri_scope=ri_scope_df,
         accounts=account_df,
@@ -103,11 +148,81 @@ def run_inuring_level_risk_level(
         coverages=coverages,
         fm_xrefs=fm_xrefs,
         xref_descriptions=xref_descriptions,
-        risk_level=risk_level
+        risk_level=risk_level,
+        logger=session.logger if session is not None else None,
+        hierarchy_cache=hierarchy_cache
     )
 
-    reinsurance_layer.generate_oasis_structures()
-    reinsurance_layer.write_oasis_files()
+    with common.get_session(session).span(
+            "generate_structures", layer=reinsurance_layer.name):
+        reinsurance_layer.generate_oasis_structures()
+    count_structures(reinsurance_layer, reinsurance_layer.name, session)
+    if fm_engine == common.FM_ENGINE_KTOOLS or debug:
+        reinsurance_layer.write_oasis_files(debug=debug, session=session)
+    return reinsurance_layer
+
+
+def count_structures(layer, name, session=None):
+    """
+    Count the items, fm_programme (node) rows, profiles and policytc rows of
+    the structures of a layer in the session's profile.
+    """
+    common.get_session(session).count(
+        name,
+        items=len(layer.items.index),
+        programmes=len(layer.fmprogrammes.index),
+        profiles=len(layer.fmprofiles.index),
+        policytcs=len(layer.fm_policytcs.index))
+
+
+def run_inuring_level_risk_level(
+        inuring_priority,
+        account_df,
+        location_df,
+        items,
+        coverages,
+        fm_xrefs,
+        xref_descriptions,
+        ri_info_df,
+        ri_scope_df,
+        previous_inuring_priority,
+        previous_risk_level,
+        risk_level,
+        debug=False,
+        sample_size=None,
+        fm_engine=common.FM_ENGINE_KTOOLS,
+        loss_matrices=None,
+        hierarchy_cache=None,
+        structures_cached=False,
+        session=None,
+        reinsurance_layer=None):
+    """
+    Run the losses of the previous layer through an inuring priority and
+    risk level. The structures are generated first, unless they have been
+    generated already, as reinsurance_layer, or are in a structure cache.
+    """
+
+    if get_inuring_level_risk_level_ri_info(
+            inuring_priority, ri_info_df, ri_scope_df, risk_level) is None:
+        return None
+
+    output_name = "ri_{}_{}".format(inuring_priority, risk_level)
+    if not structures_cached and reinsurance_layer is None:
+        reinsurance_layer = generate_inuring_level_risk_level(
+            inuring_priority,
+            account_df,
+            location_df,
+            items,
+            coverages,
+            fm_xrefs,
+            xref_descriptions,
+            ri_info_df,
+            ri_scope_df,
+            risk_level,
+            debug=debug,
+            fm_engine=fm_engine,
+            hierarchy_cache=hierarchy_cache,
+            session=session)
 
     input_name = ""
     if previous_inuring_priority is None and previous_risk_level is None:
@@ -115,8 +230,15 @@ def run_inuring_level_risk_level(
     else:
         input_name = "ri_{}_{}".format(previous_inuring_priority, previous_risk_level)
 
-    reinsurance_layer_losses_df = common.run_fm(
-        input_name, output_name, reinsurance_layer.xref_descriptions)
+    if fm_engine == common.FM_ENGINE_NUMPY:
+        with common.get_session(session).span("numpy_fm", layer=output_name):
+            reinsurance_layer_losses_df = numpy_fm.run_fm(
+                input_name, output_name, reinsurance_layer, loss_matrices,
+                sample_size=sample_size)
+    else:
+        reinsurance_layer_losses_df = common.run_fm(
+            input_name, output_name, xref_descriptions,
+            sample_size=sample_size, session=session)
 
     return reinsurance_layer_losses_df
 
@@ -126,37 +248,143 @@ def run_test(
         account_df, location_df, ri_info_df, ri_scope_df,
         loss_factor,
         do_reinsurance,
-        logger=None):
+        logger=None,
+        event_loss_set=None,
+        loss_factors=None,
+        fm_engine=common.FM_ENGINE_KTOOLS,
+        structure_cache=None,
+        incremental=False,
+        session=None,
+        chained=False,
+        stage_times=None,
+        profile=None):
     """
     Run the direct and reinsurance layers through the Oasis FM.abs
     Returns an array of net loss data frames, the first for the direct layers
     and then one per inuring layer.
+    If an event loss set is given, with columns event_id, item_id, sidx and
+    damage_ratio, all of its events and samples are run instead of the single
+    loss_factor event, and the losses are keyed by event_id and sidx.
+    If a list of loss factors is given, each factor is run as a separate event
+    in the same loss stream, and the losses are keyed by loss_factor.
+    fm_engine selects the financial module implementation, either fmcalc or
+    the in memory NumPy version, which does not need the ktools binaries.
+    If a structure_cache is given, the ktools binaries of the same inputs are
+    taken from the cache rather than generated. It is only used with fmcalc,
+    and not when debugging, as then the structures are logged.
+    If incremental is set, run_name is kept from the last run and only the
+    stages whose inputs have changed, and the stages after them, are rerun.
+    For example, changing the treaties of the second inuring priority reuses
+    the direct losses and the losses of the first inuring priority. It is
+    also only used with fmcalc and not when debugging.
+    run_name is a directory in the workspace of the session, by default
+    the working directory. The session also gives the ktools binaries and
+    the logger; the working directory is not changed, so runs in separate
+    sessions can run at once on threads.
+    If chained is set, the direct layer and every reinsurance layer are run
+    as one pipeline of fmcalc processes, rather than one after the other
+    through loss files. The layers then run at once, and no loss streams
+    are written, so it cannot be combined with incremental runs.
+    If stage_times is a dict, the wall time in seconds of each stage is set
+    in it: 'direct' for the direct structures, 'ils' for the direct losses,
+    the name of each reinsurance layer, e.g. 'ri_1_LOC', for its losses, or
+    'pipeline' for all the losses if chained, and 'total' for the run.
+    The stages, and the work within them, are timed in a
+    run_profile.RunProfile, by default the session's or a new one, which is
+    written to run_profile.PROFILE_FILE in run_name. If the profile records
+    memory, the memory use of each stage and the size of the net losses are
+    also recorded, and written to run_profile.MEMORY_FILE in run_name.
     """
     t_start = time.time()
 
+    if session is None:
+        session = common.AnalysisSession(os.getcwd(), logger=logger)
+    session = session.get_subsession(run_name)
+    run_dir = session.workspace
+    if profile is None:
+        profile = session.profile or run_profile.RunProfile()
+    profile.output_dir = run_dir
+    session.profile = profile
+    total_stage = profile.start_span("total", run_profile.CATEGORY_STAGE)
+
+    # Incremental runs reuse the stages of the last run in run_name
+    chained = chained and fm_engine == common.FM_ENGINE_KTOOLS
+    incremental = incremental and not chained and \
+        fm_engine == common.FM_ENGINE_KTOOLS and logger is None
+    if os.path.exists(run_dir) and not incremental:
+        shutil.rmtree(run_dir)
+    if not os.path.exists(run_dir):
+        os.mkdir(run_dir)
 
-    if os.path.exists(run_name):
-        shutil.rmtree(run_name)
-    os.mkdir(run_name)
+    net_losses = OrderedDict()
+    loss_matrices = {}
 
-    cwd = os.getcwd()
+    def start_stage(name):
+        return profile.start_span(name, run_profile.CATEGORY_STAGE)
 
-    if os.path.exists(run_name):
-        shutil.rmtree(run_name)
-    os.mkdir(run_name)
+    def end_stage(stage):
+        profile.end_span(stage)
+        if stage_times is not None:
+            stage_times[stage.name] = stage.t_end - stage.t_start
 
-    net_losses = OrderedDict()
-
-    cwd = os.getcwd()
     try:
-        os.chdir(run_name)
-
+        stage = start_stage("direct")
+        stage_manifest = None
+        if incremental:
+            stage_manifest = StageManifest(run_dir)
+
+        def is_current(name, fingerprint):
+            if stage_manifest is None:
+                return False
+            if stage_manifest.is_current(name, fingerprint):
+                return True
+            stage_manifest.invalidate(name)
+            return False
+
+        def record(name, fingerprint, outputs, losses_df=None):
+            if stage_manifest is not None:
+                stage_manifest.record(name, fingerprint, outputs, losses_df)
+
+        cache_key = None
+        cached_xref_descriptions = None
+        if structure_cache is not None and \
+                fm_engine == common.FM_ENGINE_KTOOLS and logger is None:
+            cache_key = structure_cache.get_key(account_df, location_df, ri_info_df, ri_scope_df)
+            cached_xref_descriptions = structure_cache.get(cache_key, run_dir)
+        structures_cached = cached_xref_descriptions is not None
+        layer_names = ["direct"]
+
+        # Direct structures
+        fingerprint = get_fingerprint(account_df, location_df)
         direct_layer = DirectLayer(account_df, location_df)
-        direct_layer.generate_oasis_structures()
-        direct_layer.write_oasis_files()
-        losses_df = direct_layer.apply_fm(
-            loss_percentage_of_tiv=loss_factor, net=False)
-        net_losses['Direct'] = losses_df
+        if structures_cached:
+            direct_layer.set_xref_descriptions(cached_xref_descriptions)
+        else:
+            # The reinsurance layers are built from the direct structures,
+            # so only writing them out is skipped when they are current
+            with session.span("generate_structures", layer="direct"):
+                direct_layer.generate_oasis_structures()
+            count_structures(direct_layer, "direct", session)
+            if (fm_engine == common.FM_ENGINE_KTOOLS or logger is not None) and \
+                    not is_current("direct", fingerprint):
+                direct_layer.write_oasis_files(
+                    debug=logger is not None, session=session)
+        record("direct", fingerprint, ["direct"])
+        end_stage(stage)
+
+        # Direct losses
+        if loss_factors is not None:
+            event_loss_set = direct_layer.get_event_loss_set(loss_factors)
+        fingerprint = get_fingerprint(
+            fingerprint, loss_factor, event_loss_set)
+        direct_current = is_current("ils", fingerprint)
+        sample_size = None
+        if event_loss_set is not None:
+            sample_size = int(event_loss_set.sidx.max())
+
+        # Reinsurance layers, as (inuring priority, risk level, name,
+        # whether the stage is current)
+        reinsurance_layers = []
         if do_reinsurance:
             (is_valid, reisurance_layers) = validate_reinsurance_structures(
                 account_df, location_df, ri_info_df, ri_scope_df)
@@ -170,40 +398,151 @@ def run_test(
                             print("\t{}".format(validation_message))
                         exit(0)
 
-            previous_inuring_priority = None
-            previous_risk_level = None
-            for inuring_priority in range(1, ri_info_df['InuringPriority'].max() + 1):
-                # Filter the reinsNumbers by inuring_priority
-                reins_numbers = ri_info_df[ri_info_df['InuringPriority'] == inuring_priority].ReinsNumber.tolist()
-                risk_level_set = set(ri_scope_df[ri_scope_df['ReinsNumber'].isin(reins_numbers)].RiskLevel)
-
-                for risk_level in common.REINS_RISK_LEVELS:
-                    if risk_level not in risk_level_set:
-                        continue
-                    reinsurance_layer_losses_df = run_inuring_level_risk_level(
-                        inuring_priority,
-                        account_df,
-                        location_df,
-                        direct_layer.items,
-                        direct_layer.coverages,
-                        direct_layer.fm_xrefs,
-                        direct_layer.xref_descriptions,
-                        ri_info_df,
-                        ri_scope_df,
-                        previous_inuring_priority,
-                        previous_risk_level,
-                        risk_level)
+            layer_fingerprint = fingerprint
+            for (inuring_priority, risk_level, reins_numbers) in \
+                    get_reinsurance_layers(ri_info_df, ri_scope_df):
+                output_name = "ri_{}_{}".format(inuring_priority, risk_level)
+                layer_fingerprint = get_fingerprint(
+                    layer_fingerprint, inuring_priority, risk_level,
+                    ri_info_df[ri_info_df.ReinsNumber.isin(reins_numbers)],
+                    ri_scope_df[
+                        ri_scope_df.ReinsNumber.isin(reins_numbers) &
+                        (ri_scope_df.RiskLevel == risk_level)])
+                reinsurance_layers.append((
+                    inuring_priority, risk_level, output_name, layer_fingerprint,
+                    is_current(output_name, layer_fingerprint)))
+
+        # The structures of the reinsurance layers only depend on the OED
+        # inputs, so they are generated on a separate thread while the
+        # earlier layers run through fmcalc. Only the flow of losses from
+        # layer to layer is sequential.
+        hierarchy_cache = HierarchyCache(direct_layer.xref_descriptions)
+        structure_executor = ThreadPoolExecutor(max_workers=1)
+        structure_futures = {}
+        try:
+            for (inuring_priority, risk_level, output_name, _, current) in reinsurance_layers:
+                if current or structures_cached:
+                    continue
+                structure_futures[output_name] = structure_executor.submit(
+                    generate_inuring_level_risk_level,
+                    inuring_priority,
+                    account_df,
+                    location_df,
+                    direct_layer.items,
+                    direct_layer.coverages,
+                    direct_layer.fm_xrefs,
+                    direct_layer.xref_descriptions,
+                    ri_info_df,
+                    ri_scope_df,
+                    risk_level,
+                    debug=logger is not None,
+                    fm_engine=fm_engine,
+                    hierarchy_cache=hierarchy_cache,
+                    session=session)
+
+            stage = start_stage("pipeline" if chained else "ils")
+            if chained:
+                # All the structures are needed before the pipeline starts
+                for structure_future in structure_futures.values():
+                    structure_future.result()
+                layer_losses = direct_layer.apply_fm_chain(
+                    [output_name for (_, _, output_name, _, _) in reinsurance_layers],
+                    loss_percentage_of_tiv=loss_factor, net=False,
+                    event_loss_set=event_loss_set, session=session)
+                net_losses['Direct'] = layer_losses['direct']
+                for (inuring_priority, risk_level, output_name, _, _) in reinsurance_layers:
+                    layer_names.append(output_name)
+                    net_losses['Inuring priority:{} - Risk level:{}'.format(
+                        inuring_priority, risk_level)] = layer_losses[output_name]
+                end_stage(stage)
+            else:
+                if direct_current:
+                    losses_df = stage_manifest.get_losses("ils")
+                else:
+                    losses_df = direct_layer.apply_fm(
+                        loss_percentage_of_tiv=loss_factor, net=False,
+                        event_loss_set=event_loss_set,
+                        fm_engine=fm_engine, loss_matrices=loss_matrices,
+                        session=session)
+                    record("ils", fingerprint, ["ils.bin"], losses_df)
+                net_losses['Direct'] = losses_df
+                end_stage(stage)
+
+                previous_inuring_priority = None
+                previous_risk_level = None
+                for (inuring_priority, risk_level, output_name, layer_fingerprint, current) \
+                        in reinsurance_layers:
+                    stage = start_stage(output_name)
+                    if current:
+                        reinsurance_layer_losses_df = \
+                            stage_manifest.get_losses(output_name)
+                    else:
+                        reinsurance_layer = None
+                        if output_name in structure_futures:
+                            reinsurance_layer = structure_futures[output_name].result()
+                        reinsurance_layer_losses_df = run_inuring_level_risk_level(
+                            inuring_priority,
+                            account_df,
+                            location_df,
+                            direct_layer.items,
+                            direct_layer.coverages,
+                            direct_layer.fm_xrefs,
+                            direct_layer.xref_descriptions,
+                            ri_info_df,
+                            ri_scope_df,
+                            previous_inuring_priority,
+                            previous_risk_level,
+                            risk_level,
+                            debug=logger is not None,
+                            sample_size=sample_size,
+                            fm_engine=fm_engine,
+                            loss_matrices=loss_matrices,
+                            hierarchy_cache=hierarchy_cache,
+                            structures_cached=structures_cached,
+                            session=session,
+                            reinsurance_layer=reinsurance_layer)
+                        if reinsurance_layer_losses_df is not None:
+                            record(
+                                output_name, layer_fingerprint,
+                                [output_name, output_name + ".bin"],
+                                reinsurance_layer_losses_df)
                     previous_inuring_priority = inuring_priority
                     previous_risk_level = risk_level
 
                     if reinsurance_layer_losses_df is not None:
+                        layer_names.append(output_name)
                         net_losses['Inuring priority:{} - Risk level:{}'.format(
                             inuring_priority, risk_level)] = reinsurance_layer_losses_df
+                    end_stage(stage)
+        finally:
+            # Do not wait for the structures of layers that will not be run
+            for structure_future in structure_futures.values():
+                structure_future.cancel()
+            structure_executor.shutdown()
+
+        if cache_key is not None and not structures_cached:
+            structure_cache.put(
+                cache_key, run_dir, layer_names, direct_layer.xref_descriptions)
+
+        if loss_factors is not None:
+            for (description, net_loss) in net_losses.items():
+                net_loss.insert(
+                    list(net_loss.columns).index('event_id'), 'loss_factor',
+                    np.asarray(loss_factors)[net_loss.event_id.values - 1])
+                del net_loss['event_id']
+                del net_loss['sidx']
+
+        if profile.memory:
+            profile.count("net_losses", bytes=sum(
+                net_loss.memory_usage(deep=True).sum()
+                for net_loss in net_losses.values()))
 
     finally:
-        os.chdir(cwd)
         t_end = time.time()
         print("Exec time: {}".format(t_end - t_start))
+        end_stage(total_stage)
+        if os.path.isdir(run_dir):
+            profile.write(os.path.join(run_dir, run_profile.PROFILE_FILE))
 
         if logger:
             print("\n\nItems_to_Locations: mapping")
@@ -216,14 +555,106 @@ def run_test(
 
 
 
-def setup_logger(log_name):
+def plan_run(
+        account_df, location_df, ri_info_df, ri_scope_df, do_reinsurance,
+        loss_factors=None, event_loss_set=None):
+    """
+    Plan a run from the OED inputs alone, without generating the structures,
+    writing any files or running fmcalc. The structures of the direct layer
+    and of each reinsurance layer are counted, and the sizes in bytes of
+    their ktools binaries, loss streams and DataFrames are estimated for the
+    events and samples of loss_factors or event_loss_set, as in run_test.
+    The ground up loss stream is only written for the direct layer, and the
+    fmcalc output streams are at most the size given, as fmcalc leaves out
+    records with no loss. The memory estimates are a lower bound: they
+    count the 8 byte values of the structures and net losses a run keeps to
+    its end, but not their indexes, the strings of object columns such as
+    location_number, nor the overhead of each DataFrame.
+    Returns a DataFrame with a row per layer, named as in run_test.
+    """
+    event_count = 1
+    sample_size = 1
+    # The columns a sweep or event loss set adds to the net losses
+    key_columns = []
+    if loss_factors is not None:
+        event_count = len(loss_factors)
+        key_columns = ['loss_factor']
+    if event_loss_set is not None:
+        event_count = event_loss_set.event_id.nunique()
+        sample_size = int(event_loss_set.sidx.max())
+        key_columns = ['event_id', 'sidx']
+
+    (direct_counts, site_items) = DirectLayer(account_df, location_df).get_structure_counts()
+    layer_counts = [("direct", None, None, direct_counts)]
+    if do_reinsurance:
+        for (inuring_priority, risk_level, _) in \
+                get_reinsurance_layers(ri_info_df, ri_scope_df):
+            ri_info_inuring_priority_df = get_inuring_level_risk_level_ri_info(
+                inuring_priority, ri_info_df, ri_scope_df, risk_level)
+            if ri_info_inuring_priority_df is None:
+                continue
+            layer_counts.append((
+                "ri_{}_{}".format(inuring_priority, risk_level),
+                inuring_priority, risk_level,
+                get_reinsurance_structure_counts(
+                    site_items, ri_info_inuring_priority_df, ri_scope_df, risk_level)))
+
+    # The structures and net losses are held as int64, float64 or object
+    # columns, of 8 bytes a value, unlike the 4 byte values of the ktools
+    # binaries. Each net loss row has the item description, any key columns
+    # and the losses before and after the layer.
+    value_size = 8
+    loss_columns = len(common.XrefDescription._fields) - 1 + len(key_columns) + 2
+
+    rows = []
+    for (name, inuring_priority, risk_level, counts) in layer_counts:
+        row_counts = OrderedDict([
+            ('coverages', counts['coverages']),
+            ('items', counts['items']),
+            ('fm_programme', counts['programmes']),
+            ('fm_profile', counts['profiles']),
+            ('fm_policytc', counts['policytcs']),
+            ('fm_xref', counts['items'])])
+        record_count = counts['items'] * event_count
+        loss_count = record_count * sample_size
+        row = OrderedDict([
+            ('layer', name),
+            ('inuring_priority', inuring_priority),
+            ('risk_level', risk_level)])
+        row.update(counts)
+        row['input_bytes'] = ktools_io.get_input_files_size(row_counts)
+        row['gul_stream_bytes'] = ktools_io.get_gul_stream_size(
+            record_count, sample_size) if name == "direct" else 0
+        row['loss_stream_bytes'] = ktools_io.get_fm_stream_size(
+            record_count, sample_size)
+        row['structure_memory_bytes'] = value_size * sum(
+            row_count * len(ktools_io.INPUT_FILE_DTYPES[input_file].names)
+            for (input_file, row_count) in row_counts.items())
+        row['loss_memory_bytes'] = value_size * loss_count * loss_columns
+        rows.append(row)
+    return pd.DataFrame(rows, columns=list(rows[0].keys()))
+
+
+def parse_loss_factors(loss_factors):
+    """
+    Parse a loss factor sweep, either a comma separated list of factors,
+    or start:stop:count for count evenly spaced factors from start to stop.
+    """
+    if ':' in loss_factors:
+        (start, stop, count) = loss_factors.split(':')
+        return np.linspace(float(start), float(stop), int(count)).tolist()
+    return [float(loss_factor) for loss_factor in loss_factors.split(',')]
+
+
+def setup_logger(log_name, log_dir='logs'):
+    """
+    Return a logger that writes to its own file in log_dir. The root logger
+    is not configured, so each analysis can have its own log.
+    """
     log_file = "run_{}.log".format(time.strftime("%Y%m%d-%H%M%S"))
     if log_name:
         log_file = "{}.log".format(log_name)
 
-    log_dir = 'logs'
-    
-
     log_level = logging.DEBUG
     #log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     log_format = '%(message)s\n'
@@ -231,12 +662,16 @@ def setup_logger(log_name):
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
-    #logging.basicConfig(stream=sys.stdout, level=log_level, format=log_format)
-    logging.basicConfig(level=log_level,
-                        format=log_format,
-                        filename=os.path.join(log_dir, log_file),
-                        filemode='w')
-    return logging.getLogger()
+    handler = logging.FileHandler(os.path.join(log_dir, log_file), mode='w')
+    handler.setFormatter(logging.Formatter(log_format))
+    logger = logging.getLogger("reinsurance_tester.{}".format(log_file))
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+        old_handler.close()
+    logger.addHandler(handler)
+    logger.setLevel(log_level)
+    logger.propagate = False
+    return logger
 
 
 
@@ -254,25 +689,115 @@ if __name__ == "__main__":
     parser.add_argument(
         '-l', '--loss_factor', metavar='N', type=float, default=1.0,
         help='The loss factor to apply to TIVs.')
+    parser.add_argument(
+        '-s', '--sweep', metavar='N', type=str, default=None,
+        help='Run a sweep of loss factors in one pass, either a comma separated '
+             'list, e.g. 0.1,0.5,1.0, or start:stop:count, e.g. 0.01:1.0:100.')
+    parser.add_argument(
+        '-e', '--event_loss_set', metavar='N', type=str, default=None,
+        help='A CSV file of damage ratios with columns event_id, item_id, '
+             'sidx and damage_ratio, to run instead of the loss factor.')
+    parser.add_argument(
+        '-f', '--fm_engine', metavar='N', type=str,
+        default=common.FM_ENGINE_KTOOLS, choices=common.FM_ENGINES,
+        help='The financial module implementation, either ktools or numpy.')
+    parser.add_argument(
+        '-c', '--structure_cache', metavar='N', type=str, default=None,
+        help='A directory to cache the generated structures in, to reuse '
+             'them when the same OED inputs are run again.')
+    parser.add_argument(
+        '--structure_cache_size', metavar='N', type=int, default=1024,
+        help='The maximum size of the structure cache in MB.')
+    parser.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='Keep the run directory of the last run with the same name, and '
+             'only rerun the stages whose inputs have changed.')
+    parser.add_argument(
+        '-j', '--max_processes', metavar='N', type=int, default=None,
+        help='The most ktools processes to run at once, by default the number of CPUs.')
+    parser.add_argument(
+        '--partitions', metavar='N', type=int, default=1,
+        help='The number of partitions, by event, to split each fmcalc run into.')
+    parser.add_argument(
+        '-p', '--pipeline', action='store_true',
+        help='Run the direct and reinsurance layers as one pipeline of fmcalc '
+             'processes, without writing the losses of each layer to disk.')
+    parser.add_argument(
+        '--plan', action='store_true',
+        help='Print the structure counts and estimated file and memory sizes '
+             'of each layer, without running anything. The memory sizes are '
+             'a lower bound.')
     parser.add_argument(
        '-d', '--debug', action='store', default=None,
        help='Store Debugging Logs under ./logs')
+    parser.add_argument(
+        '--cprofile', metavar='N', type=str, default=None,
+        help='A comma separated list of the stages to run under cProfile, '
+             'e.g. ils,ri_*, with the stats dumped to the run directory.')
+    parser.add_argument(
+        '--memory', action='store_true',
+        help='Record the peak memory and largest allocations of each stage, '
+             'in the run directory. This slows the run.')
+    parser.add_argument(
+        '--reset_peak_rss', action='store_true',
+        help='With --memory, reset the peak resident set size before each '
+             'stage, so that it is the stage\'s own. This writes to '
+             '/proc/self/clear_refs, which affects the whole process.')
 
     args = parser.parse_args()
 
     run_name = args.name
     oed_dir = args.oed_dir
     loss_factor = args.loss_factor
-    logger = (setup_logger(args.debug) if args.debug else None)
+    event_loss_set = None
+    if args.event_loss_set is not None:
+        event_loss_set = pd.read_csv(args.event_loss_set)
+    loss_factors = None
+    if args.sweep is not None:
+        loss_factors = parse_loss_factors(args.sweep)
+
+    profile = run_profile.RunProfile(
+        cprofile_stages=[] if args.cprofile is None else args.cprofile.split(","),
+        memory=args.memory,
+        reset_peak_rss=args.reset_peak_rss)
+    with profile.span("load_oed", run_profile.CATEGORY_STAGE):
+        (account_df, location_df, ri_info_df, ri_scope_df, do_reinsurance) = \
+            load_oed_dfs(oed_dir)
+
+    if args.plan:
+        plan_df = plan_run(
+            account_df, location_df, ri_info_df, ri_scope_df, do_reinsurance,
+            loss_factors=loss_factors, event_loss_set=event_loss_set)
+        print(tabulate(plan_df, headers='keys', tablefmt='psql', showindex=False))
+        print("Input files: {:.1f}MB, ground up loss stream: {:.1f}MB, "
+              "loss streams: up to {:.1f}MB, memory: at least {:.1f}MB".format(
+                  *[plan_df[columns].values.sum() / (1024 * 1024)
+                    for columns in [
+                        'input_bytes', 'gul_stream_bytes', 'loss_stream_bytes',
+                        ['structure_memory_bytes', 'loss_memory_bytes']]]))
+        exit(0)
 
-    (account_df, location_df, ri_info_df, ri_scope_df, do_reinsurance) = load_oed_dfs(oed_dir)
+    logger = (setup_logger(args.debug) if args.debug else None)
+    structure_cache = None
+    if args.structure_cache is not None:
+        structure_cache = StructureCache(
+            args.structure_cache, max_size=args.structure_cache_size * 1024 * 1024)
 
     net_losses = run_test(
         run_name,
         account_df, location_df, ri_info_df, ri_scope_df,
         loss_factor,
         do_reinsurance,
-        logger)
+        logger,
+        event_loss_set,
+        loss_factors,
+        args.fm_engine,
+        structure_cache,
+        args.incremental,
+        common.AnalysisSession(
+            os.getcwd(), logger=logger, max_processes=args.max_processes,
+            partitions=args.partitions, profile=profile),
+        args.pipeline)
 
     for (description, net_loss) in net_losses.items():
         #Print / Write Output to csv
@@ -283,9 +808,13 @@ if __name__ == "__main__":
 
         # print / write, output sum by location_number
         if 'loss_net' in net_loss.columns:
-            loc_sum_df = net_loss.groupby(['location_number']).sum()
+            group_by = [
+                c for c in ['loss_factor', 'event_id', 'sidx']
+                if c in net_loss.columns]
+            loc_sum_df = net_loss.groupby(group_by + ['location_number']).sum()
             filename = '{}_output_locsum.csv'.format(description.replace(' ', '_'))
-            loc_sum_df.to_csv(os.path.join(run_name, filename), index=False)
+            loc_sum_df.reset_index().to_csv(
+                os.path.join(run_name, filename), index=False)
             print(tabulate(loc_sum_df[['tiv','loss_pre', 'loss_net']], 
                   headers='keys', tablefmt='psql', floatfmt=".2f"))
 
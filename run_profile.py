@@ -0,0 +1,356 @@
+"""
+Timing and size instrumentation of a run. A run records a span for each
+stage and for the work within it, such as structure generation, file
+writes, conversion tools, fmcalc invocations and merges, and counts the
+items, nodes, profiles and policytc rows of each layer. The profile is
+written as JSON to the run directory. Stages can also be run under
+cProfile, with the stats of each dumped next to the profile, and their
+memory use can be recorded, with a report written next to the profile.
+"""
+import cProfile
+import fnmatch
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+PROFILE_FILE = "profile.json"
+MEMORY_FILE = "memory.json"
+CATEGORY_STAGE = "stage"
+
+# The number of allocation sites reported for each stage
+TOP_ALLOCATIONS = 10
+TRACEMALLOC_FRAMES = 1
+
+# Tracing and peak memory are global to the process, so they are shared by
+# the running stages of every profile that records memory. Tracing runs
+# while any of them is running, and the peaks are added to all of them
+# before they are reset. _owns_tracing is set if tracing was started here,
+# and the peaks are only reset then, to leave other users of tracemalloc
+# their own peaks. tracemalloc.reset_peak needs Python 3.9; before that the
+# traced peak of a stage is the highest since tracing started. The peak
+# resident set size is reset for the whole process, so only while a stage
+# of a profile that asked for it is running.
+_memory_lock = threading.Lock()
+_memory_spans = []
+_owns_tracing = False
+
+
+def get_peak_rss(who=resource.RUSAGE_SELF):
+    """
+    Return the peak resident set size in bytes, of this process or, with
+    RUSAGE_CHILDREN, of the largest of its finished child processes.
+    """
+    peak_rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return peak_rss
+
+
+def _read_proc_status(field):
+    """
+    Return a memory field of /proc/self/status, such as VmRSS, in bytes,
+    or None where there is no /proc.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak resident set size of this process reported in
+    /proc/self/status, and return whether it could be reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _take_snapshot():
+    """
+    Take a tracemalloc snapshot, without the allocations of tracemalloc
+    itself and of imports.
+    """
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+
+
+class MemoryUsage(object):
+    """
+    The memory use of a stage: the peak and net change of the memory
+    allocated by Python, traced by tracemalloc, the peak and final resident
+    set size of the process, the peak resident set size of the largest
+    child process, such as fmcalc, finished so far, and the allocation
+    sites with the largest net change.
+    """
+
+    def __init__(self):
+        (self.traced_start, self.traced_peak) = tracemalloc.get_traced_memory()
+        self.snapshot = _take_snapshot()
+        self.peak_rss = 0
+        self.rss = None
+        self.children_peak_rss = None
+        self.traced_diff = None
+        self.top_allocations = []
+
+    def update_peaks(self, traced_peak, peak_rss):
+        self.traced_peak = max(self.traced_peak, traced_peak)
+        self.peak_rss = max(self.peak_rss, peak_rss)
+
+    def finish(self):
+        self.traced_diff = tracemalloc.get_traced_memory()[0] - self.traced_start
+        self.rss = _read_proc_status("VmRSS")
+        self.children_peak_rss = get_peak_rss(resource.RUSAGE_CHILDREN)
+        snapshot = _take_snapshot()
+        self.top_allocations = [
+            OrderedDict([
+                ('location', "{}:{}".format(
+                    statistic.traceback[0].filename, statistic.traceback[0].lineno)),
+                ('size_diff', statistic.size_diff),
+                ('count_diff', statistic.count_diff)])
+            for statistic in snapshot.compare_to(self.snapshot, 'lineno')[:TOP_ALLOCATIONS]
+            if statistic.size_diff != 0]
+        self.snapshot = None
+
+    def to_dict(self):
+        return OrderedDict([
+            ('traced_peak', self.traced_peak),
+            ('traced_diff', self.traced_diff),
+            ('peak_rss', self.peak_rss),
+            ('rss', self.rss),
+            ('children_peak_rss', self.children_peak_rss),
+            ('top_allocations', self.top_allocations),
+        ])
+
+
+def _update_memory_peaks(reset_peak_rss=False):
+    """
+    Add the peaks since the last update to every running stage, and reset
+    them where possible, so that a stage started now only sees its own
+    peaks. The peak resident set size is reset if reset_peak_rss is set or
+    a running stage asked for it. Called with _memory_lock held.
+    """
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    peak_rss = _read_proc_status("VmHWM") or get_peak_rss()
+    for span in _memory_spans:
+        span.memory.update_peaks(traced_peak, peak_rss)
+    if not _owns_tracing:
+        return
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    if reset_peak_rss or any(span.reset_peak_rss for span in _memory_spans):
+        _reset_peak_rss()
+
+
+def _start_memory(span, reset_peak_rss):
+    global _owns_tracing
+    with _memory_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            _owns_tracing = True
+        _update_memory_peaks(reset_peak_rss)
+        span.memory = MemoryUsage()
+        span.reset_peak_rss = reset_peak_rss
+        _memory_spans.append(span)
+
+
+def _end_memory(span):
+    global _owns_tracing
+    with _memory_lock:
+        _update_memory_peaks()
+        _memory_spans.remove(span)
+        span.memory.finish()
+        if _owns_tracing and not _memory_spans:
+            tracemalloc.stop()
+            _owns_tracing = False
+
+
+class Span(object):
+    """
+    A timed piece of work, and the span it was started in on the same thread.
+    """
+
+    def __init__(self, name, category, parent, attributes):
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.attributes = attributes
+        self.thread = threading.current_thread().name
+        self.profiler = None
+        self.memory = None
+        self.reset_peak_rss = False
+        self.t_start = time.time()
+        self.t_end = None
+
+
+class RunProfile(object):
+    """
+    The spans and counts of a run. Spans can be nested, and can be recorded
+    from any thread. Spans whose names match one of cprofile_stages, as
+    fnmatch patterns such as "ri_*", are also run under cProfile, and their
+    stats dumped to "<name>.<n>.prof" in output_dir, or on write if it is not
+    set yet. cProfile only sees the thread a span runs on, and spans within a
+    profiled span are not profiled separately.
+    If memory is set, the MemoryUsage of each stage span is recorded. Python
+    allocations are traced while any stage is running, which slows the run.
+    Profiles can record memory at the same time. The peaks of each stage
+    are its own, though they include the work of other threads and
+    profiles running at the same time. The traced peak is the peak so far
+    before Python 3.9, and the peak resident set size is the process peak
+    so far unless reset_peak_rss is set. That resets it through
+    /proc/self/clear_refs, which also clears the referenced bits of the
+    pages of the whole process.
+    """
+
+    def __init__(
+            self, cprofile_stages=(), output_dir=None, memory=False,
+            reset_peak_rss=False):
+        self.t_start = time.time()
+        self.cprofile_stages = list(cprofile_stages)
+        self.output_dir = output_dir
+        self.memory = memory
+        self.reset_peak_rss = reset_peak_rss
+        self.spans = []
+        self.counts = OrderedDict()
+        self.cprofile_files = []
+        self._pending_stats = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def start_span(self, name, category=None, **attributes):
+        """
+        Start a span, which is recorded when it is passed to end_span.
+        """
+        stack = self._get_stack()
+        span = Span(
+            name, category, stack[-1].name if stack else None, attributes)
+        if any(fnmatch.fnmatch(name, pattern) for pattern in self.cprofile_stages) and \
+                not any(outer.profiler is not None for outer in stack):
+            span.profiler = cProfile.Profile()
+            span.profiler.enable()
+        if self.memory and category == CATEGORY_STAGE:
+            _start_memory(span, self.reset_peak_rss)
+        stack.append(span)
+        return span
+
+    def end_span(self, span):
+        span.t_end = time.time()
+        if span.profiler is not None:
+            span.profiler.disable()
+            self._dump_stats(span)
+        if span.memory is not None:
+            _end_memory(span)
+        stack = self._get_stack()
+        if span in stack:
+            stack.remove(span)
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, category=None, **attributes):
+        """
+        Time the body of a with statement as a span.
+        """
+        span = self.start_span(name, category, **attributes)
+        try:
+            yield span
+        finally:
+            self.end_span(span)
+
+    def get_memory(self):
+        """
+        Return the MemoryUsage of each stage, as a dict, in the order they started.
+        """
+        return OrderedDict(
+            (span.name, span.memory.to_dict())
+            for span in sorted(self.spans, key=lambda span: span.t_start)
+            if span.memory is not None)
+
+    def _dump_stats(self, span):
+        with self._lock:
+            file_name = "{}.{}.prof".format(span.name, len(self.cprofile_files) + 1)
+            self.cprofile_files.append(file_name)
+        span.attributes['cprofile_file'] = file_name
+        if self.output_dir is None:
+            with self._lock:
+                self._pending_stats.append((file_name, span.profiler))
+        else:
+            span.profiler.dump_stats(os.path.join(self.output_dir, file_name))
+        span.profiler = None
+
+    def count(self, scope, **counts):
+        """
+        Record counts, such as the number of items, of a scope such as a layer.
+        """
+        with self._lock:
+            self.counts.setdefault(scope, OrderedDict()).update(
+                (name, int(value)) for (name, value) in counts.items())
+
+    def get_times(self, category=None):
+        """
+        Return the total duration in seconds of the spans of each name,
+        optionally only those in a category, in the order they started.
+        """
+        times = OrderedDict()
+        for span in sorted(self.spans, key=lambda span: span.t_start):
+            if category is None or span.category == category:
+                times[span.name] = times.get(span.name, 0.0) + span.t_end - span.t_start
+        return times
+
+    def to_dict(self):
+        return OrderedDict([
+            ('start', time.strftime(
+                "%Y-%m-%dT%H:%M:%S", time.localtime(self.t_start))),
+            ('stage_times', self.get_times(CATEGORY_STAGE)),
+            ('spans', [
+                OrderedDict([
+                    ('name', span.name),
+                    ('category', span.category),
+                    ('parent', span.parent),
+                    ('thread', span.thread),
+                    ('start', span.t_start - self.t_start),
+                    ('duration', span.t_end - span.t_start),
+                    ('attributes', span.attributes)])
+                for span in sorted(self.spans, key=lambda span: span.t_start)]),
+            ('counts', self.counts),
+            ('cprofile_files', self.cprofile_files),
+        ])
+
+    def write(self, file_path=None):
+        """
+        Write the profile as JSON, by default to PROFILE_FILE in output_dir.
+        If memory is recorded, the memory use of each stage is written to
+        MEMORY_FILE in the same directory.
+        """
+        if file_path is None:
+            file_path = os.path.join(self.output_dir, PROFILE_FILE)
+        with self._lock:
+            (pending_stats, self._pending_stats) = (self._pending_stats, [])
+        for (file_name, profiler) in pending_stats:
+            profiler.dump_stats(os.path.join(os.path.dirname(file_path), file_name))
+        with open(file_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4, default=str)
+        if self.memory:
+            with open(os.path.join(os.path.dirname(file_path), MEMORY_FILE), 'w') as f:
+                json.dump(self.get_memory(), f, indent=4)
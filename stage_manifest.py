@@ -0,0 +1,87 @@
+"""
+Tracks the stages of a run in its run directory: the direct structures, the
+direct losses, then each inuring priority and risk level. Each stage records
+a fingerprint of its inputs, which includes the fingerprint of the stage
+before it, so a rerun in the same directory only recomputes the stages whose
+inputs have changed and the stages downstream of them.
+"""
+import hashlib
+import json
+import os
+import pandas as pd
+from structure_cache import hash_df
+
+MANIFEST_FILE = "stages.json"
+
+
+def get_fingerprint(*inputs):
+    """
+    Return a fingerprint of the inputs of a stage. Inputs are DataFrames, or
+    values with a stable repr such as the fingerprint of an upstream stage.
+    """
+    fingerprint = hashlib.sha256()
+    for value in inputs:
+        if isinstance(value, pd.DataFrame):
+            hash_df(fingerprint, value)
+        else:
+            fingerprint.update(repr(value).encode())
+        fingerprint.update(b"\0")
+    return fingerprint.hexdigest()
+
+
+class StageManifest(object):
+    """
+    The fingerprint and output files of each completed stage in a run
+    directory, and the losses that the stage returned.
+    """
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.manifest_file = os.path.join(run_dir, MANIFEST_FILE)
+        self.stages = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.stages = json.load(f)
+
+    def _get_losses_file(self, name):
+        return os.path.join(self.run_dir, "{}_losses.pkl".format(name))
+
+    def is_current(self, name, fingerprint):
+        """
+        Has the stage been run on inputs with this fingerprint, and are
+        its outputs still there?
+        """
+        stage = self.stages.get(name)
+        return (
+            stage is not None and
+            stage['fingerprint'] == fingerprint and
+            all(os.path.exists(os.path.join(self.run_dir, output))
+                for output in stage['outputs']))
+
+    def get_losses(self, name):
+        return pd.read_pickle(self._get_losses_file(name))
+
+    def invalidate(self, name):
+        """
+        Remove a stage before it is recomputed, so that its outputs are not
+        reused if it does not complete.
+        """
+        if self.stages.pop(name, None) is not None:
+            self._save()
+
+    def record(self, name, fingerprint, outputs, losses_df=None):
+        """
+        Record a completed stage, with its output files relative to the
+        run directory, and the losses it returned.
+        """
+        if losses_df is not None:
+            losses_df.to_pickle(self._get_losses_file(name))
+            outputs = outputs + [os.path.basename(self._get_losses_file(name))]
+        self.stages[name] = {'fingerprint': fingerprint, 'outputs': outputs}
+        self._save()
+
+    def _save(self):
+        temp_file = self.manifest_file + ".tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(self.stages, f, indent=4, sort_keys=True)
+        os.replace(temp_file, self.manifest_file)
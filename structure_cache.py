@@ -0,0 +1,155 @@
+"""
+On disk cache of the Oasis structures generated for a set of OED inputs.
+Entries are keyed by a hash of the account, location and reinsurance
+columns that the structures are built from, so runs on the same inputs,
+for example with a different loss factor, reuse the ktools binaries and
+xref descriptions rather than regenerating them. The cache is held to a
+maximum size by evicting the least recently used entries.
+"""
+import hashlib
+import os
+import shutil
+import uuid
+import pandas as pd
+import common
+
+# Changing the structures that are generated invalidates existing entries
+CACHE_VERSION = "1"
+
+XREF_DESCRIPTIONS_FILE = "xref_descriptions.pkl"
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+
+def hash_df(hash, df):
+    """
+    Add the column names, types and values of a DataFrame to a hashlib hash,
+    so that the same inputs give the same key whatever their index. Used for
+    the cache keys here and the stage fingerprints of stage_manifest.
+    """
+    hash.update(repr([(str(c), str(t)) for (c, t) in df.dtypes.items()]).encode())
+    hash.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+
+
+class StructureCache(object):
+    """
+    A cache directory with one subdirectory per entry. An entry holds the
+    ktools binary directory of each layer, e.g. direct and ri_1_LOC, and the
+    xref descriptions of the direct layer.
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get_key(self, account_df, location_df, ri_info_df, ri_scope_df):
+        """
+        Return the cache key for a set of OED inputs, a hash of the columns
+        the Oasis structures are generated from.
+        """
+        key = hashlib.sha256(CACHE_VERSION.encode())
+        for (df, fields) in [
+                (account_df, common.OED_ACCOUNT_FIELDS),
+                (location_df, common.OED_LOCATION_FIELDS),
+                (ri_info_df, common.OED_REINS_INFO_FIELDS),
+                (ri_scope_df, common.OED_REINS_SCOPE_FIELDS)]:
+            if df is None:
+                key.update(b"None")
+                continue
+            hash_df(key, df[fields])
+        return key.hexdigest()
+
+    def _get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, run_dir):
+        """
+        Copy the layer directories of an entry into run_dir and return the
+        xref descriptions, or None if the entry is not in the cache.
+        """
+        entry_dir = self._get_entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return None
+        copied = []
+        try:
+            # Mark the entry as used, for eviction
+            os.utime(entry_dir, None)
+            for name in os.listdir(entry_dir):
+                path = os.path.join(entry_dir, name)
+                if os.path.isdir(path):
+                    copied.append(os.path.join(run_dir, name))
+                    if os.path.exists(copied[-1]):
+                        shutil.rmtree(copied[-1])
+                    shutil.copytree(path, copied[-1])
+            return pd.read_pickle(os.path.join(entry_dir, XREF_DESCRIPTIONS_FILE))
+        except (IOError, OSError):
+            # Evicted while it was being read
+            for path in copied:
+                shutil.rmtree(path, ignore_errors=True)
+            return None
+
+    def put(self, key, run_dir, layer_names, xref_descriptions):
+        """
+        Add the layer directories in run_dir, and the xref descriptions,
+        to the cache under key, then evict entries to fit the maximum size.
+        """
+        entry_dir = self._get_entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+
+        # Build the entry under a temporary name, so that it appears whole
+        temp_dir = os.path.join(
+            self.cache_dir, ".{}.{}".format(key, uuid.uuid4().hex))
+        try:
+            os.mkdir(temp_dir)
+            for name in layer_names:
+                shutil.copytree(
+                    os.path.join(run_dir, name), os.path.join(temp_dir, name))
+            xref_descriptions.to_pickle(
+                os.path.join(temp_dir, XREF_DESCRIPTIONS_FILE))
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # Another run added the same entry first
+            if not os.path.exists(entry_dir):
+                raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def get_entries(self):
+        """
+        Return (last used time, size in bytes, key) for each entry,
+        least recently used first.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._get_entry_dir(key)
+            if key.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            size = 0
+            for (directory, _, file_names) in os.walk(entry_dir):
+                for file_name in file_names:
+                    size += os.path.getsize(os.path.join(directory, file_name))
+            entries.append((os.path.getmtime(entry_dir), size, key))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries, other than keep, until
+        the cache is no larger than the maximum size.
+        """
+        entries = self.get_entries()
+        total_size = sum(size for (_, size, _) in entries)
+        for (_, size, key) in entries:
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._get_entry_dir(key), ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        for (_, _, key) in self.get_entries():
+            shutil.rmtree(self._get_entry_dir(key), ignore_errors=True)
@@ -0,0 +1,57 @@
+"""
+    Check running many cases at once with the batch runner.
+    Run using:
+        python -m unittest -v tests/test_batch_runner.py
+        py.test -v tests/test_batch_runner.py
+"""
+import unittest
+from pandas.util.testing import assert_frame_equal
+
+import os
+import sys
+import shutil
+import tempfile
+import pandas as pd
+from pathlib import Path
+
+top_level_dir = str(Path(__file__).parents[1])
+sys.path.insert(0, top_level_dir)
+import batch_runner
+
+
+input_dir = os.path.join(top_level_dir, 'examples')
+expected_output_dir = os.path.join(top_level_dir, 'tests', 'expected', 'calc')
+
+
+class test_batch_runner(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_run_batch(self):
+        # A case whose account file is missing its columns
+        broken_dir = os.path.join(self.output_dir, 'broken_account')
+        shutil.copytree(os.path.join(input_dir, 'simple_QS'), broken_dir)
+        with open(os.path.join(broken_dir, 'account.csv'), 'w') as f:
+            f.write("Unknown\n1\n")
+
+        cases = ['simple_QS', 'multiple_FAC', 'broken_account']
+        summary_df = batch_runner.run_batch(
+            [os.path.join(input_dir, case) for case in cases[:2]] + [broken_dir],
+            os.path.join(self.output_dir, 'output'), processes=2)
+
+        self.assertEqual(summary_df.name.tolist(), cases)
+        self.assertEqual(
+            summary_df.status.tolist(),
+            [batch_runner.STATUS_SUCCESS, batch_runner.STATUS_SUCCESS,
+             batch_runner.STATUS_FAILED])
+        self.assertTrue(summary_df.error[2].startswith('KeyError'))
+        for case in cases[:2]:
+            case_output_dir = os.path.join(self.output_dir, 'output', case)
+            for file_name in os.listdir(case_output_dir):
+                assert_frame_equal(
+                    pd.read_csv(os.path.join(case_output_dir, file_name)),
+                    pd.read_csv(os.path.join(expected_output_dir, case, file_name)))
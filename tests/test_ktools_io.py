@@ -0,0 +1,217 @@
+"""
+    Check the native ktools binary writers against the ktools conversion tools.
+    Run using:
+        python -m unittest -v tests/test_ktools_io.py
+        py.test -v tests/test_ktools_io.py
+"""
+import unittest
+from parameterized import parameterized
+
+import io
+import os
+import sys
+import shutil
+import subprocess
+import pandas as pd
+from pathlib import Path
+from pandas.util.testing import assert_frame_equal
+
+top_level_dir = str(Path(__file__).parents[1])
+sys.path.insert(0, top_level_dir)
+import reinsurance_tester
+import ktools_io
+import common
+from direct_layer import DirectLayer
+from reinsurance_layer import ReinsuranceLayer
+
+
+input_dir = os.path.join(top_level_dir, 'examples')
+test_cases = [
+    (case, os.path.join(input_dir, case))
+    for case in ['simple_QS', 'loc_SS', 'multiple_FAC', 'multiple_CAT_XL']]
+
+# Loss streams with the matching fmtocsv output
+run_dir = os.path.join(top_level_dir, 'run')
+loss_stream_cases = [
+    (name, os.path.join(run_dir, name), chunk_size)
+    for name in ['ils', 'ri_1_LOC']
+    for chunk_size in [8, 20, ktools_io.LOSS_STREAM_CHUNK_SIZE]]
+
+
+class test_ktools_io(unittest.TestCase):
+
+    def setUp(self):
+        # The conversion tools are referenced relative to the run directory
+        self.cwd = os.getcwd()
+        self.run_dir = os.path.join(top_level_dir, 'ktools_io_testing')
+        if os.path.exists(self.run_dir):
+            shutil.rmtree(self.run_dir)
+        os.mkdir(self.run_dir)
+        os.chdir(self.run_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.run_dir)
+
+    def assert_same_binaries(self, layer, directory):
+        layer.write_oasis_files(use_conversion_tools=True)
+        os.rename(directory, 'expected')
+        layer.write_oasis_files()
+        for input_file in sorted(os.listdir('expected')):
+            if not input_file.endswith('.bin'):
+                continue
+            with open(os.path.join('expected', input_file), 'rb') as f:
+                expected = f.read()
+            with open(os.path.join(directory, input_file), 'rb') as f:
+                actual = f.read()
+            self.assertEqual(actual, expected, input_file)
+        shutil.rmtree('expected')
+
+    @parameterized.expand(test_cases)
+    def test_write_input_files(self, name, case_dir):
+        (
+            account_df,
+            location_df,
+            ri_info_df,
+            ri_scope_df,
+            do_reinsurance
+        ) = reinsurance_tester.load_oed_dfs(case_dir)
+
+        direct_layer = DirectLayer(account_df, location_df)
+        direct_layer.generate_oasis_structures()
+        self.assert_same_binaries(direct_layer, 'direct')
+
+        ri_info_1_df = ri_info_df[ri_info_df.InuringPriority == 1]
+        risk_level = ri_scope_df[
+            ri_scope_df.ReinsNumber.isin(ri_info_1_df.ReinsNumber)].RiskLevel.iloc[0]
+        reinsurance_layer = ReinsuranceLayer(
+            name='ri_1',
+            ri_info=ri_info_1_df,
+            ri_scope=ri_scope_df,
+            accounts=account_df,
+            locations=location_df,
+            items=direct_layer.items,
+            coverages=direct_layer.coverages,
+            fm_xrefs=direct_layer.fm_xrefs,
+            xref_descriptions=direct_layer.xref_descriptions,
+            risk_level=risk_level)
+        reinsurance_layer.generate_oasis_structures()
+        self.assert_same_binaries(reinsurance_layer, 'ri_1')
+
+    def test_conversion_tool_failures(self):
+        (account_df, location_df, _, _, _) = reinsurance_tester.load_oed_dfs(
+            os.path.join(input_dir, 'simple_QS'))
+        direct_layer = DirectLayer(account_df, location_df)
+        direct_layer.generate_oasis_structures()
+        direct_layer.write_oasis_files(debug=True)
+
+        # Every file fails without the ktools binaries, and all are reported
+        os.mkdir('no_ktools')
+        session = common.AnalysisSession(
+            self.run_dir, ktools_dir='no_ktools', max_processes=2)
+        input_files = ['coverages', 'items', 'fm_programme', 'fm_profile']
+        with self.assertRaises(Exception) as context:
+            common.run_conversion_tools(input_files, ".", "direct", session=session)
+        for input_file in input_files:
+            self.assertIn(input_file + ".csv", str(context.exception))
+
+
+class test_loss_stream(unittest.TestCase):
+
+    @parameterized.expand(loss_stream_cases)
+    def test_read_loss_stream(self, name, file_path, chunk_size):
+        with open(file_path + '.bin', 'rb') as f:
+            stream = io.BytesIO(f.read())
+        tee = io.BytesIO()
+        losses_df = ktools_io.read_loss_stream(
+            stream, tee=tee, decimals=2, chunk_size=chunk_size)
+
+        assert_frame_equal(losses_df, pd.read_csv(file_path + '.csv'))
+        self.assertEqual(tee.getvalue(), stream.getvalue())
+
+    def test_unterminated_loss_stream(self):
+        # Only a GUL item stream can leave its last record unterminated
+        gul_stream = io.BytesIO()
+        ktools_io.write_gul_stream(
+            gul_stream, [1, 1, 2], [1, 2, 1], [1.0, 2.0, 3.0])
+        assert_frame_equal(
+            ktools_io.read_loss_stream(io.BytesIO(
+                gul_stream.getvalue()[:-ktools_io.LOSS_STREAM_PAIR_SIZE])),
+            ktools_io.read_loss_stream(io.BytesIO(gul_stream.getvalue())))
+
+        with open(os.path.join(run_dir, 'ils.bin'), 'rb') as f:
+            fm_stream = f.read()
+        with self.assertRaisesRegex(Exception, "^Truncated loss stream"):
+            ktools_io.read_loss_stream(
+                io.BytesIO(fm_stream[:-ktools_io.LOSS_STREAM_PAIR_SIZE]))
+
+    def test_read_loss_stream_sidx(self):
+        losses_df = ktools_io.read_loss_file(
+            os.path.join(run_dir, 'ils.bin'), sidx=1, decimals=2)
+        expected_df = pd.read_csv(os.path.join(run_dir, 'ils.csv'))
+        expected_df = expected_df[expected_df.sidx == 1].reset_index(drop=True)
+
+        assert_frame_equal(losses_df, expected_df)
+
+    def test_write_gul_stream(self):
+        # gultobin does not terminate the last record
+        guls_file = os.path.join(run_dir, 'guls.csv')
+        with open(guls_file) as f:
+            expected = subprocess.check_output(
+                [os.path.join(top_level_dir, 'ktools', 'gultobin'), '-S', '1'],
+                stdin=f)
+        guls_df = pd.read_csv(guls_file)
+        guls_df = guls_df[guls_df.sidx == 1]
+        stream = io.BytesIO()
+        ktools_io.write_gul_stream(
+            stream, guls_df.event_id.values, guls_df.item_id.values,
+            guls_df.loss.values)
+
+        self.assertEqual(
+            stream.getvalue(),
+            expected + bytes(ktools_io.LOSS_STREAM_PAIR_SIZE))
+
+    def test_loss_stream_sizes(self):
+        stream = io.BytesIO()
+        ktools_io.write_gul_stream(
+            stream, [1, 1, 2], [1, 2, 1], [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+        self.assertEqual(
+            len(stream.getvalue()), ktools_io.get_gul_stream_size(3, 2))
+
+        # Every record of the fmcalc output has a loss
+        losses_df = pd.read_csv(os.path.join(run_dir, 'ils.csv'))
+        self.assertEqual(
+            os.path.getsize(os.path.join(run_dir, 'ils.bin')),
+            ktools_io.get_fm_stream_size(
+                len(losses_df[['event_id', 'output_id']].drop_duplicates().index), 1))
+
+    def test_split_loss_stream(self):
+        stream = io.BytesIO()
+        ktools_io.write_gul_stream(
+            stream, [1, 1, 2, 4, 4, 5, 7], [1, 2, 1, 1, 2, 2, 1],
+            [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0], [7.0, 8.0], [9.0, 10.0],
+             [11.0, 12.0], [13.0, 14.0]])
+        losses_df = ktools_io.read_loss_stream(io.BytesIO(stream.getvalue()))
+
+        partitions = ktools_io.split_loss_stream(stream.getvalue(), 3)
+        partition_dfs = [
+            ktools_io.read_loss_stream(io.BytesIO(partition))
+            for partition in partitions]
+        self.assertEqual(
+            [sorted(df.event_id.unique()) for df in partition_dfs],
+            [[1, 2], [4, 5], [7]])
+        assert_frame_equal(
+            pd.concat(partition_dfs, ignore_index=True), losses_df)
+
+        # No more partitions than events
+        self.assertEqual(
+            len(ktools_io.split_loss_stream(stream.getvalue(), 10)), 5)
+
+        # Partitions streamed from the bounds match the split
+        for (partition, bounds) in zip(
+                partitions,
+                ktools_io.get_loss_stream_partitions(stream.getvalue(), 3)):
+            partition_stream = io.BytesIO()
+            ktools_io.write_loss_stream_partition(
+                partition_stream, stream.getvalue(), *bounds)
+            self.assertEqual(partition_stream.getvalue(), partition)
@@ -0,0 +1,58 @@
+"""
+    Check the micro benchmarks and their comparison with a baseline.
+    Run using:
+        python -m unittest -v tests/test_micro_benchmark.py
+        py.test -v tests/test_micro_benchmark.py
+"""
+import unittest
+
+import sys
+from pathlib import Path
+
+top_level_dir = str(Path(__file__).parents[1])
+sys.path.insert(0, top_level_dir)
+import common
+import micro_benchmark
+
+
+class test_micro_benchmark(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        results = micro_benchmark.run_benchmarks([20, 40], repeat=1)
+
+        self.assertEqual(
+            list(results['benchmarks'].keys()), list(micro_benchmark.BENCHMARKS.keys()))
+        for result in results['benchmarks'].values():
+            self.assertEqual(len(result['times']), 2)
+            self.assertIsNotNone(result['exponent'])
+        self.assertEqual(micro_benchmark.compare(results, results), [])
+
+    def test_fixture(self):
+        # Each risk treaty has a scope row for every location
+        fixture = micro_benchmark.Fixture(40)
+        for (inuring_priority, (reins_type, risk_level)) in enumerate(
+                micro_benchmark.PROFILE_TREATIES.values(), 1):
+            ri_info_df = fixture.ri_info_df[
+                fixture.ri_info_df.InuringPriority == inuring_priority]
+            self.assertEqual(list(ri_info_df.ReinsType.unique()), [reins_type])
+            ri_scope_df = fixture.ri_scope_df[
+                fixture.ri_scope_df.ReinsNumber.isin(ri_info_df.ReinsNumber)]
+            self.assertEqual(list(ri_scope_df.RiskLevel.unique()), [risk_level])
+            self.assertEqual(
+                len(ri_scope_df.index),
+                1 if risk_level == common.REINS_RISK_LEVEL_PORTFOLIO else 40)
+
+    def test_compare(self):
+        baseline = {
+            'sizes': [1000, 2000],
+            'benchmarks': {'add_fac_profiles': {'times': [0.01, 0.02], 'exponent': 1.0}}}
+        quadratic = {
+            'sizes': [1000, 2000],
+            'benchmarks': {'add_fac_profiles': {'times': [0.01, 0.04], 'exponent': 2.0}}}
+
+        self.assertEqual(micro_benchmark.compare(baseline, baseline), [])
+        self.assertEqual(
+            micro_benchmark.compare(quadratic, baseline),
+            ["add_fac_profiles grows as size ** 2.00, baseline size ** 1.00"])
+        self.assertEqual(
+            len(micro_benchmark.compare(quadratic, baseline, time_tolerance=1.5)), 2)
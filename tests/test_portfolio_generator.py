@@ -0,0 +1,91 @@
+"""
+    Check the synthetic portfolios, and the benchmark that runs them.
+    Run using:
+        python -m unittest -v tests/test_portfolio_generator.py
+        py.test -v tests/test_portfolio_generator.py
+"""
+import unittest
+from parameterized import parameterized
+from pandas.util.testing import assert_frame_equal
+
+import json
+import os
+import sys
+import shutil
+import tempfile
+from pathlib import Path
+
+top_level_dir = str(Path(__file__).parents[1])
+sys.path.insert(0, top_level_dir)
+import reinsurance_tester
+import benchmark
+import common
+import portfolio_generator
+
+
+class test_portfolio_generator(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    @parameterized.expand([
+        ('default', portfolio_generator.DEFAULT_TREATIES),
+        ('qs', portfolio_generator.get_treaties(
+            [common.REINS_TYPE_QUOTA_SHARE], common.REINS_RISK_LEVELS, 3)),
+        ('fac_cat_xl', portfolio_generator.get_treaties(
+            [common.REINS_TYPE_FAC, common.REINS_TYPE_CAT_XL],
+            common.REINS_RISK_LEVELS, 4, layer_count=2)),
+        ('pr', portfolio_generator.get_treaties(
+            [common.REINS_TYPE_PER_RISK], common.REINS_RISK_LEVELS, 3, layer_count=2)),
+    ])
+    def test_generate_portfolio(self, name, treaties):
+        portfolio = portfolio_generator.generate_portfolio(
+            4, 5, policies_per_account=2,
+            tiv_distribution=portfolio_generator.TIV_DISTRIBUTION_LOGNORMAL,
+            treaties=treaties, seed=1)
+        (account_df, location_df, ri_info_df, ri_scope_df) = portfolio
+        self.assertEqual(len(account_df.index), 8)
+        self.assertEqual(len(location_df.index), 20)
+        self.assertEqual(
+            ri_info_df.InuringPriority.max(),
+            max(treaty.inuring_priority for treaty in treaties))
+
+        (is_valid, _) = reinsurance_tester.validate_reinsurance_structures(*portfolio)
+        self.assertTrue(is_valid)
+
+        # The same seed gives the same portfolio, and it loads as OED files
+        portfolio_generator.write_portfolio(
+            self.output_dir,
+            *portfolio_generator.generate_portfolio(
+                4, 5, policies_per_account=2,
+                tiv_distribution=portfolio_generator.TIV_DISTRIBUTION_LOGNORMAL,
+                treaties=treaties, seed=1))
+        loaded = reinsurance_tester.load_oed_dfs(self.output_dir)
+        for (df, loaded_df) in zip(portfolio, loaded):
+            assert_frame_equal(df, loaded_df, check_dtype=False)
+
+        net_losses = reinsurance_tester.run_test(
+            "ri_testing",
+            account_df, location_df, ri_info_df, ri_scope_df,
+            1.0,
+            True,
+            session=common.AnalysisSession(self.output_dir))
+        self.assertEqual(len(net_losses), len(treaties) + 1)
+
+    def test_benchmark(self):
+        output_file = os.path.join(self.output_dir, "benchmark.json")
+        results = benchmark.run_benchmark(
+            [100, 200], output_file, locations_per_account=50, event_count=2)
+
+        with open(output_file) as f:
+            self.assertEqual(json.load(f), results)
+        self.assertEqual(
+            [result['location_count'] for result in results['results']], [100, 200])
+        for result in results['results']:
+            self.assertEqual(
+                sorted(result['stage_times'].keys()),
+                ['direct', 'ils', 'ri_1_LOC', 'ri_2_LOC', 'ri_3_ACC', 'ri_4_SEL', 'total'])
+            self.assertGreater(result['peak_rss'], 0)
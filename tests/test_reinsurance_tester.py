@@ -12,11 +12,20 @@ from pandas.util.testing import assert_frame_equal
 import pandas as pd
 import os 
 import sys
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from unittest import mock
 
 top_level_dir = str(Path(__file__).parents[1])
 sys.path.insert(0, top_level_dir)
 import reinsurance_tester
+import common
+import run_profile
+from direct_layer import DirectLayer
+from structure_cache import StructureCache
 
 
 expected_output_dir = os.path.join(top_level_dir, 'tests', 'expected', 'calc')
@@ -76,6 +85,13 @@ for case in fm_examples:
 
 
 class test_reinsurance_values(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
     @parameterized.expand(test_cases)
     def test_fmcalc(self, name, case_dir, expected_dir):
         loss_factor = 1.0
@@ -92,6 +108,7 @@ class test_reinsurance_values(unittest.TestCase):
             account_df, location_df, ri_info_df, ri_scope_df,
             loss_factor,
             do_reinsurance,
+            session=common.AnalysisSession(self.workspace)
         )
 
         for key in net_losses.keys():
@@ -104,5 +121,505 @@ class test_reinsurance_values(unittest.TestCase):
             assert_frame_equal(net_losses[key],
                                expected_df)
 
+    @parameterized.expand(test_cases)
+    def test_numpy_fm(self, name, case_dir, expected_dir):
+        loss_factor = 1.0
+        (
+            account_df,
+            location_df,
+            ri_info_df,
+            ri_scope_df,
+            do_reinsurance
+        ) = reinsurance_tester.load_oed_dfs(case_dir)
+
+        net_losses = reinsurance_tester.run_test(
+            "ri_testing",
+            account_df, location_df, ri_info_df, ri_scope_df,
+            loss_factor,
+            do_reinsurance,
+            fm_engine=common.FM_ENGINE_NUMPY,
+            session=common.AnalysisSession(self.workspace)
+        )
+
+        for key in net_losses.keys():
+            expected_file = os.path.join(
+                expected_dir,
+                "{}.csv".format(key.replace(' ', '_'))
+            )
+
+            expected_df = pd.read_csv(expected_file)
+            assert_frame_equal(net_losses[key],
+                               expected_df)
+
+
+
+event_loss_set_cases = [
+    (case, os.path.join(input_dir, case))
+    for case in ['simple_QS', 'multiple_QS_2', 'multiple_FAC', 'multiple_CAT_XL']]
+event_loss_set_cases.append(('fm24', os.path.join(fm_input_dir, 'fm24')))
+
+# (event_id, sidx, damage ratio)
+event_damage_ratios = [(1, 1, 1.0), (1, 2, 0.5), (2, 1, 0.5), (2, 2, 0.25)]
+
+
+class net_losses_test_case(unittest.TestCase):
+    """
+    Runs the OED inputs of a case, as returned by load_oed_dfs, and compares
+    the net losses of the runs. Runs are made in a temporary workspace,
+    unless a session is given.
+    """
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def run_case(self, oed_dfs, loss_factor=1.0, **kwargs):
+        kwargs.setdefault('session', common.AnalysisSession(self.workspace))
+        (
+            account_df,
+            location_df,
+            ri_info_df,
+            ri_scope_df,
+            do_reinsurance
+        ) = oed_dfs
+        return reinsurance_tester.run_test(
+            "ri_testing",
+            account_df, location_df, ri_info_df, ri_scope_df,
+            loss_factor,
+            do_reinsurance,
+            **kwargs)
+
+    def assert_net_losses_equal(self, net_losses, expected_net_losses):
+        self.assertEqual(
+            list(net_losses.keys()), list(expected_net_losses.keys()))
+        for key in net_losses.keys():
+            assert_frame_equal(net_losses[key], expected_net_losses[key])
+
+    def assert_single_event_losses_equal(self, losses_df, expected_df):
+        # The single event outputs omit items with no net loss
+        expected_df = pd.merge(
+            losses_df[expected_df.columns[:6]], expected_df, how='left')
+        expected_df.fillna(0.0, inplace=True)
+        assert_frame_equal(losses_df.reset_index(drop=True), expected_df)
+
+
+class test_event_loss_set(net_losses_test_case):
+    @parameterized.expand(event_loss_set_cases)
+    def test_event_loss_set(self, name, case_dir):
+        oed_dfs = reinsurance_tester.load_oed_dfs(case_dir)
+
+        # Each event and sample should match a run with that loss factor
+        expected_net_losses = {}
+        for loss_factor in set(r[2] for r in event_damage_ratios):
+            expected_net_losses[loss_factor] = self.run_case(oed_dfs, loss_factor)
+
+        item_count = len(expected_net_losses[1.0]['Direct'].index)
+        event_loss_set = pd.concat([
+            pd.DataFrame({
+                'event_id': event_id,
+                'item_id': range(1, item_count + 1),
+                'sidx': sidx,
+                'damage_ratio': damage_ratio})
+            for (event_id, sidx, damage_ratio) in event_damage_ratios])
+        net_losses = self.run_case(oed_dfs, event_loss_set=event_loss_set)
+
+        self.assertEqual(
+            list(net_losses.keys()), list(expected_net_losses[1.0].keys()))
+        for key in net_losses.keys():
+            for (event_id, sidx, damage_ratio) in event_damage_ratios:
+                losses_df = net_losses[key]
+                losses_df = losses_df[
+                    (losses_df.event_id == event_id) & (losses_df.sidx == sidx)]
+                del losses_df['event_id']
+                del losses_df['sidx']
+                self.assert_single_event_losses_equal(
+                    losses_df, expected_net_losses[damage_ratio][key])
+
+    @parameterized.expand(event_loss_set_cases)
+    def test_numpy_fm_event_loss_set(self, name, case_dir):
+        oed_dfs = reinsurance_tester.load_oed_dfs(case_dir)
+
+        # Uneven damage ratios, with some items and samples missing
+        item_count = len(self.run_case(oed_dfs)['Direct'].index)
+        event_loss_set = pd.DataFrame([
+            (event_id, item_id, sidx, (event_id * item_id * sidx % 7) / 4.0)
+            for event_id in [1, 3]
+            for item_id in range(1, item_count + 1)
+            for sidx in [1, 2, 3]
+            if (event_id + item_id + sidx) % 5 != 0],
+            columns=['event_id', 'item_id', 'sidx', 'damage_ratio'])
+
+        self.assert_net_losses_equal(
+            self.run_case(
+                oed_dfs, event_loss_set=event_loss_set,
+                fm_engine=common.FM_ENGINE_NUMPY),
+            self.run_case(oed_dfs, event_loss_set=event_loss_set))
+    @parameterized.expand([
+        ('zero_sidx', [(1, 1, 0, 0.5)], "sidx below 1"),
+        ('negative_sidx', [(1, 1, -1, 0.5)], "sidx below 1"),
+        ('zero_item_id', [(1, 0, 1, 0.5)], "item_id outside 1 to"),
+        ('large_item_id', [(1, 1000, 1, 0.5)], "item_id outside 1 to"),
+        ('zero_event_id', [(0, 1, 1, 0.5)], "event_id below 1"),
+        ('duplicate', [(1, 1, 1, 0.5), (1, 1, 1, 0.25)],
+         "duplicate event_id, item_id and sidx"),
+        ('negative_damage_ratio', [(1, 1, 1, -0.5)], "damage_ratio not a finite"),
+        ('nan_damage_ratio', [(1, 1, 1, float('nan'))], "damage_ratio not a finite"),
+        ('inf_damage_ratio', [(1, 1, 1, float('inf'))], "damage_ratio not a finite"),
+        ('text_damage_ratio', [(1, 1, 1, 'half')], "damage_ratio not a finite"),
+        ('empty', None, "empty event loss set"),
+    ])
+    def test_invalid_event_loss_set(self, name, rows, message):
+        (account_df, location_df, _, _, _) = reinsurance_tester.load_oed_dfs(
+            os.path.join(input_dir, 'simple_QS'))
+        direct_layer = DirectLayer(account_df, location_df)
+        direct_layer.generate_oasis_structures()
+        event_loss_set = pd.DataFrame(
+            [] if rows is None else [(2, 2, 1, 0.5)] + rows,
+            columns=['event_id', 'item_id', 'sidx', 'damage_ratio'])
+
+        workspace = tempfile.mkdtemp()
+        try:
+            for fm_engine in common.FM_ENGINES:
+                with self.assertRaisesRegex(Exception, message):
+                    direct_layer.apply_fm(
+                        event_loss_set=event_loss_set, fm_engine=fm_engine,
+                        session=common.AnalysisSession(workspace))
+            self.assertEqual(os.listdir(workspace), [])
+        finally:
+            shutil.rmtree(workspace)
+
+
+class test_loss_factor_sweep(net_losses_test_case):
+    @parameterized.expand(event_loss_set_cases)
+    def test_loss_factor_sweep(self, name, case_dir):
+        net_losses = self.run_case(
+            reinsurance_tester.load_oed_dfs(case_dir), loss_factors=[0.5, 1.0, 2.0])
+
+        expected_dir = os.path.join(expected_output_dir, name)
+        for key in net_losses.keys():
+            self.assertEqual(
+                sorted(net_losses[key].loss_factor.unique()), [0.5, 1.0, 2.0])
+            losses_df = net_losses[key]
+            losses_df = losses_df[losses_df.loss_factor == 1.0]
+            del losses_df['loss_factor']
+            self.assert_single_event_losses_equal(
+                losses_df,
+                pd.read_csv(os.path.join(
+                    expected_dir, "{}.csv".format(key.replace(' ', '_')))))
+
+    def test_parse_loss_factors(self):
+        self.assertEqual(
+            reinsurance_tester.parse_loss_factors('0.1,0.5,1'), [0.1, 0.5, 1.0])
+        self.assertEqual(
+            reinsurance_tester.parse_loss_factors('0:1:5'),
+            [0.0, 0.25, 0.5, 0.75, 1.0])
+
+    @parameterized.expand([
+        ("single", [], []),
+        ("sweep", ["-s", "0.5,1"], ['loss_factor']),
+    ])
+    def test_locsum(self, name, args, key_columns):
+        workspace = tempfile.mkdtemp()
+        try:
+            subprocess.check_output(
+                [sys.executable, os.path.join(top_level_dir, "reinsurance_tester.py"),
+                 "-n", "run", "-o", os.path.join(input_dir, "loc_SS")] + args,
+                cwd=workspace)
+            loc_sum_df = pd.read_csv(os.path.join(
+                workspace, "run",
+                "Inuring_priority:1_-_Risk_level:LOC_output_locsum.csv"))
+        finally:
+            shutil.rmtree(workspace)
+
+        # The sums are written with their group keys
+        self.assertEqual(
+            list(loc_sum_df.columns[:len(key_columns) + 1]),
+            key_columns + ['location_number'])
+        # A row for each location, and loss factor of a sweep
+        loss_factor_count = 2 if key_columns else 1
+        self.assertEqual(
+            len(loc_sum_df.index),
+            loss_factor_count * loc_sum_df.location_number.nunique())
+
+
+class test_structure_cache(net_losses_test_case):
+
+    def setUp(self):
+        super(test_structure_cache, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        super(test_structure_cache, self).tearDown()
+
+    @parameterized.expand(event_loss_set_cases)
+    def test_structure_cache(self, name, case_dir):
+        oed_dfs = reinsurance_tester.load_oed_dfs(case_dir)
+        structure_cache = StructureCache(self.cache_dir)
+
+        expected_net_losses = self.run_case(oed_dfs, 0.5)
+        self.run_case(oed_dfs, structure_cache=structure_cache)
+        self.assertEqual(len(structure_cache.get_entries()), 1)
+
+        # The second run takes the structures from the cache
+        self.assert_net_losses_equal(
+            self.run_case(oed_dfs, 0.5, structure_cache=structure_cache),
+            expected_net_losses)
+
+    def test_structure_cache_eviction(self):
+        cases = [case_dir for (_, case_dir) in event_loss_set_cases[:3]]
+        structure_cache = StructureCache(self.cache_dir)
+        keys = []
+        for case_dir in cases:
+            oed_dfs = reinsurance_tester.load_oed_dfs(case_dir)
+            keys.append(structure_cache.get_key(*oed_dfs[:4]))
+            self.run_case(oed_dfs, structure_cache=structure_cache)
+            # Use the first entry after each run
+            run_dir = tempfile.mkdtemp()
+            structure_cache.get(keys[0], run_dir)
+            shutil.rmtree(run_dir)
+
+        # Fit the two most recently used entries
+        entries = structure_cache.get_entries()
+        structure_cache.max_size = sum(size for (_, size, _) in entries[1:])
+        structure_cache.evict()
+        self.assertEqual(
+            sorted(key for (_, _, key) in structure_cache.get_entries()),
+            sorted([keys[0], keys[2]]))
+
+
+class test_incremental(net_losses_test_case):
+
+    def test_incremental(self):
+        oed_dfs = reinsurance_tester.load_oed_dfs(os.path.join(fm_input_dir, 'fm24'))
+        ri_info_df = oed_dfs[2]
+        run_dir = os.path.join(self.workspace, "ri_testing")
+
+        self.run_case(oed_dfs, incremental=True)
+        outputs = ['ils.bin', 'ri_1_LOC.bin', 'ri_1_ACC.bin', 'ri_2_LOC.bin', 'ri_3_LOC.bin']
+        modified_times = [
+            os.stat(os.path.join(run_dir, output)).st_mtime_ns for output in outputs]
+
+        # Only the third inuring priority is rerun
+        ri_info_df.loc[ri_info_df.ReinsNumber == 10, 'PlacementPercent'] = 0.25
+        net_losses = self.run_case(oed_dfs, incremental=True)
+        self.assertEqual(
+            [os.stat(os.path.join(run_dir, output)).st_mtime_ns == modified_time
+             for (output, modified_time) in zip(outputs, modified_times)],
+            [True, True, True, True, False])
+
+        self.assert_net_losses_equal(net_losses, self.run_case(oed_dfs))
+
+
+class test_pipeline(net_losses_test_case):
+    @parameterized.expand(event_loss_set_cases)
+    def test_pipeline(self, name, case_dir):
+        oed_dfs = reinsurance_tester.load_oed_dfs(case_dir)
+
+        for loss_factors in [None, [0.5, 1.0, 2.0]]:
+            expected_net_losses = self.run_case(oed_dfs, loss_factors=loss_factors)
+            net_losses = self.run_case(
+                oed_dfs, loss_factors=loss_factors, chained=True)
+
+            self.assertFalse(os.path.exists(
+                os.path.join(self.workspace, "ri_testing", "ils.bin")))
+            self.assert_net_losses_equal(net_losses, expected_net_losses)
+
+    @parameterized.expand(event_loss_set_cases)
+    def test_partitions(self, name, case_dir):
+        oed_dfs = reinsurance_tester.load_oed_dfs(case_dir)
+        loss_factors = [0.5, 1.0, 2.0, 4.0]
+
+        expected_net_losses = self.run_case(oed_dfs, loss_factors=loss_factors)
+        for chained in [False, True]:
+            self.assert_net_losses_equal(
+                self.run_case(
+                    oed_dfs, loss_factors=loss_factors,
+                    session=common.AnalysisSession(self.workspace, partitions=3),
+                    chained=chained),
+                expected_net_losses)
+
+    def test_partition_processes(self):
+        oed_dfs = reinsurance_tester.load_oed_dfs(os.path.join(input_dir, 'multiple_FAC'))
+        loss_factors = [0.5, 1.0, 2.0, 4.0]
+        expected_net_losses = self.run_case(oed_dfs, loss_factors=loss_factors)
+
+        # Each chained pipeline runs one fmcalc per layer
+        layer_count = len(expected_net_losses)
+        for (max_processes, expected_workers) in [
+                (2 * layer_count, 2), (layer_count, 1), (1, 1)]:
+            max_workers = []
+            with mock.patch.object(
+                    common, 'ThreadPoolExecutor',
+                    lambda max_workers=None, record=max_workers: record.append(
+                        max_workers) or ThreadPoolExecutor(max_workers=max_workers)):
+                net_losses = self.run_case(
+                    oed_dfs, loss_factors=loss_factors,
+                    session=common.AnalysisSession(
+                        self.workspace, max_processes=max_processes, partitions=3),
+                    chained=True)
+
+            self.assertEqual(max_workers, [expected_workers])
+            self.assert_net_losses_equal(net_losses, expected_net_losses)
+
+    @parameterized.expand([
+        ("single", ['missing'], ()),
+        ("first", ['missing', 'direct'], ()),
+        ("last", ['direct', 'missing'], ()),
+        ("tapped", ['direct', 'missing', 'direct'], (0, 1)),
+    ])
+    def test_failed_layer(self, name, fm_input_dirs, taps):
+        self.run_case(reinsurance_tester.load_oed_dfs(os.path.join(input_dir, 'simple_QS')))
+
+        # The failed layer is reported rather than the truncated stream
+        session = common.AnalysisSession(os.path.join(self.workspace, "ri_testing"))
+        with open(os.path.join(session.workspace, "ils.bin"), 'rb') as input_file:
+            with self.assertRaisesRegex(
+                    Exception,
+                    "^Failed to run fm: fmcalc on missing exited with return code 1$"):
+                common.run_fmcalc_chain(
+                    fm_input_dirs, input_file=input_file, taps=taps, session=session)
+
+
+# The account file of acc_1_CAT_XL does not load
+plan_cases = [case for case in test_cases if case[0] != 'acc_1_CAT_XL']
+
+
+class test_plan(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    @parameterized.expand(plan_cases)
+    def test_plan_run(self, name, case_dir, expected_dir):
+        (
+            account_df,
+            location_df,
+            ri_info_df,
+            ri_scope_df,
+            do_reinsurance
+        ) = reinsurance_tester.load_oed_dfs(case_dir)
+        plan_df = reinsurance_tester.plan_run(
+            account_df, location_df, ri_info_df, ri_scope_df, do_reinsurance)
+
+        profile = run_profile.RunProfile()
+        reinsurance_tester.run_test(
+            "run",
+            account_df, location_df, ri_info_df, ri_scope_df,
+            1.0,
+            do_reinsurance,
+            session=common.AnalysisSession(self.workspace),
+            profile=profile)
+
+        self.assertEqual(plan_df.layer.tolist(), list(profile.counts.keys()))
+        for row in plan_df.itertuples():
+            for (count, value) in profile.counts[row.layer].items():
+                self.assertEqual(getattr(row, count), value, (row.layer, count))
+            layer_dir = os.path.join(self.workspace, "run", row.layer)
+            self.assertEqual(
+                row.input_bytes,
+                sum(os.path.getsize(os.path.join(layer_dir, file_name))
+                    for file_name in os.listdir(layer_dir)))
+            # fmcalc leaves out records with no loss
+            self.assertLessEqual(
+                os.path.getsize(os.path.join(
+                    self.workspace, "run",
+                    "ils.bin" if row.layer == "direct" else row.layer + ".bin")),
+                row.loss_stream_bytes)
+
+    @parameterized.expand([
+        ("single", None, None),
+        ("sweep", [0.5, 1.0, 2.0], None),
+        ("event_loss_set", None, pd.DataFrame(
+            [(event_id, item_id, sidx, 0.5)
+             for event_id in [1, 3] for item_id in range(1, 28) for sidx in [1, 2, 3]],
+            columns=['event_id', 'item_id', 'sidx', 'damage_ratio'])),
+    ])
+    def test_plan_sizes(self, name, loss_factors, event_loss_set):
+        # Every item of fm24 has a loss, so fmcalc writes every record
+        oed_dfs = reinsurance_tester.load_oed_dfs(os.path.join(fm_input_dir, 'fm24'))
+        plan_df = reinsurance_tester.plan_run(
+            *oed_dfs, loss_factors=loss_factors, event_loss_set=event_loss_set)
+        net_losses = reinsurance_tester.run_test(
+            "run",
+            *oed_dfs[:4],
+            1.0,
+            oed_dfs[4],
+            loss_factors=loss_factors,
+            event_loss_set=event_loss_set,
+            session=common.AnalysisSession(self.workspace))
+
+        self.assertEqual(len(plan_df.index), len(net_losses))
+        for (row, net_loss) in zip(plan_df.itertuples(), net_losses.values()):
+            self.assertEqual(
+                os.path.getsize(os.path.join(
+                    self.workspace, "run",
+                    "ils.bin" if row.layer == "direct" else row.layer + ".bin")),
+                row.loss_stream_bytes)
+            # The values of the net losses, without their index or strings
+            self.assertEqual(
+                net_loss.memory_usage(index=False).sum(), row.loss_memory_bytes)
+            self.assertLess(
+                row.loss_memory_bytes, net_loss.memory_usage(deep=True).sum())
+
+    def test_plan_writes_nothing(self):
+        # Even with a log and a structure cache set, which a run would create
+        output = subprocess.check_output(
+            [sys.executable, os.path.join(top_level_dir, "reinsurance_tester.py"),
+             "-n", "run", "-o", os.path.join(input_dir, "multiple_QS_1"),
+             "-d", "plan.log", "-c", "cache", "--plan"],
+            cwd=self.workspace)
+
+        self.assertIn(b"ri_1_ACC", output)
+        self.assertEqual(os.listdir(self.workspace), [])
+
+
+class test_analysis_session(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def test_concurrent_sessions(self):
+        cwd = os.getcwd()
+        cases = [
+            (name, case_dir, expected_dir)
+            for (name, case_dir, expected_dir) in test_cases
+            if name in ['simple_QS', 'multiple_FAC', 'loc_SS', 'fm24']]
+
+        def run_case(case):
+            (name, case_dir, _) = case
+            (
+                account_df,
+                location_df,
+                ri_info_df,
+                ri_scope_df,
+                do_reinsurance
+            ) = reinsurance_tester.load_oed_dfs(case_dir)
+            session = common.AnalysisSession(os.path.join(self.workspace, name))
+            os.mkdir(session.workspace)
+            return reinsurance_tester.run_test(
+                "run",
+                account_df, location_df, ri_info_df, ri_scope_df,
+                1.0,
+                do_reinsurance,
+                session=session)
 
+        with ThreadPoolExecutor(max_workers=len(cases)) as executor:
+            results = list(executor.map(run_case, cases))
 
+        self.assertEqual(os.getcwd(), cwd)
+        for ((name, _, expected_dir), net_losses) in zip(cases, results):
+            self.assertTrue(os.path.exists(
+                os.path.join(self.workspace, name, "run", "ils.bin")))
+            for key in net_losses.keys():
+                expected_df = pd.read_csv(os.path.join(
+                    expected_dir, "{}.csv".format(key.replace(' ', '_'))))
+                assert_frame_equal(net_losses[key], expected_df)
@@ -0,0 +1,158 @@
+"""
+    Check the timing, size and memory instrumentation of a run.
+    Run using:
+        python -m unittest -v tests/test_run_profile.py
+        py.test -v tests/test_run_profile.py
+"""
+import unittest
+
+import json
+import os
+import sys
+import shutil
+import tempfile
+import tracemalloc
+from pathlib import Path
+from unittest import mock
+
+top_level_dir = str(Path(__file__).parents[1])
+sys.path.insert(0, top_level_dir)
+import reinsurance_tester
+import common
+import run_profile
+
+
+input_dir = os.path.join(top_level_dir, 'examples')
+
+
+class test_run_profile(unittest.TestCase):
+
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def test_run_profile(self):
+        (
+            account_df,
+            location_df,
+            ri_info_df,
+            ri_scope_df,
+            do_reinsurance
+        ) = reinsurance_tester.load_oed_dfs(os.path.join(input_dir, 'multiple_QS_1'))
+        profile = run_profile.RunProfile(cprofile_stages=['ri_*'])
+        stage_times = {}
+        net_losses = reinsurance_tester.run_test(
+            "run",
+            account_df, location_df, ri_info_df, ri_scope_df,
+            1.0,
+            do_reinsurance,
+            session=common.AnalysisSession(self.workspace),
+            stage_times=stage_times,
+            profile=profile)
+
+        run_dir = os.path.join(self.workspace, "run")
+        with open(os.path.join(run_dir, run_profile.PROFILE_FILE)) as f:
+            profile_dict = json.load(f)
+        layer_names = ['direct'] + [
+            name for name in profile_dict['counts'].keys() if name != 'direct']
+        self.assertEqual(len(layer_names), len(net_losses))
+        self.assertEqual(
+            list(profile_dict['stage_times'].keys()),
+            ['total', 'direct', 'ils'] + layer_names[1:])
+        self.assertEqual(
+            {name: round(time, 6) for (name, time) in profile_dict['stage_times'].items()},
+            {name: round(time, 6) for (name, time) in stage_times.items()})
+
+        spans = profile_dict['spans']
+        span_names = set(span['name'] for span in spans)
+        for name in ['generate_structures', 'write_bin', 'fmcalc', 'merge']:
+            self.assertIn(name, span_names)
+        self.assertEqual(
+            sorted(span['attributes']['layer'] for span in spans
+                   if span['name'] == 'generate_structures'),
+            sorted(layer_names))
+        for (name, counts) in profile_dict['counts'].items():
+            self.assertEqual(
+                list(counts.keys()), ['items', 'programmes', 'profiles', 'policytcs'])
+            self.assertEqual(counts['items'], len(net_losses['Direct'].index))
+
+        # Each reinsurance layer's stage is profiled, and nothing else
+        self.assertEqual(len(profile_dict['cprofile_files']), len(layer_names) - 1)
+        for file_name in profile_dict['cprofile_files']:
+            self.assertTrue(file_name.startswith('ri_'))
+            self.assertTrue(os.path.exists(os.path.join(run_dir, file_name)))
+
+    def test_memory(self):
+        (
+            account_df,
+            location_df,
+            ri_info_df,
+            ri_scope_df,
+            do_reinsurance
+        ) = reinsurance_tester.load_oed_dfs(os.path.join(input_dir, 'multiple_QS_1'))
+        profile = run_profile.RunProfile(memory=True)
+        reinsurance_tester.run_test(
+            "run",
+            account_df, location_df, ri_info_df, ri_scope_df,
+            1.0,
+            do_reinsurance,
+            session=common.AnalysisSession(self.workspace),
+            profile=profile)
+
+        self.assertFalse(tracemalloc.is_tracing())
+        with open(os.path.join(self.workspace, "run", run_profile.MEMORY_FILE)) as f:
+            memory = json.load(f)
+        self.assertEqual(list(memory.keys()), list(profile.get_times('stage').keys()))
+        for usage in memory.values():
+            self.assertGreater(usage['peak_rss'], 0)
+            self.assertGreater(usage['children_peak_rss'], 0)
+            self.assertGreaterEqual(usage['traced_peak'], usage['traced_diff'])
+        # The run includes its stages
+        self.assertEqual(
+            memory['total']['traced_peak'],
+            max(usage['traced_peak'] for usage in memory.values()))
+        self.assertGreater(len(memory['total']['top_allocations']), 0)
+        self.assertGreater(profile.counts['net_losses']['bytes'], 0)
+
+    def test_overlapping_memory_profiles(self):
+        profiles = [run_profile.RunProfile(memory=True) for _ in range(2)]
+        stage_a = profiles[0].start_span("a", run_profile.CATEGORY_STAGE)
+        stage_b = profiles[1].start_span("b", run_profile.CATEGORY_STAGE)
+        data = bytearray(1 << 20)
+        profiles[0].end_span(stage_a)
+        self.assertTrue(tracemalloc.is_tracing())
+        del data
+        profiles[1].end_span(stage_b)
+        self.assertFalse(tracemalloc.is_tracing())
+
+        # Both stages see the peak of the allocation made while they overlapped
+        for (profile, name) in zip(profiles, ["a", "b"]):
+            self.assertGreaterEqual(profile.get_memory()[name]['traced_peak'], 1 << 20)
+
+    def test_reset_peak_rss(self):
+        # The process peak is only reset for profiles that ask for it
+        for reset_peak_rss in [False, True]:
+            profile = run_profile.RunProfile(memory=True, reset_peak_rss=reset_peak_rss)
+            with mock.patch.object(run_profile, '_reset_peak_rss') as reset:
+                with profile.span("stage", run_profile.CATEGORY_STAGE):
+                    pass
+            self.assertEqual(reset.called, reset_peak_rss)
+
+    def test_memory_without_reset_peak(self):
+        # tracemalloc.reset_peak needs Python 3.9
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        if reset_peak is not None:
+            del tracemalloc.reset_peak
+        try:
+            profile = run_profile.RunProfile(memory=True)
+            with profile.span("stage", run_profile.CATEGORY_STAGE):
+                data = bytearray(1 << 20)
+                del data
+        finally:
+            if reset_peak is not None:
+                tracemalloc.reset_peak = reset_peak
+
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertGreaterEqual(profile.get_memory()['stage']['traced_peak'], 1 << 20)